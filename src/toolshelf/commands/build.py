@@ -2,13 +2,52 @@
 Build (or re-build) the executables for the specified docked sources.
 
 build {<docked-source-spec>}
+
+Sources are built in an order which respects their build_requires hints;
+with -j, independent sources are built at the same time.  Sources which
+haven't changed since they were last built are skipped, unless --force
+is given.
 """
 
-from toolshelf.toolshelf import BaseCommand
+from toolshelf.toolshelf import BaseCommand, BuildScheduler
 
 class Command(BaseCommand):
     def show_progress(self):  # only if quiet
         return False
 
+    def skips_unchanged(self):
+        return True
+
+    def setup(self, shelf):
+        self.scheduler = BuildScheduler(shelf)
+        self.streaming = False
+
+    def prepare(self, shelf, sources):
+        self.scheduler.expect(sources)
+
+    def stream(self, shelf):
+        self.scheduler.start()
+        self.streaming = True
+
+    def waits_for_other_sources(self):
+        return True
+
+    def withdraw(self, shelf, source):
+        self.scheduler.withdraw(source)
+
+    def submit(self, shelf, source):
+        return self.scheduler.add(source)
+
     def perform(self, shelf, source):
-        source.build()
+        self.scheduler.add(source)
+
+    def teardown(self, shelf):
+        if self.streaming:
+            self.scheduler.finish()
+        else:
+            self.scheduler.run()
+        skipped = shelf.build_fingerprints.skipped
+        if skipped and not shelf.options.quiet:
+            print "Skipped %d sources which were already built:" % len(skipped)
+            for (source, reason) in sorted(skipped, key=lambda x: x[0].name):
+                print "  %s (%s)" % (source.name, reason)
@@ -9,11 +9,17 @@ from toolshelf.toolshelf import BaseCommand
 class Command(BaseCommand):
     def process_args(self, shelf, args):
         for (name, farm) in shelf.link_farms.iteritems():
+            links = {}
+            broken = False
             for (linkname, sourcename) in farm.links():
                 if not os.path.exists(sourcename):
                     shelf.note(
                         '`%s` does not exist, deleting `%s`...' %
                         (sourcename, linkname)
                     )
-                    os.unlink(linkname)
+                    broken = True
+                    continue
+                links[os.path.basename(linkname)] = sourcename
+            if broken:
+                farm.publish(links)
         return []
@@ -0,0 +1,30 @@
+"""
+Compile the cookies files into the cookie cache, or check them for errors.
+
+cookies compile|check
+
+`compile` re-parses every cookies file and rewrites the cookie cache,
+reporting any hints which could not be parsed.  `check` reports any such
+hints (re-parsing only those cookies files which have changed since they
+were last compiled) without otherwise doing anything.
+"""
+
+from toolshelf.toolshelf import BaseCommand, CommandLineSyntaxError
+
+class Command(BaseCommand):
+    def process_args(self, shelf, args):
+        if len(args) != 1 or args[0] not in ('compile', 'check'):
+            raise CommandLineSyntaxError(
+                "Usage: cookies compile|check"
+            )
+        if args[0] == 'compile':
+            shelf.cookies.compile()
+        else:
+            shelf.cookies.load(warn=False)
+        for filename in shelf.cookies.filenames:
+            errors = shelf.cookies.errors.get(filename, [])
+            if errors:
+                shelf.errors.setdefault(filename, []).extend(errors)
+            else:
+                shelf.note("%s: OK" % filename)
+        return []
@@ -0,0 +1,26 @@
+"""
+Replace identical read-only files in the specified sources with hard links
+to a single copy, and report how much space that reclaimed.
+
+dedup {<docked-source-spec>}
+"""
+
+import os
+
+from toolshelf.toolshelf import BaseCommand, Deduplicator
+
+class Command(BaseCommand):
+    def setup(self, shelf):
+        self.deduplicator = Deduplicator(
+            shelf, os.path.join(shelf.dir, '.cache', 'dedup.index')
+        )
+
+    def perform(self, shelf, source):
+        self.deduplicator.add(source)
+
+    def teardown(self, shelf):
+        (linked, reclaimed) = self.deduplicator.run()
+        self.deduplicator.save()
+        print "Linked %d files, reclaiming %d bytes (%.1f MB)." % (
+            linked, reclaimed, reclaimed / (1024.0 * 1024.0)
+        )
@@ -0,0 +1,13 @@
+"""
+Give sources cloned with --share-objects their own copies of the objects
+they borrow from the shared object pool, so they no longer depend on it.
+
+dissociate {<docked-source-spec>}
+"""
+
+from toolshelf.toolshelf import BaseCommand
+
+class Command(BaseCommand):
+    def perform(self, shelf, source):
+        if not source.dissociate():
+            shelf.note("%s does not use a shared object pool" % source.name)
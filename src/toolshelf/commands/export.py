@@ -10,11 +10,12 @@ class Command(BaseCommand):
     def perform(self, shelf, source):
         dest_dir = os.path.join(shelf.options.output_dir, source.name)
         if os.path.isdir(dest_dir):
-            shelf.chdir(source.dir)
             if os.path.isdir(os.path.join(source.dir, '.hg')):
-                shelf.run('hg', 'push', dest_dir, ignore_exit_code=True)
+                shelf.run('hg', 'push', dest_dir, ignore_exit_code=True,
+                          cwd=source.dir)
             elif os.path.isdir(os.path.join(source.dir, '.git')):
-                shelf.run('git', 'push', dest_dir, ignore_exit_code=True)
+                shelf.run('git', 'push', dest_dir, ignore_exit_code=True,
+                          cwd=source.dir)
             else:
                 raise NotImplementedError('source "%s" is not version-controlled' %
                                           source.name)
@@ -30,18 +30,21 @@ class Command(BaseCommand):
         self.problems = {}
 
     def perform(self, shelf, source):
+        def exists(filename):
+            return os.path.exists(os.path.join(source.dir, filename))
+
         prob = []
-        if not os.path.exists('README.markdown'):
+        if not exists('README.markdown'):
             prob.append("No README.markdown")
-        if not os.path.exists('LICENSE') and not os.path.exists('UNLICENSE'):
+        if not exists('LICENSE') and not exists('UNLICENSE'):
             prob.append("No LICENSE or UNLICENSE")
-        if os.path.exists('LICENSE') and os.path.exists('UNLICENSE'):
+        if exists('LICENSE') and exists('UNLICENSE'):
             prob.append("Both LICENSE and UNLICENSE")
-        for root, dirnames, filenames in os.walk('.'):
+        for root, dirnames, filenames in os.walk(source.dir):
             if root.endswith(".hg"):
                 del dirnames[:]
                 continue
-            if root == '.':
+            if root == source.dir:
                 root_files = []
                 for filename in filenames:
                     if filename not in OK_ROOT_FILES:
@@ -59,12 +62,12 @@ class Command(BaseCommand):
                     prob.append(
                         "Junk dirs in root: %s" % root_dirs
                     )
-        problems[source.dir] = prob
+        self.problems[source.dir] = prob
 
     def teardown(self, shelf):
         problematic_count = 0
         for d in sorted(self.problems.keys()):
-            if not problems[d]:
+            if not self.problems[d]:
                 continue
             print d
             print '-' * len(d)
@@ -8,7 +8,7 @@ from toolshelf.toolshelf import BaseCommand
 class Command(BaseCommand):
     def perform(self, shelf, source):
         print source.name
-        shelf.run('hg', 'out')
+        shelf.run('hg', 'out', cwd=source.dir)
         #outgoing = shelf.get_it("hg out")
         #if 'no changes found' not in outgoing:
         #    print outgoing
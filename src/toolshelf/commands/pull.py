@@ -6,9 +6,13 @@ it was originally docked.  Does not work on distfile-based sources.
 
 pull {<docked-source-spec>}
 
-"""
+When followed by other commands (as in `update`), those commands skip
+sources which pulling found no new changes for, unless --force is given.
+
+With --precheck, the upstream repos are first asked (all at once) what
+their heads are, and only sources which are behind are pulled.
 
-# TODO: figure out how to propogate was_changed to a subsequent 'build'
+"""
 
 from toolshelf.toolshelf import BaseCommand
 
@@ -16,5 +20,26 @@ class Command(BaseCommand):
     def show_progress(self):
         return False
 
+    def fetches(self):
+        return True
+
+    def prepare(self, shelf, sources):
+        self.up_to_date = set()
+        if not shelf.options.precheck:
+            return
+
+        def check(source):
+            if source.is_behind_upstream() is False:
+                self.up_to_date.add(source.dir)
+
+        shelf.foreach_source(
+            sources, check, progress=lambda x: x,
+            jobs=max(shelf.options.jobs, shelf.options.fetch_jobs)
+        )
+
     def perform(self, shelf, source):
-        source.update()
+        if source.dir in self.up_to_date:
+            shelf.note("%s is up to date with upstream, not pulling" %
+                       source.name)
+            return False
+        return source.update()
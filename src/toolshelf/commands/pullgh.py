@@ -14,4 +14,4 @@ class Command(BaseCommand):
 
     def perform(self, shelf, source):
         url = "git+ssh://git@github.com/%s/%s.git" % (source.user, source.project)
-        shelf.run('hg', 'pull', '-u', url)
+        shelf.run('hg', 'pull', '-u', url, cwd=source.dir)
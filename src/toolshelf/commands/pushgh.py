@@ -13,6 +13,6 @@ class Command(BaseCommand):
         return False
 
     def perform(self, shelf, source):
-        shelf.run('hg', 'bookmark', '-f', '-r', 'tip', 'master')
+        shelf.run('hg', 'bookmark', '-f', '-r', 'tip', 'master', cwd=source.dir)
         url = "git+ssh://git@github.com/%s/%s.git" % (source.user, source.project)
-        shelf.run('hg', 'push', url)
+        shelf.run('hg', 'push', url, cwd=source.dir)
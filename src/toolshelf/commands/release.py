@@ -70,7 +70,7 @@ class Command(BaseCommand):
             command.append(x)
         # hg archive -t zip -r 1.0 -X .hgignore -X .gitignore -X .hgtags -X .hg_archival.txt foobar-1.0.zip
         command.append(full_filename)
-        shelf.run(*command)
+        shelf.run(*command, cwd=source.dir)
         shelf.run('unzip', '-v', full_filename)
         # Chrysoberyl entry
         print """\
@@ -4,8 +4,17 @@ Update link farms to contain links to executables and libraries in sources.
 {<docked-source-spec>}
 """
 
-from toolshelf.toolshelf import BaseCommand
+from toolshelf.toolshelf import BaseCommand, LinkPlanner
 
 class Command(BaseCommand):
+    def skips_unchanged(self):
+        return True
+
+    def setup(self, shelf):
+        self.planner = LinkPlanner(shelf)
+
     def perform(self, shelf, source):
-        source.relink()
+        self.planner.add(source)
+
+    def teardown(self, shelf):
+        self.planner.apply()
@@ -6,7 +6,12 @@ from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
     def perform(self, shelf, source):
+        pool = source.shared_object_pool()
         shelf.run('rm', '-rf', source.dir)
+        if pool is not None:
+            source.release_object_pool(pool)
+        shelf.link_manifest.forget(source)
+        shelf.build_fingerprints.forget(source)
 
     def trigger_relink(self, shelf):
         return ['all']
@@ -0,0 +1,23 @@
+"""
+Restore the previous generation of each link farm.
+
+rollback
+
+Every time the link farms are changed (by `relink` and friends), the
+previous contents of each link farm are kept; this command makes them
+current again.  The rolled-back-from contents are discarded the next time
+the link farm is changed.
+"""
+
+from toolshelf.toolshelf import BaseCommand
+
+class Command(BaseCommand):
+    def process_args(self, shelf, args):
+        for (name, farm) in sorted(shelf.link_farms.iteritems()):
+            generation = farm.rollback()
+            if generation is None:
+                shelf.warn("No previous generation of %s" % farm.dirname)
+            else:
+                shelf.note("Rolled %s back to generation %d" %
+                           (farm.dirname, generation))
+        return []
@@ -13,7 +13,7 @@ class Command(BaseCommand):
 
     def perform(self, shelf, source):
         print source.name
-        dirty = shelf.get_it("hg st")
+        dirty = shelf.get_it("hg st", cwd=source.dir)
         tags = {}
         latest_tag = source.get_latest_release_tag(tags)
         due = ''
@@ -21,7 +21,8 @@ class Command(BaseCommand):
         if latest_tag is None:
             due = 'NEVER RELEASED'
         else:
-            diff = shelf.get_it('hg diff -r %s -r tip -X .hgtags' % latest_tag)
+            diff = shelf.get_it('hg diff -r %s -r tip -X .hgtags' % latest_tag,
+                                cwd=source.dir)
             if not diff:
                 due = ''
             else:
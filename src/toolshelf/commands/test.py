@@ -10,14 +10,11 @@ from toolshelf.toolshelf import BaseCommand, Path
 
 class Command(BaseCommand):
     def setup(self, shelf):
-        self.sources = 0
         self.no_tests = []
         self.passes = []
         self.fails = []
 
     def perform(self, shelf, source):
-        self.sources += 1
-
         test_requires = source.hints.get('test_requires', '')
         if test_requires:
             search_path = Path()
@@ -33,7 +30,7 @@ class Command(BaseCommand):
                 test_command = './test.sh'
         if test_command:
             process = subprocess.Popen(
-                test_command, shell=True,
+                test_command, shell=True, cwd=source.dir,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE
             )
             (std_output, std_error) = process.communicate()
@@ -48,7 +45,8 @@ class Command(BaseCommand):
             self.no_tests.append(source)
 
     def teardown(self, shelf):
-        print "Total docked sources tested:      %s" % self.sources
+        sources = len(self.no_tests) + len(self.passes) + len(self.fails)
+        print "Total docked sources tested:      %s" % sources
         print "Total without discoverable tests: %s" % len(self.no_tests)
         if shelf.options.verbose:
             print '(%s)' % ' '.join([s.name for s in self.no_tests])
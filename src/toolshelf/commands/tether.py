@@ -13,6 +13,9 @@ class Command(BaseCommand):
     def specs_are_external(self):
         return True
 
+    def fetches(self):
+        return True
+
     def perform(self, shelf, source):
         if source.docked:
             if source.tag:
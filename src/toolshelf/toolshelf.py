@@ -37,29 +37,138 @@ same parameters may be combined and executed aggregatively.
 
 """
 
+# Some of the modules used here (httplib, urllib2, urlparse, socket, tarfile,
+# zipfile, multiprocessing, and tqdm) are imported only in the functions which
+# need them, as they are slow to import, and most invocations of toolshelf
+# never use them.
+
+import bisect
+import collections
 import errno
+import fcntl
 import fnmatch
+import hashlib
 import os
 import optparse
-import pkgutil
 import re
+import shutil
+import stat
+import struct
 import subprocess
 import sys
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from Queue import Queue, Empty
+from StringIO import StringIO
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 try:
-    from tqdm import tqdm
+    import lzma
 except ImportError:
-    def tqdm(x):
-        return x
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 
 __all__ = ['Toolshelf']
 
 
+class LazyRegex(object):
+    """A regular expression which is compiled when it is first used, rather
+    than when it is defined.  Few of the patterns below are needed by any
+    one invocation of toolshelf, and compiling all of them would make up a
+    good part of its startup time.
+
+    """
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = getattr(re.compile(self.pattern, self.flags), name)
+        setattr(self, name, value)
+        return value
+
+
 ### Constants
 
 COMMANDS_PATH = os.path.join(os.path.dirname(__file__), 'commands')
-COMMANDS = [name for _, name, _ in pkgutil.iter_modules([COMMANDS_PATH])]
+COMMANDS = sorted(
+    name[:-3] for name in os.listdir(COMMANDS_PATH)
+    if name.endswith('.py') and name != '__init__.py'
+)
+# the first line of each command's docstring, for the usage message, so that
+# showing it does not mean importing every command module.  Commands missing
+# from here are still listed; their modules are imported to describe them.
+COMMAND_SUMMARIES = {
+    'bbuser': "Dump a catalog for all of a Bitbucket user's repositories.",
+    'build': "Build (or re-build) the executables for the specified docked "
+             "sources.",
+    'cleanfarms': "Remove broken links from link farms.",
+    'collectdocs': "Find documentation files and write out Yaml file "
+                   "summarizing them.",
+    'cookies': "Compile the cookies files into the cookie cache, or check "
+               "them for errors.",
+    'dedup': "Replace identical read-only files in the specified sources "
+             "with hard links",
+    'disable': "Temporarily remove links to executables and libraries in "
+               "specified sources.",
+    'dissociate': "Give sources cloned with --share-objects their own "
+                  "copies of the objects",
+    'enable': "Restore any previously disabled links for the given sources.",
+    'export': "Clones a copy of each of the docked sources to the output "
+              "directory.",
+    'ghstars': "Dump a catalog for all of a Github user's starred "
+               "repositories.",
+    'ghuser': "Dump a catalog for all of a Github user's repositories.",
+    'hgrcify': "Update config of Mercurial sources to include username.",
+    'lint': "Check that the layouts of given sources conform to some "
+            "guidelines.",
+    'outgoing': "Crudely reports docked sources that have changes not in "
+                "the upstream repo.",
+    'pull': "Pull latest revision of specified sources from each's "
+            "upstream repository.",
+    'pullgh': "Pull updates from a Github git mirror of a Mercurial "
+              "repository.",
+    'pushgh': "Push updates to a Github git mirror of a Mercurial "
+              "repository.",
+    'rectify': "Traverse sources and set executable permissions "
+               "'reasonably' on all files.",
+    'release': "Create a release distfile from the latest tag in a docked "
+               "source.",
+    'relink': "Update link farms to contain links to executables and "
+              "libraries in sources.",
+    'remove': "Delete the specified source trees and relink all remaining "
+              "docked sources.",
+    'resolve': "Emit the names of the directories of the docked sources.",
+    'rollback': "Restore the previous generation of each link farm.",
+    'show': "Display links made in links farms from the specified sources.",
+    'status': "Show `hg st` or `git status` as appropriate for specified "
+              "sources.",
+    'survey': "Generate report summarizing various properties of the "
+              "specified sources.",
+    'test': "Look for test suites in docked sources and run them.",
+    'tether': "Obtain external source trees (repos or distfiles, from "
+              "internet or filesystem).",
+    'which': "Display locations within sources where executable or library "
+             "is found.",
+}
 ALIASES = {
     'dock':   'tether+build+relink',
     'update': 'pull+build+relink',
@@ -110,10 +219,19 @@ UNINTERESTING_EXECUTABLES = (
     'dirname', 'basename', 'mt',
 )
 
+UNINTERESTING_RE = LazyRegex(
+    '^(?:%s)$' % '|'.join('(?:%s)' % p for p in UNINTERESTING_EXECUTABLES)
+)
+
 UNINTERESTING_PATHS = (
     'test', 'tests', 'dep', 'deps'
 )
 
+SHARED_OBJECT_RE = LazyRegex(r'^.*?\.so(\.\d+)?$')
+STATIC_LIB_RE = LazyRegex(r'^.*?\.a$')
+PKGCONFIG_DATA_RE = LazyRegex(r'^.*?\.pc$')
+UNINSTALLED_PKGCONFIG_DATA_RE = LazyRegex(r'^.*?uninstalled\.pc$')
+
 HINT_NAMES = (
     'build_command',
     'test_command',
@@ -127,10 +245,80 @@ HINT_NAMES = (
     'python_modules',
     'lua_modules',
     'include_dirs',  # defaults to '/install/include' if it exists
+    'sha256',
+    'clone_depth',
+    'clone_filter',
 )
 
+HINT_RE = LazyRegex(r'^(%s)(@\w+)?\s+(.*?)\s*$' % '|'.join(HINT_NAMES))
+
 LINK_FARM_NAMES = ('bin', 'lib', 'include', 'pkgconfig', 'python', 'lua')
 
+# the hints which affect which files of a source are linked into link farms
+LINK_HINT_NAMES = (
+    'exclude_paths',
+    'only_paths',
+    'interesting_executables',
+    'python_modules',
+    'lua_modules',
+    'include_dirs',
+)
+
+GLOB_CHARS_RE = LazyRegex(r'[*?[]')
+
+SHA256_RE = LazyRegex(r'^[0-9a-fA-F]{64}$')
+COMMIT_ID_RE = LazyRegex(r'^[0-9a-fA-F]{7,40}$')
+
+SPEC_TAG_RE = LazyRegex(r'^(.*?)\@(.*?)$')
+SPEC_SHORTHAND_RE = LazyRegex(r'^(gh|bb):(.*?)\/(.*?)$')
+MAGIC_DISTFILE_NAME_RE = LazyRegex(r'^([^,]*?),([^,]*?),([^,]*?)(\-[^\-]*?)?$')
+
+DISTFILE_TYPES = ('zip', 'tgz', 'tar.gz', 'tar.xz', 'tar.bz2')
+DISTFILE_URL_RE = LazyRegex(r'^(https?|ftp):\/\/(.*?)/.*?\/?([^/]*?)'
+                             r'\.(zip|tgz|tar\.gz|tar\.xz|tar\.bz2)$')
+# the patterns for external source specs, keyed by URL scheme, with the
+# kind of source each describes; for each spec, those for its scheme are
+# tried in order, then those under None
+SPEC_PATTERNS = {
+    'git': (
+        (LazyRegex(r'^git:\/\/(.*?)/(.*?)/(.*?)\.git$'), 'git'),
+    ),
+    'file': (
+        (LazyRegex(r'^file:\/\/.*?/([^/]*?)/([^/]*?)(\.git)?\/?$'), 'file'),
+    ),
+    'http': (
+        (LazyRegex(r'^https?:\/\/(.*?)/(.*?)/(.*?)\.git$'), 'git'),
+        (DISTFILE_URL_RE, 'distfile'),
+        (LazyRegex(r'^https?:\/\/(.*?)/(.*?)/(.*?)\/?$'), 'hg-or-git'),
+    ),
+    'ftp': (
+        (DISTFILE_URL_RE, 'distfile'),
+    ),
+    None: (
+        (LazyRegex(r'^(.*?\/)([^/]*?)\.(zip|tgz|tar\.gz|tar\.xz|tar\.bz2)$'),
+         'local-distfile'),
+        (LazyRegex(r'^(.*?)\/(.*?)\/(.*?)$'), 'docked'),
+    ),
+}
+SPEC_PATTERNS['https'] = SPEC_PATTERNS['http']
+
+# bump this whenever the layout of anything written by save_cache changes
+CACHE_VERSION = 2
+
+# bump this whenever the way cookies files are parsed, or the hints in them
+# are validated, changes; compiled cookies files are re-parsed if this (or
+# HINT_NAMES) is not what it was when they were compiled
+COOKIES_PARSER_VERSION = 1
+
+RECTIFY_ENGINES = ('magic', 'file')
+
+ELF_MAGIC = '\x7fELF'
+MACHO_MAGICS = {
+    '\xfe\xed\xfa\xce': '>', '\xfe\xed\xfa\xcf': '>',
+    '\xce\xfa\xed\xfe': '<', '\xcf\xfa\xed\xfe': '<',
+}
+MACHO_FAT_MAGIC = '\xca\xfe\xba\xbe'
+
 ### Exceptions
 
 class CommandLineSyntaxError(ValueError):
@@ -146,33 +334,27 @@ class DependencyError(ValueError):
     pass
 
 
-### Helper Functions
-
-
-def is_executable(filename):
-    return os.path.isfile(filename) and os.access(filename, os.X_OK)
-
+class ChecksumError(ValueError):
+    pass
 
-def is_shared_object(filename):
-    match = re.match('^.*?\.so(\.\d+)?$', filename)
-    return ((os.path.isfile(filename) or os.path.islink(filename)) and match)
 
+class UnsafeArchiveError(ValueError):
+    pass
 
-def is_static_lib(filename):
-    match = re.match('^.*?\.a$', filename)
-    return ((os.path.isfile(filename) or os.path.islink(filename)) and match)
 
+### Helper Functions
 
-def is_library(filename):
-    return is_shared_object(filename) or is_static_lib(filename)
 
+def progress_bar(iterable):
+    """Wrap the given iterable in a `tqdm` progress bar, if `tqdm` is
+    installed; otherwise return it as it is.
 
-def is_pkgconfig_data(filename):
-    if re.match('^.*?\.pc$', filename) is None:
-        return False
-    if re.match('^.*?\uninstalled\.pc$', filename) is not None:
-        return False
-    return True
+    """
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        return iterable
+    return tqdm(iterable)
 
 
 def is_python_package(filename):
@@ -186,8 +368,145 @@ def is_python_package(filename):
     return False
 
 
-def is_lua_module(filename):
-    return filename.endswith('.lua') and os.path.isfile(filename)
+def looks_executable(filename):
+    """Return True if the contents of the given file look like those of
+    an executable: an ELF executable (but not a shared library), a Mach-O
+    executable, a PE (or MS-DOS) executable, or a script with a `#!` line.
+    These are the files which `file` describes as "executable".
+
+    """
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(64)
+            if header.startswith('#!'):
+                return True
+            if header.startswith('MZ') and len(header) >= 64:
+                return True
+            if header.startswith(ELF_MAGIC):
+                return elf_is_executable(f, header)
+            magic = header[:4]
+            if magic in MACHO_MAGICS and len(header) >= 16:
+                (filetype,) = struct.unpack(
+                    MACHO_MAGICS[magic] + 'I', header[12:16]
+                )
+                return filetype == 2  # MH_EXECUTE
+            if magic == MACHO_FAT_MAGIC and len(header) >= 8:
+                # Java class files share this magic number, but follow
+                # it with a version number rather than a small count
+                # of architectures.
+                (nfat_arch,) = struct.unpack('>I', header[4:8])
+                return 0 < nfat_arch < 32
+    except (IOError, OSError, struct.error):
+        pass
+    return False
+
+
+def elf_is_executable(f, header):
+    """Given an open ELF file and its first 64 bytes, return True if it
+    is an executable.  Position-independent executables have the same
+    type as shared libraries, so those are told apart by the PIE flag
+    in their dynamic section.
+
+    """
+    if len(header) < 52:
+        return False
+    endian = {'\x01': '<', '\x02': '>'}.get(header[5])
+    if endian is None:
+        return False
+    (e_type,) = struct.unpack(endian + 'H', header[16:18])
+    if e_type == 2:  # ET_EXEC
+        return True
+    if e_type != 3:  # ET_DYN
+        return False
+    if header[4] == '\x02':
+        if len(header) < 64:
+            return False
+        (phoff,) = struct.unpack(endian + 'Q', header[32:40])
+        (phentsize, phnum) = struct.unpack(endian + 'HH', header[54:58])
+        phdr_format = endian + 'I4xQ16xQ'
+        dyn_format = endian + 'qQ'
+    else:
+        (phoff,) = struct.unpack(endian + 'I', header[28:32])
+        (phentsize, phnum) = struct.unpack(endian + 'HH', header[42:46])
+        phdr_format = endian + 'II8xI'
+        dyn_format = endian + 'iI'
+    phdr_size = struct.calcsize(phdr_format)
+    dyn_size = struct.calcsize(dyn_format)
+    for index in xrange(min(phnum, 256)):
+        f.seek(phoff + index * phentsize)
+        (p_type, p_offset, p_filesz) = struct.unpack(
+            phdr_format, f.read(phdr_size)
+        )
+        if p_type != 2:  # PT_DYNAMIC
+            continue
+        f.seek(p_offset)
+        dynamic = f.read(min(p_filesz, 65536))
+        for offset in xrange(0, len(dynamic) - dyn_size + 1, dyn_size):
+            (d_tag, d_val) = struct.unpack_from(dyn_format, dynamic, offset)
+            if d_tag == 0:  # DT_NULL
+                break
+            if d_tag == 0x6ffffffb:  # DT_FLAGS_1
+                return bool(d_val & 0x08000000)  # DF_1_PIE
+    return False
+
+
+def span_length(spans):
+    """Return the total length of time covered by the given list of
+    (start, end) tuples, counting time covered more than once only once.
+
+    """
+    total = 0.0
+    current_start = current_end = None
+    for (start, end) in sorted(spans):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            (current_start, current_end) = (start, end)
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def interleave_by_host(sources):
+    """Return the given Sources reordered so that, as far as possible,
+    consecutive Sources come from different hosts.  Sources from the same
+    host stay in the same order relative to each other.
+
+    """
+    queues = collections.OrderedDict()
+    for source in sources:
+        queues.setdefault(source.host, collections.deque()).append(source)
+    result = []
+    while queues:
+        for host in list(queues):
+            queue = queues[host]
+            result.append(queue.popleft())
+            if not queue:
+                del queues[host]
+    return result
+
+
+def shared_object_pool(dirname):
+    """Return the shared object pool which the repository in the given
+    directory was cloned against (see `Source.object_pool`), or None if it
+    has its own copy of everything.
+
+    """
+    for (filename, suffix) in (
+        (os.path.join(dirname, '.git', 'objects', 'info', 'alternates'),
+         'objects'),
+        (os.path.join(dirname, '.hg', 'sharedpath'), '.hg'),
+    ):
+        try:
+            with open(filename) as f:
+                path = f.readline().strip()
+        except IOError:
+            continue
+        if os.path.basename(path.rstrip(os.sep)) == suffix:
+            return os.path.dirname(path.rstrip(os.sep))
+    return None
 
 
 def makedirs(dirname):
@@ -199,16 +518,188 @@ def makedirs(dirname):
         else:
             raise
 
+
+def load_cache(filename):
+    """Return the object stored in the given cache file by save_cache,
+    or None if the file is missing, unreadable, or from another version.
+
+    """
+    try:
+        with open(filename, 'rb') as cache_file:
+            (version, obj) = pickle.load(cache_file)
+    except Exception:
+        return None
+    if version != CACHE_VERSION:
+        return None
+    return obj
+
+
+def save_cache(filename, obj):
+    """Atomically replace the given cache file with one containing obj."""
+    makedirs(os.path.dirname(filename))
+    temp_filename = '%s.%d.%d.tmp' % (
+        filename, os.getpid(), threading.current_thread().ident
+    )
+    with open(temp_filename, 'wb') as cache_file:
+        pickle.dump((CACHE_VERSION, obj), cache_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_filename, filename)
+
+
+class DirEntry(object):
+    """A minimal stand-in for the entries returned by `scandir`, used
+    when it is not available.  Caches the results of lstat and stat.
+
+    """
+    __slots__ = ('name', 'path', '_lstat', '_stat')
+
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._lstat = None
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if not follow_symlinks:
+            return self._lstat
+        if self._stat is None:
+            if stat.S_ISLNK(self._lstat.st_mode):
+                self._stat = os.stat(self.path)
+            else:
+                self._stat = self._lstat
+        return self._stat
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def dir_entries(dirname):
+    if scandir is not None:
+        return list(scandir(dirname))
+    return [DirEntry(dirname, name) for name in os.listdir(dirname)]
+
+
+def scan_tree(top):
+    """Walk the directory tree rooted at `top`, top-down, without following
+    symbolic links to directories.
+
+    Like `os.walk`, yields a 3-tuple for each directory, and the list of
+    subdirectory names in it may be pruned in place to avoid descending
+    into them.  Unlike `os.walk`, the third element is a list of directory
+    entries (as returned by `scandir`) for the non-directories in it.
+
+    """
+    try:
+        entries = dir_entries(top)
+    except OSError:
+        return
+    dirs = []
+    files = []
+    subdir_entries = {}
+    for entry in entries:
+        if entry.is_dir():
+            dirs.append(entry.name)
+            subdir_entries[entry.name] = entry
+        else:
+            files.append(entry)
+    yield (top, dirs, files)
+    for name in dirs:
+        entry = subdir_entries.get(name)
+        if entry is None or entry.is_symlink():
+            continue
+        for result in scan_tree(entry.path):
+            yield result
+
+
+def check_archive_member(dest_dir, name, symlink=None, hardlink=None,
+                         absolute_links=True):
+    """Raise UnsafeArchiveError if extracting the archive member with the
+    given name (relative to `dest_dir`) would write anything outside of
+    `dest_dir`, by way of an absolute name, `..`, or a symbolic link which
+    has already been extracted.  `symlink` is the target of the member,
+    if it is a symbolic link, and `hardlink` the name (relative to
+    `dest_dir`) of the file it is a hard link to, if it is one; these must
+    not lead outside of `dest_dir` either.  Unless `absolute_links` is
+    True, symbolic links with absolute targets are refused outright.
+
+    """
+    dest_dir = os.path.realpath(dest_dir)
+
+    def check_inside(path, what):
+        if path != dest_dir and not path.startswith(dest_dir + os.sep):
+            raise UnsafeArchiveError("%s %s: %s is outside %s" %
+                                     (what, name, path, dest_dir))
+
+    if os.path.isabs(name) or '..' in name.split('/'):
+        raise UnsafeArchiveError("Unsafe member name %s" % name)
+    path = os.path.join(dest_dir, name)
+    parent = os.path.realpath(os.path.dirname(path))
+    check_inside(parent, "Member")
+    if symlink is not None:
+        if os.path.isabs(symlink) and not absolute_links:
+            raise UnsafeArchiveError("Symlink %s: %s is absolute" %
+                                     (name, symlink))
+        # an existing file is replaced by the symlink, not followed
+        target = os.path.join(parent, symlink)
+        check_inside(os.path.normpath(target), "Symlink")
+        check_inside(os.path.realpath(target), "Symlink")
+    else:
+        check_inside(os.path.realpath(path), "Member")
+    if hardlink is not None:
+        if os.path.isabs(hardlink) or '..' in hardlink.split('/'):
+            raise UnsafeArchiveError("Hard link %s: unsafe target %s" %
+                                     (name, hardlink))
+        check_inside(os.path.realpath(os.path.join(dest_dir, hardlink)),
+                     "Hard link")
+
+
+def file_signature(filename):
+    """Return a (size, mtime) tuple which changes when the file does."""
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime)
+
 ### Classes
 
 # hints are stored under a 'spec key' which is a glob which
 # matches a *docked* source spec.
 
 class Cookies(object):
-    def __init__(self, shelf):
+    """The hints from one or more cookies files.
+
+    Parsing a cookies file is done once per change to that file; the
+    resulting hint maps are kept in a compiled cache (keyed by the
+    filename, size and mtime of each cookies file, along with the hint
+    names and the version of the parser which were current when it was
+    compiled) and any problems found while parsing are reported only when
+    the file is compiled.
+
+    Hints are loaded when they are first needed, which may be in several
+    worker threads at once; `lock` makes sure they are loaded only once,
+    and that no thread sees them before they have all been loaded.
+
+    """
+    def __init__(self, shelf, cache_filename=None):
         self.shelf = shelf
+        self.cache_filename = cache_filename
         self._hint_maps = None
+        self._matchers = None
+        self._resolved = {}
         self.filenames = []
+        self.errors = {}
+        self.lock = threading.RLock()
 
     def add_file(self, filename):
         """Will not work after hints have been loaded.
@@ -216,102 +707,375 @@ class Cookies(object):
         if os.path.exists(filename):
             self.filenames.append(filename)
 
-    def _load_hints(self):
-        self._hint_maps = []
+    def _load_hints(self, warn=True):
+        cache = {}
+        if self.cache_filename is not None:
+            cache = load_cache(self.cache_filename) or {}
+        dirty = False
+        hint_maps = []
         for filename in self.filenames:
-            self._load_hints_from_file(filename)
+            signature = (COOKIES_PARSER_VERSION, HINT_NAMES,
+                         file_signature(filename))
+            entry = cache.get(filename)
+            if entry is None or entry[0] != signature:
+                (hint_map, errors) = self._load_hints_from_file(filename)
+                if warn:
+                    for error in errors:
+                        self.shelf.warn(error)
+                entry = (signature, hint_map, errors)
+                cache[filename] = entry
+                dirty = True
+            hint_maps.append(entry[1])
+            self.errors[filename] = entry[2]
+        if dirty and self.cache_filename is not None:
+            try:
+                save_cache(self.cache_filename, cache)
+            except (IOError, OSError) as e:
+                self.shelf.debug("Could not save cookie cache: %s" % e)
+        self._matchers = None
+        self._resolved = {}
+        self._hint_maps = hint_maps
 
     def _load_hints_from_file(self, filename):
-        hint_map = {}
+        """Parse a cookies file, returning a tuple of its hint map and
+        a list of messages describing any lines which were rejected.
+
+        """
+        hint_map = collections.OrderedDict()
+        errors = []
         with open(filename, 'r') as hints_file:
             spec_key = None
-            for line in hints_file:
+            for (line_number, line) in enumerate(hints_file):
                 line = line.strip()
                 if line == '' or line.startswith('#'):
                     continue
-                found_hint = False
-                for hint_name in HINT_NAMES:
-                    pattern = r'^%s(@\w+)?\s+(.*?)\s*$' % hint_name
-                    match = re.match(pattern, line)
-                    if match:
-                        if spec_key is None:
-                            raise SourceSpecError(
-                                'Found hint %s before any spec' % hint_name
-                            )
-                        arch_hint_name = hint_name + (match.group(1) or '')
-                        hint_value = match.group(2)
-                        self.shelf.debug("Adding hint '%s %s' to %s" %
-                            (arch_hint_name, hint_value, spec_key)
-                        )
-                        hint_map[spec_key][arch_hint_name] = hint_value
-                        if (hint_name == 'rectify_permissions' and
-                            hint_value not in ('yes', 'no')):
-                            raise ValueError(
-                                "rectify_permissions must be 'yes' or 'no'"
-                            )
-                        found_hint = True
-                        break
-                if not found_hint:  # ... then we found a spec
+                match = HINT_RE.match(line)
+                if not match:  # ... then we found a spec
                     spec_key = line
                     hint_map.setdefault(spec_key, {})
-        self._hint_maps.append(hint_map)
+                    continue
+                hint_name = match.group(1)
+                where = '%s:%d' % (filename, line_number + 1)
+                if spec_key is None:
+                    errors.append(
+                        '%s: Found hint %s before any spec' % (where, hint_name)
+                    )
+                    continue
+                arch_hint_name = hint_name + (match.group(2) or '')
+                hint_value = match.group(3)
+                if (hint_name == 'rectify_permissions' and
+                    hint_value not in ('yes', 'no')):
+                    errors.append(
+                        "%s: rectify_permissions must be 'yes' or 'no'" % where
+                    )
+                    continue
+                if (hint_name == 'clone_depth' and
+                    not hint_value.isdigit()):
+                    errors.append(
+                        "%s: clone_depth must be a number" % where
+                    )
+                    continue
+                if (hint_name == 'sha256' and
+                    not SHA256_RE.match(hint_value)):
+                    errors.append(
+                        "%s: sha256 must be 64 hexadecimal digits" % where
+                    )
+                    continue
+                self.shelf.debug("Adding hint '%s %s' to %s" %
+                    (arch_hint_name, hint_value, spec_key)
+                )
+                hint_map[spec_key][arch_hint_name] = hint_value
+        return (hint_map, errors)
+
+    def compile(self):
+        """Re-parse all cookies files, regardless of the state of the
+        cache, and update the cache.  Problems found are not displayed,
+        only collected in `errors`.
+
+        """
+        with self.lock:
+            if (self.cache_filename is not None and
+                os.path.exists(self.cache_filename)):
+                os.unlink(self.cache_filename)
+            self._load_hints(warn=False)
+
+    def load(self, warn=True):
+        """Load the hints, if they have not been loaded already.  Problems
+        found in cookies files which had to be re-parsed are displayed as
+        warnings (unless `warn` is False), and collected in `errors`.
+
+        """
+        if self._hint_maps is None:
+            with self.lock:
+                if self._hint_maps is None:
+                    self._load_hints(warn=warn)
 
     @property
     def hint_maps(self):
-        if self._hint_maps is None:
-            self._load_hints()
+        self.load()
         return self._hint_maps
 
-    def apply_hints(self, source):
-        for hint_map in self.hint_maps:
-            found_in_map = False
-            for (key, hints) in hint_map.iteritems():
-                pattern = fnmatch.translate(key)
-                match = re.match(pattern, source.name)
-                if match:
-                    source.hints.update(hints)
-                    found_in_map = True
-            if found_in_map:
-                break
+    @property
+    def matchers(self):
+        if self._matchers is None:
+            with self.lock:
+                if self._matchers is None:
+                    self._matchers = [CookieMatcher(m)
+                                      for m in self.hint_maps]
+        return self._matchers
+
+    def hints_for(self, name):
+        """Return the hints which apply to the source with the given name.
+
+        The hints come from the first hint map in which any spec key
+        matches the name; the hints of all the matching spec keys in
+        that map are merged, in the order they appear in the file.
+
+        """
+        hints = self._resolved.get(name)
+        if hints is None:
+            hints = {}
+            for matcher in self.matchers:
+                found = matcher.match(name)
+                if found:
+                    for key_hints in found:
+                        hints.update(key_hints)
+                    break
+            self._resolved[name] = hints
+        return hints
+
+
+class Catalogs(object):
+    """The source specs listed in catalog files.
+
+    A catalog lists one source spec per line, and may include other
+    catalogs with `@file` and `@@name` lines.  The expansion of each
+    catalog (its specs, with those of the catalogs it includes in place
+    of the include lines, and duplicates removed) is kept in a compiled
+    cache, along with the size and mtime of every file it was expanded
+    from, and is only re-read when one of those has changed.  In any one
+    run, each catalog is expanded at most once, however often it is
+    included.
+
+    """
+    def __init__(self, shelf, cache_filename=None):
+        self.shelf = shelf
+        self.cache_filename = cache_filename
+        self._cache = None
+        self.dirty = False
+        self.expansions = {}
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = {}
+            if self.cache_filename is not None:
+                self._cache = load_cache(self.cache_filename) or {}
+        return self._cache
+
+    def resolve(self, name):
+        """Return the filename of the catalog named by an `@` or `@@`
+        spec.
+
+        """
+        if name.startswith('@@'):
+            filename = os.path.join(
+                self.shelf.dir, '.toolshelf', 'catalog', name[2:] + '.catalog'
+            )
+        else:
+            filename = os.path.join(self.shelf.cwd, name[1:])
+        return os.path.normpath(filename)
+
+    def is_current(self, entry):
+        (signatures, includes, specs) = entry
+        for (filename, signature) in signatures.iteritems():
+            try:
+                if file_signature(filename) != signature:
+                    return False
+            except OSError:
+                return False
+        # `@file` includes are relative to the current directory
+        for (name, filename) in includes:
+            if self.resolve(name) != filename:
+                return False
+        return True
+
+    def expand(self, filename, including=()):
+        """Return the specs in the given catalog file, with included
+        catalogs expanded in place, and duplicates removed.
+
+        """
+        return self._expand(filename, including)[2]
+
+    def _expand(self, filename, including):
+        if filename in including:
+            cycle = including[including.index(filename):] + (filename,)
+            raise SourceSpecError(
+                "Catalogs include each other: %s" % ' -> '.join(cycle)
+            )
+        entry = self.expansions.get(filename)
+        if entry is not None:
+            return entry
+        entry = self.cache.get(filename)
+        if entry is None or not self.is_current(entry):
+            entry = self._read(filename, including + (filename,))
+            self.cache[filename] = entry
+            self.dirty = True
+        self.expansions[filename] = entry
+        return entry
+
+    def _read(self, filename, including):
+        self.shelf.debug('Reading catalog %s' % filename)
+        signatures = {filename: file_signature(filename)}
+        includes = set()
+        specs = []
+        seen = set()
+        with open(filename, 'r') as file:
+            for line in file:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                if line.startswith('@'):
+                    included_filename = self.resolve(line)
+                    (included_signatures, included_includes, new_specs) = \
+                        self._expand(included_filename, including)
+                    signatures.update(included_signatures)
+                    includes.update(included_includes)
+                    includes.add((line, included_filename))
+                else:
+                    new_specs = (line,)
+                for spec in new_specs:
+                    if spec not in seen:
+                        seen.add(spec)
+                        specs.append(spec)
+        return (signatures, frozenset(includes), specs)
+
+    def save(self):
+        if self.dirty and self.cache_filename is not None:
+            try:
+                save_cache(self.cache_filename, self.cache)
+            except (IOError, OSError) as e:
+                self.shelf.debug("Could not save catalog cache: %s" % e)
+            self.dirty = False
+
+
+class CookieMatcher(object):
+    """Finds the spec keys in a hint map which match a given source name.
+
+    Spec keys of the form host/user/project are bucketed by their literal
+    project, user, or host segment (in that order of preference) or,
+    failing that, by the literal prefix of their project segment.  Only
+    the keys in the buckets a name falls into, and the few keys which
+    could not be bucketed, are actually matched against it.
+
+    """
+    def __init__(self, hint_map):
+        self.entries = []
+        self.by_segment = ({}, {}, {})
+        self.by_project_prefix = {}
+        self.unbucketed = []
+        for (order, (key, hints)) in enumerate(hint_map.iteritems()):
+            entry = (order, re.compile(fnmatch.translate(key)), hints)
+            self.entries.append(entry)
+            self._bucket(key, entry)
+
+    def _bucket(self, key, entry):
+        segments = key.split('/')
+        if len(segments) != 3 or '[' in key:
+            self.unbucketed.append(entry)
+            return
+        for index in (2, 1, 0):
+            if not GLOB_CHARS_RE.search(segments[index]):
+                self.by_segment[index].setdefault(
+                    segments[index], []
+                ).append(entry)
+                return
+        prefix = GLOB_CHARS_RE.split(segments[2], 1)[0]
+        if prefix:
+            self.by_project_prefix.setdefault(prefix, []).append(entry)
+        else:
+            self.unbucketed.append(entry)
+
+    def candidates(self, name):
+        segments = name.split('/')
+        if len(segments) != 3:
+            return self.entries
+        candidates = list(self.unbucketed)
+        for index in (2, 1, 0):
+            candidates.extend(self.by_segment[index].get(segments[index], ()))
+        project = segments[2]
+        for length in xrange(1, len(project) + 1):
+            candidates.extend(
+                self.by_project_prefix.get(project[:length], ())
+            )
+        candidates.sort(key=lambda entry: entry[0])
+        return candidates
+
+    def match(self, name):
+        """Return a list of the hints of all matching spec keys, in the
+        order in which the spec keys were given.
+
+        """
+        return [hints for (order, regex, hints) in self.candidates(name)
+                if regex.match(name)]
 
 
 class Blacklist(object):
     """A list of sources whose files will not be made available
     in the link farms.
     
-    Used by `toolshelf disable/enable`, and persisted.
+    Used by `toolshelf disable/enable`, and persisted.  It is not read
+    until it is first consulted, and only written back if it was changed.
 
     """
     def __init__(self, shelf, filename):
         self.shelf = shelf
         self.filename = filename
-        self._blacklist_map = set()
+        self._blacklist_map = None
+        self.dirty = False
+        self.lock = threading.Lock()
 
     def load(self):
-        if not os.path.exists(self.filename):
-            return
-        with open(self.filename, 'r') as blacklist_file:
-            for line in blacklist_file:
-                line = line.strip()
-                match = re.match(r'^(.*?\/.*?\/.*?)$', line)
-                if match:
-                    self._blacklist_map.add(match.group(1))
-        self.shelf.debug("Loaded blacklist %r" % self._blacklist_map)
+        # built up in a local, so that other threads never see it
+        # partially filled in
+        blacklist_map = set()
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as blacklist_file:
+                for line in blacklist_file:
+                    line = line.strip()
+                    match = re.match(r'^(.*?\/.*?\/.*?)$', line)
+                    if match:
+                        blacklist_map.add(match.group(1))
+        self.shelf.debug("Loaded blacklist %r" % blacklist_map)
+        self._blacklist_map = blacklist_map
 
     def save(self):
+        if not self.dirty:
+            return
         with open(self.filename, 'w') as blacklist_file:
             for key in self._blacklist_map:
                 self.shelf.debug("Saving blacklisted %r" % key)
                 blacklist_file.write('%s\n' % key)
+        self.dirty = False
+
+    @property
+    def entries(self):
+        if self._blacklist_map is None:
+            with self.lock:
+                if self._blacklist_map is None:
+                    self.load()
+        return self._blacklist_map
 
     def add(self, source):
-        self._blacklist_map.add(source.name)
+        self.entries.add(source.name)
+        self.dirty = True
 
     def remove(self, source):
-        self._blacklist_map.remove(source.name)
+        self.entries.remove(source.name)
+        self.dirty = True
 
     def __contains__(self, source):
-        return source.name in self._blacklist_map
+        return source.name in self.entries
 
 
 class Path(object):
@@ -339,7 +1103,8 @@ class Path(object):
         found = []
         for component in self.components:
             full_filename = os.path.join(component, filename)
-            if is_executable(full_filename):
+            if (os.path.isfile(full_filename) and
+                os.access(full_filename, os.X_OK)):
                 found.append(full_filename)
         return found
 
@@ -349,13 +1114,28 @@ class LinkFarm(object):
     to files (typically executables, libraries, modules, etc.)
     in various other parts of the filesystem.
 
+    The link farm directory (e.g. `$TOOLSHELF/.bin`) is itself a symbolic
+    link to the current "generation" of the link farm, which is a directory
+    under `$TOOLSHELF/.farms`.  Changes are made by populating a new
+    generation and then atomically pointing the link farm directory at it,
+    so that the link farm never appears partially populated.  The previous
+    generation is kept, so that it can be rolled back to.
+
+    Nothing is created until the first generation is published; until
+    then the link farm reads as empty.
+
     """
     def __init__(self, shelf, dirname):
         self.shelf = shelf
         self.dirname = dirname
-        makedirs(dirname)
+        self.generations_dir = os.path.join(
+            os.path.dirname(dirname), '.farms',
+            os.path.basename(dirname).lstrip('.')
+        )
 
     def links(self):
+        if not os.path.isdir(self.dirname):
+            return
         for name in os.listdir(self.dirname):
             fullfilename = os.path.join(self.dirname, name)
             if not os.path.islink(fullfilename):
@@ -371,401 +1151,2829 @@ class LinkFarm(object):
         source = os.readlink(linkname)
         return (linkname, source)
 
-    def create_link(self, filename):
-        filename = os.path.abspath(filename)
-        linkname = os.path.join(self.dirname, os.path.basename(filename))
-        # We do trample existing links
-        if os.path.islink(linkname):
-            # TODO only produce this message if the source link and
-            # dest link are in different sources?
-            self.shelf.warn("Trampling existing [%s] link %s" %
-                (os.path.basename(self.dirname), linkname)
-            )
-            self.shelf.warn("  was: %s" % os.readlink(linkname))
-            self.shelf.warn("  now: %s" % filename)
-            os.unlink(linkname)
-        self.shelf.symlink(filename, linkname)
+    ### generations ###
 
-    def clean(self, prefix=''):
-        for (linkname, sourcename) in self.links():
-            if sourcename.startswith(prefix):
-                os.unlink(linkname)
-                if os.path.islink(linkname):
-                    raise IOError("could not unlink %s" % linkname)
+    def generations(self):
+        """Return the numbers of all existing generations, in order."""
+        if not os.path.isdir(self.generations_dir):
+            return []
+        return sorted(int(name) for name in os.listdir(self.generations_dir)
+                      if name.isdigit())
 
+    def current_generation(self):
+        """Return the number of the generation the link farm directory
+        currently points to, or None if it is not a generation (e.g. if
+        it is a plain directory created by an older `toolshelf`.)
 
-class Source(object):
-    def __init__(self, shelf, url=None, host=None, user=None, project=None,
-                 type=None, local=False, tag=None):
-        self.shelf = shelf
-        self.url = url
-        if not host:
-            raise ValueError('no host supplied')
-        self.host = host
-        self.user = user or 'distfile'
-        self.project = project
-        self.type = type
-        self.local = local
-        self.tag = tag
-        self.hints = {}
-        self.shelf.cookies.apply_hints(self)
+        """
+        if not os.path.islink(self.dirname):
+            return None
+        target = os.readlink(self.dirname)
+        if os.path.dirname(target) != os.path.relpath(
+            self.generations_dir, os.path.dirname(self.dirname)
+        ) or not os.path.basename(target).isdigit():
+            return None
+        return int(os.path.basename(target))
 
-    def __repr__(self):
-        return ("Source(url=%r, host=%r, user=%r, "
-                "project=%r, type=%r, local=%r, tag=%r, hints=%r)" %
-                (self.url, self.host, self.user,
-                 self.project, self.type, self.local, self.tag, self.hints))
+    def publish(self, links):
+        """Populate a new generation of this link farm with the given
+        links (a dict mapping link names to the files they link to),
+        make it the current generation, and delete all generations
+        before the previous one.
 
-    @property
-    def distfile(self):
-        if self.local:
-            return self.url
-        if self.type in ('zip', 'tgz', 'tar.gz', 'tar.xz', 'tar.bz2'):
-            return os.path.join(self.shelf.dir, '.distfiles',
-                                '%s.%s' % (self.project, self.type))
-        else:
+        """
+        makedirs(self.generations_dir)
+        generation = max(self.generations() + [0]) + 1
+        while True:
+            gen_dirname = os.path.join(self.generations_dir, str(generation))
+            try:
+                os.mkdir(gen_dirname)
+                break
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+                generation += 1
+        for (name, filename) in links.iteritems():
+            os.symlink(filename, os.path.join(gen_dirname, name))
+        previous = self.current_generation()
+        self._point_to(generation)
+        self.shelf.note("Published generation %d of %s (%d links)" %
+                        (generation, self.dirname, len(links)))
+        for old_generation in self.generations():
+            if old_generation not in (previous, generation):
+                shutil.rmtree(
+                    os.path.join(self.generations_dir, str(old_generation))
+                )
+        legacy_dirname = os.path.join(self.generations_dir, 'legacy')
+        if previous is not None and os.path.isdir(legacy_dirname):
+            shutil.rmtree(legacy_dirname)
+
+    def rollback(self):
+        """Make the generation before the current one current again.
+        Returns the number of that generation, or None if there is none.
+
+        """
+        current = self.current_generation()
+        earlier = [g for g in self.generations()
+                   if current is None or g < current]
+        if not earlier:
             return None
+        self._point_to(earlier[-1])
+        return earlier[-1]
+
+    def _point_to(self, generation):
+        target = os.path.join(
+            os.path.relpath(self.generations_dir,
+                            os.path.dirname(self.dirname)),
+            str(generation)
+        )
+        temp_linkname = '%s.%d.new' % (self.dirname, os.getpid())
+        if os.path.lexists(temp_linkname):
+            os.unlink(temp_linkname)
+        os.symlink(target, temp_linkname)
+        if os.path.isdir(self.dirname) and not os.path.islink(self.dirname):
+            # a link farm from before generations: it can't be atomically
+            # replaced, so move it out of the way as quickly as possible
+            legacy_dirname = os.path.join(self.generations_dir, 'legacy')
+            if os.path.isdir(legacy_dirname):
+                shutil.rmtree(legacy_dirname)
+            os.rename(self.dirname, legacy_dirname)
+        os.rename(temp_linkname, self.dirname)
+
+
+class LinkManifest(object):
+    """A record of the files each source provides to each link farm, as
+    of the last time it was searched, along with a fingerprint of the source
+    at that time: the settings which affect what gets linked, the mtimes
+    of the directories which were searched for linkable files, and the
+    permission bits of the files which were candidates for linking.
+    (Changing a file's mode does not touch its directory's mtime, and
+    whether a file is executable decides whether it goes in `bin`.)
+
+    Persisted in `$TOOLSHELF/.cache`.
 
-    @property
-    def name(self):
-        return os.path.join(self.host, self.user, self.project)
+    """
+    def __init__(self, shelf, filename):
+        self.shelf = shelf
+        self.filename = filename
+        self._records = None
+        self.dirty = False
 
     @property
-    def user_dir(self):
-        return os.path.join(self.shelf.dir, self.host, self.user)
+    def records(self):
+        if self._records is None:
+            self._records = load_cache(self.filename) or {}
+        return self._records
+
+    def get(self, source):
+        return self.records.get(source.name)
+
+    def record(self, source, settings, searched_dirs, candidate_modes,
+               links):
+        self.records[source.name] = {
+            'settings': settings,
+            'dirs': searched_dirs,
+            'modes': candidate_modes,
+            'links': links,
+        }
+        self.dirty = True
+
+    def forget(self, source):
+        if self.records.pop(source.name, None) is not None:
+            self.dirty = True
+
+    def is_current(self, source, settings):
+        """Return True if the given source has been searched for linkable
+        files before, and nothing which would affect what gets linked from
+        it has changed since, and all of the files it linked still exist.
 
-    @property
-    def dir(self):
-        return os.path.join(self.user_dir, self.project)
+        """
+        record = self.get(source)
+        if (record is None or 'modes' not in record or
+            record['settings'] != settings):
+            return False
+        try:
+            for (dirname, mtime) in record['dirs'].iteritems():
+                if os.stat(dirname).st_mtime != mtime:
+                    return False
+            for (filename, mode) in record['modes'].iteritems():
+                if stat.S_IMODE(os.stat(filename).st_mode) != mode:
+                    return False
+        except OSError:
+            return False
+        for filenames in record['links'].itervalues():
+            for filename in filenames:
+                if not os.path.exists(filename):
+                    return False
+        return True
 
-    @property
-    def docked(self):
-        return os.path.isdir(self.dir)
+    def save(self):
+        if self.dirty:
+            save_cache(self.filename, self.records)
+            self.dirty = False
 
-    def checkout(self):
-        self.shelf.note("Checking out %s..." % self.name)
 
-        makedirs(self.user_dir)
-        self.shelf.chdir(self.user_dir)
+class DockedIndex(object):
+    """An index of the sources docked on the shelf, so that docked source
+    specs can be resolved without listing the shelf's directories for
+    each one.
 
-        if self.type == 'git':
-            self.shelf.run('git', 'clone', self.url)
-        elif self.type == 'hg':
-            self.shelf.run('hg', 'clone', self.url)
-        elif self.type == 'hg-or-git':
-            try:
-                # better would be to check hg's error output for
-                # 'Http Error 406'
-                self.shelf.run('hg', 'clone', self.url)
-            except subprocess.CalledProcessError:
-                self.shelf.note("`hg clone` failed, so trying git")
-                self.shelf.run('git', 'clone', self.url)
-        elif self.distfile is not None:
-            self.shelf.run('mkdir', '-p',
-                           os.path.join(self.shelf.dir, '.distfiles'))
-            if not os.path.exists(self.distfile):
-                if self.local:
-                    raise IOError("local distfile '%s' doesn't exist?!" % self.distfile)
-                else:
-                    self.shelf.run('wget', '-nc', '-O', self.distfile, self.url)
-            extract_dir = os.path.join(
-                self.shelf.dir, '.extract_' + self.project
+    The index is kept in `$TOOLSHELF/.cache` along with the modification
+    times of the shelf's directory and of every host and user directory
+    in it.  Docking or removing a source changes the modification time of
+    the directory it is in, so the index is only rebuilt when one of
+    those has changed.
+
+    """
+    # modification times this recent might be shared by a later change
+    RACY_SECONDS = 2
+
+    def __init__(self, shelf, filename):
+        self.shelf = shelf
+        self.filename = filename
+        self.mtimes = None
+        self.racy = False
+        self.sources = None
+
+    def refresh(self):
+        """Make sure the index describes what is docked now."""
+        if self.mtimes is None:
+            cached = load_cache(self.filename)
+            if cached is not None:
+                (self.mtimes, sources) = cached
+                self.index(sources)
+        if self.mtimes is None or self.racy or not self.is_current():
+            self.rebuild()
+
+    def is_current(self):
+        for (dirname, mtime) in self.mtimes.iteritems():
+            try:
+                if os.stat(dirname).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def rebuild(self):
+        self.shelf.debug("Rebuilding index of docked sources")
+        mtimes = {}
+        sources = []
+
+        def subdirs(dirname):
+            # note the time before listing, so that a change made while
+            # listing it is noticed next time
+            try:
+                mtimes[dirname] = os.stat(dirname).st_mtime
+                return [entry for entry in dir_entries(dirname)
+                        if entry.is_dir()]
+            except OSError:
+                return []
+
+        for host in subdirs(self.shelf.dir):
+            if host.name.startswith('.'):
+                continue
+            for user in subdirs(host.path):
+                for project in subdirs(user.path):
+                    sources.append((host.name, user.name, project.name))
+        sources.sort()
+
+        self.mtimes = mtimes
+        self.index(sources)
+        self.racy = any(
+            mtime >= time.time() - self.RACY_SECONDS
+            for mtime in mtimes.itervalues()
+        )
+        if not self.racy:
+            save_cache(self.filename, (mtimes, sources))
+
+    def index(self, sources):
+        self.sources = sources
+        self.by_project = {}
+        self.by_user = {}
+        self.by_host_user = {}
+        for source in sources:
+            (host, user, project) = source
+            self.by_project.setdefault(project, []).append(source)
+            self.by_user.setdefault(user, []).append(source)
+            self.by_host_user.setdefault((host, user), []).append(source)
+        self.projects = sorted(self.by_project)
+
+    def all(self):
+        return self.sources
+
+    def find(self, host=None, user=None, project=None):
+        """Return the docked sources with the given host, user, and/or
+        project, as (host, user, project) tuples in sorted order.
+
+        """
+        if host is not None and user is not None:
+            sources = self.by_host_user.get((host, user), [])
+        elif user is not None:
+            sources = self.by_user.get(user, [])
+        elif project is not None:
+            return self.by_project.get(project, [])
+        else:
+            sources = self.sources
+        if project is not None:
+            sources = [source for source in sources if source[2] == project]
+        return sources
+
+    def find_prefix(self, prefix):
+        """Return the first docked source (in the order of host, user,
+        project) whose project name starts with the given prefix, or None.
+
+        """
+        found = []
+        i = bisect.bisect_left(self.projects, prefix)
+        while i < len(self.projects) and self.projects[i].startswith(prefix):
+            found.extend(self.by_project[self.projects[i]])
+            i += 1
+        return min(found) if found else None
+
+
+class BuildFingerprints(object):
+    """A record of the state each source was in the last time it was
+    successfully built: its head ref, any local changes to it (or, if it
+    is not version-controlled, its distfile and the files in its tree),
+    the build command in effect, and its hints.  A source whose
+    fingerprint still matches needn't be built again.
+
+    Persisted in `$TOOLSHELF/.cache`.
+
+    """
+    def __init__(self, shelf, filename):
+        self.shelf = shelf
+        self.filename = filename
+        self._records = None
+        self.dirty = False
+        self.skipped = []
+
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = load_cache(self.filename) or {}
+        return self._records
+
+    def get(self, source):
+        return self.records.get(source.name)
+
+    def record(self, source, fingerprint):
+        self.records[source.name] = fingerprint
+        self.dirty = True
+
+    def forget(self, source):
+        if self.records.pop(source.name, None) is not None:
+            self.dirty = True
+
+    def matches(self, source, fingerprint):
+        return self.get(source) == fingerprint
+
+    def skip(self, source, fingerprint):
+        """Note that the given source was not built because its
+        fingerprint matched, and why.
+
+        """
+        fingerprint = dict(fingerprint)
+        reasons = []
+        if fingerprint['head'] is not None:
+            reasons.append("still at %s" % fingerprint['head'][:12])
+        if fingerprint['tree'] is not None:
+            if fingerprint['distfile'] is not None:
+                reasons.append("same distfile")
+            reasons.append("no files changed since")
+        elif fingerprint['changes'] is None:
+            reasons.append("no local changes")
+        else:
+            reasons.append("same local changes")
+        reasons.append("same build command and hints")
+        self.skipped.append((source, ', '.join(reasons)))
+
+    def save(self):
+        if self.dirty:
+            save_cache(self.filename, self.records)
+            self.dirty = False
+
+
+class ArtifactStore(object):
+    """A directory of build outputs, keyed by everything which determines
+    what a build produces (see `Source.artifact_key`), so that a source
+    which has been built once, by any toolshelf sharing the directory,
+    can be restored from it instead of being built again.
+
+    Each artifact is a tar file of the `install` directory of a source,
+    along with any other files which were created or modified by the
+    build.  Artifacts are added atomically, and the least recently used
+    ones are removed when the store grows larger than its size limit.
+    As the store may be shared, an artifact is not restored if any of its
+    members would be written, or link to anything, outside the source.
+
+    """
+    def __init__(self, shelf, dirname, max_size):
+        self.shelf = shelf
+        self.dirname = dirname
+        self.max_size = max_size
+
+    def filename(self, key):
+        return os.path.join(self.dirname, key[:2], key + '.tar')
+
+    def restore(self, source, key):
+        """Extract the artifact with the given key into the given
+        source's directory.  Returns False if there is no such artifact.
+
+        """
+        import tarfile
+
+        filename = self.filename(key)
+        try:
+            with tarfile.open(filename, 'r') as tar:
+                members = tar.getmembers()
+                for member in members:
+                    self.check_member(source.dir, member)
+                for member in members:
+                    # checked again, against what has been extracted so
+                    # far, in case an earlier member was a symlink
+                    self.check_member(source.dir, member)
+                    tar.extract(member, source.dir)
+            os.utime(filename, None)
+        except (IOError, OSError, tarfile.TarError, UnsafeArchiveError) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                self.shelf.warn("Could not restore %s from %s: %s" %
+                                (source.name, filename, e))
+            return False
+        return True
+
+    def check_member(self, dest_dir, member):
+        """Raise an error if extracting the given member of an artifact
+        into `dest_dir` would write, or create a link to, anything outside
+        of `dest_dir`.
+
+        """
+        if not (member.isfile() or member.isdir() or
+                member.issym() or member.islnk()):
+            raise UnsafeArchiveError(
+                "Member %s is not a file, directory or link" % member.name
             )
-            self.shelf.run('mkdir', '-p', extract_dir)
-            self.shelf.chdir(extract_dir)
-            if self.type == 'zip':
-                self.shelf.run('unzip', self.distfile)
-            elif self.type in ('tgz', 'tar.gz'):
-                self.shelf.run('tar', '-z', '-x', '-v', '-f', self.distfile)
-            elif self.type == 'tar.xz':
-                self.shelf.run('tar', '-J', '-x', '-v', '-f', self.distfile)
-            elif self.type == 'tar.bz2':
-                self.shelf.run('tar', '-j', '-x', '-v', '-f', self.distfile)
-
-            files = os.listdir(extract_dir)
-            if len(files) == 1:
-                self.shelf.note("Archive is well-structured "
-                                "(all files in one directory)")
-                extracted_dir = os.path.join(extract_dir, files[0])
-                if not os.path.isdir(extracted_dir):
-                    extracted_dir = extract_dir
+        check_archive_member(
+            dest_dir, member.name,
+            symlink=member.linkname if member.issym() else None,
+            hardlink=member.linkname if member.islnk() else None
+        )
+
+    def snapshot(self, source):
+        """Return a dict mapping the name of each file in the given source,
+        relative to its directory, to its modification time and size.
+
+        """
+        files = {}
+        for (root, dirs, entries) in scan_tree(source.dir):
+            if root == source.dir:
+                for name in ('.git', '.hg'):
+                    if name in dirs:
+                        dirs.remove(name)
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                files[os.path.relpath(entry.path, source.dir)] = (
+                    st.st_mtime, st.st_size
+                )
+        return files
+
+    def publish(self, source, key, before):
+        """Add the outputs of a build of the given source to the store,
+        under the given key.  `before` is the `snapshot` of the source
+        taken before it was built.
+
+        """
+        import tarfile
+
+        filename = self.filename(key)
+        if os.path.exists(filename):
+            return
+        makedirs(os.path.dirname(filename))
+        temp_filename = '%s.%s.%d.%d.tmp' % (
+            filename, os.uname()[1], os.getpid(),
+            threading.current_thread().ident
+        )
+        try:
+            with tarfile.open(temp_filename, 'w') as tar:
+                for relname in self.find_outputs(source, before):
+                    tar.add(os.path.join(source.dir, relname), relname,
+                            recursive=False)
+            os.rename(temp_filename, filename)
+        except (IOError, OSError, tarfile.TarError) as e:
+            self.shelf.warn("Could not add %s to %s: %s" %
+                            (source.name, self.dirname, e))
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+            return
+        self.shelf.note("Added %s to artifact store as %s" %
+                        (source.name, key))
+        self.evict()
+
+    def find_outputs(self, source, before):
+        """Return the names, relative to the source's directory, of the
+        files in the source which are the outputs of a build which began
+        when the source was as described by the snapshot `before`:
+        everything under `install`, and everything else which is new or
+        has changed since then.
+
+        """
+        install_prefix = 'install' + os.sep
+        return sorted(
+            relname for (relname, signature)
+            in self.snapshot(source).iteritems()
+            if relname.startswith(install_prefix) or
+               before.get(relname) != signature
+        )
+
+    def evict(self):
+        """Remove the least recently used artifacts until the store is
+        no larger than its size limit.
+
+        """
+        artifacts = []
+        total = 0
+        for (root, dirs, files) in scan_tree(self.dirname):
+            for entry in files:
+                if not entry.name.endswith('.tar'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                artifacts.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        for (mtime, size, filename) in sorted(artifacts):
+            if total <= self.max_size:
+                break
+            self.shelf.note("Evicting %s from artifact store" % filename)
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+            total -= size
+
+
+class Deduplicator(object):
+    """Finds files which are identical across (and within) docked sources,
+    and replaces all but one copy of each with hard links to that copy.
+
+    Only regular files with no write permission are considered, since a
+    hard-linked file which was changed in place would change in every
+    source.  Files are grouped by device, size, permissions and ownership
+    (a link has only one owner), and only files in a group with others
+    (which aren't already links to the same file) are hashed.  The
+    hashes are kept in an index in `$TOOLSHELF/.cache`, so files which
+    haven't changed since the last run are not read again.
+
+    """
+    def __init__(self, shelf, filename):
+        self.shelf = shelf
+        self.filename = filename
+        self.index = load_cache(filename) or {}
+        self.dirs = []
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def add(self, source):
+        """Find the files in the given source which could be linked."""
+        candidates = []
+        for (root, dirs, entries) in scan_tree(source.dir):
+            for name in ('.git', '.hg'):
+                if name in dirs:
+                    dirs.remove(name)
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if (stat.S_ISREG(st.st_mode) and st.st_size > 0 and
+                    not st.st_mode & 0222):
+                    candidates.append((entry.path, st))
+        with self.lock:
+            self.dirs.append(source.dir + os.sep)
+            for (path, st) in candidates:
+                key = (st.st_dev, st.st_size, stat.S_IMODE(st.st_mode),
+                       st.st_uid, st.st_gid)
+                self.groups.setdefault(key, []).append((path, st))
+
+    def digest(self, path, st):
+        """Return the SHA-256 of the given file, from the index if the
+        file hasn't changed since it was last hashed.
+
+        """
+        signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        record = self.index.get(path)
+        if record is not None and record[0] == signature:
+            return record[1]
+        hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                hash.update(chunk)
+        return hash.hexdigest()
+
+    def run(self):
+        """Link identical files together.  Returns the number of files
+        which were replaced by links and the number of bytes reclaimed.
+
+        """
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+
+        # within each group, the paths of each distinct file (inode)
+        inode_groups = []
+        for (key, files) in self.groups.iteritems():
+            if len(files) < 2:
+                continue
+            by_inode = collections.OrderedDict()
+            for (path, st) in files:
+                by_inode.setdefault(st.st_ino, []).append((path, st))
+            if len(by_inode) > 1:
+                inode_groups.append(by_inode.values())
+
+        def hash_file(file):
+            (path, st) = file
+            try:
+                return self.digest(path, st)
+            except (IOError, OSError) as e:
+                self.shelf.warn("Could not read %s: %s" % (path, e))
+                return None
+
+        representatives = [paths[0] for inodes in inode_groups
+                                    for paths in inodes]
+        pool = ThreadPool(max(self.shelf.options.jobs, cpu_count()))
+        try:
+            digests = iter(pool.map(hash_file, representatives))
+        finally:
+            pool.close()
+
+        linked = 0
+        reclaimed = 0
+        for inodes in inode_groups:
+            copies = collections.OrderedDict()
+            for paths in inodes:
+                digest = next(digests)
+                if digest is None:
+                    continue
+                for (path, st) in paths:
+                    self.record(path, st, digest)
+                copies.setdefault(digest, []).append(paths)
+            for (digest, same) in copies.iteritems():
+                if len(same) < 2:
+                    continue
+                # keep the copy which already has the most links to it
+                same.sort(key=lambda paths: -paths[0][1].st_nlink)
+                (target, target_st) = same[0][0]
+                for paths in same[1:]:
+                    count = 0
+                    for (path, st) in paths:
+                        if self.link(target, target_st, path, st):
+                            self.record(path, target_st, digest)
+                            count += 1
+                    linked += count
+                    # the space is only reclaimed if no links to it remain
+                    if count == paths[0][1].st_nlink:
+                        reclaimed += paths[0][1].st_size
+        return (linked, reclaimed)
+
+    def link(self, target, target_st, path, st):
+        """Replace the file at `path` with a hard link to `target`, unless
+        either has changed since it was found (with the stat results
+        `st` and `target_st`) and hashed.
+
+        """
+        def unchanged(filename, st):
+            current = os.lstat(filename)
+            return ((current.st_ino, current.st_size, current.st_mtime,
+                     current.st_mode, current.st_uid, current.st_gid) ==
+                    (st.st_ino, st.st_size, st.st_mtime,
+                     st.st_mode, st.st_uid, st.st_gid))
+
+        temp_path = path + '.dedup'
+        try:
+            if not (unchanged(target, target_st) and unchanged(path, st)):
+                self.shelf.debug("Not linking %s to %s: changed since "
+                                 "hashed" % (path, target))
+                return False
+            os.link(target, temp_path)
+            os.rename(temp_path, path)
+        except OSError as e:
+            self.shelf.warn("Could not link %s to %s: %s" % (path, target, e))
+            if os.path.lexists(temp_path):
+                os.unlink(temp_path)
+            return False
+        self.shelf.debug("Linked %s to %s" % (path, target))
+        return True
+
+    def record(self, path, st, digest):
+        self.index[path] = (
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime), digest
+        )
+
+    def save(self):
+        """Save the index, dropping the files which were not seen in the
+        sources which were looked at.
+
+        """
+        seen = set(path for files in self.groups.itervalues()
+                        for (path, st) in files)
+        dirs = tuple(self.dirs)
+        for path in self.index.keys():
+            if path.startswith(dirs) and path not in seen:
+                del self.index[path]
+        save_cache(self.filename, self.index)
+
+
+class Downloader(object):
+    """Downloads distfiles, keeping the HTTP(S) connections it opens so
+    that later downloads from the same host can reuse them.  (How many
+    downloads from one host may happen at once is limited by
+    `Toolshelf.host_slot`, so no more connections than that are kept to
+    any host.)
+
+    Downloaded distfiles are stored in `.distfiles/sha256`, named by the
+    SHA-256 of their contents, and `.distfiles/<project>.<type>` is a
+    hard link to the stored file, so that the same archive downloaded
+    under different names is only stored once.
+
+    """
+    MAX_REDIRECTS = 5
+    TIMEOUT = 60
+
+    def __init__(self, shelf):
+        self.shelf = shelf
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def connect(self, scheme, netloc):
+        """Return a connection to the given host, and whether it is one
+        which has been used before.
+
+        """
+        import httplib
+
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return (idle.pop(), True)
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc, timeout=self.TIMEOUT)
+        else:
+            connection = httplib.HTTPConnection(netloc, timeout=self.TIMEOUT)
+        return (connection, False)
+
+    def release(self, connection, response):
+        """Return the connection to the pool, if the response it was
+        used for has been read completely and the server will keep it
+        open; otherwise close it.
+
+        """
+        if response.will_close or not response.isclosed():
+            connection.close()
+            return
+        with self.lock:
+            self.idle.setdefault(connection.pool_key, []).append(
+                connection
+            )
+
+    def request(self, url, offset=0, validator=None):
+        """Request the given URL, asking for it from the given offset
+        onward, but only if it still matches `validator` (an ETag or
+        Last-Modified date, sent as If-Range.)  Returns the response
+        (which may have status 200 even if an offset was asked for) and
+        the connection it was read over, which should be passed to
+        `release` once the response has been read.  URLs which aren't
+        HTTP(S), such as ftp://, are fetched with urllib2, the connection
+        is None, and the offset is ignored.
+
+        """
+        import httplib
+        import socket
+        import urllib2
+        import urlparse
+
+        for redirect in xrange(self.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                return (urllib2.urlopen(url, timeout=self.TIMEOUT), None)
+            path = urlparse.urlunsplit(
+                ('', '', parts.path or '/', parts.query, '')
+            )
+            headers = {'User-Agent': 'toolshelf'}
+            if offset:
+                headers['Range'] = 'bytes=%d-' % offset
+                if validator:
+                    headers['If-Range'] = validator
+            while True:
+                (connection, reused) = self.connect(parts.scheme, parts.netloc)
+                connection.pool_key = (parts.scheme, parts.netloc)
+                try:
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                    break
+                except (socket.error, httplib.HTTPException):
+                    connection.close()
+                    # the server may have closed it while it was idle
+                    if not reused:
+                        raise
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                response.read()
+                self.release(connection, response)
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status not in (200, 206, 416):
+                response.read()
+                self.release(connection, response)
+                raise IOError("HTTP Error %d: %s" %
+                              (response.status, response.reason))
+            return (response, connection)
+        raise IOError("Too many redirects fetching %s" % url)
+
+    def open(self, url, filename, sha256=None):
+        return Download(self, url, filename, sha256=sha256)
+
+    def content_filename(self, digest):
+        return os.path.join(self.shelf.dir, '.distfiles', 'sha256', digest)
+
+    def store(self, temp_filename, digest, filename):
+        """Move the downloaded file `temp_filename`, whose SHA-256 is
+        `digest`, into the store, and link `filename` to it.
+
+        """
+        content_filename = self.content_filename(digest)
+        makedirs(os.path.dirname(content_filename))
+        if os.path.exists(content_filename):
+            self.shelf.note("Already have %s as %s" % (filename, digest))
+            os.unlink(temp_filename)
+        else:
+            os.rename(temp_filename, content_filename)
+        self.link(content_filename, filename)
+
+    def link(self, content_filename, filename):
+        link_filename = filename + '.link'
+        if os.path.lexists(link_filename):
+            os.unlink(link_filename)
+        try:
+            os.link(content_filename, link_filename)
+        except OSError:
+            os.symlink(os.path.relpath(content_filename,
+                                       os.path.dirname(filename)),
+                       link_filename)
+        os.rename(link_filename, filename)
+
+    def fetch_stored(self, digest, filename):
+        """If a distfile with the given SHA-256 has already been
+        downloaded, link `filename` to it and return True.
+
+        """
+        content_filename = self.content_filename(digest.lower())
+        if not os.path.exists(content_filename):
+            return False
+        self.shelf.note("Using stored distfile %s for %s" %
+                        (digest, filename))
+        self.link(content_filename, filename)
+        return True
+
+    def verify(self, filename, digest):
+        """Return whether the contents of the given file have the given
+        SHA-256.
+
+        """
+        content_filename = self.content_filename(digest.lower())
+        try:
+            if os.path.samefile(filename, content_filename):
+                return True
+        except OSError:
+            pass
+        hash = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                hash.update(chunk)
+        return hash.hexdigest() == digest.lower()
+
+
+class Download(object):
+    """A file-like object which reads a distfile from the network, writing
+    everything it reads to a `.part` file as it goes, so that the distfile
+    can be extracted while it is still being downloaded.
+
+    The validator (strong ETag, or else Last-Modified date) the server
+    gave for the distfile is kept in a `.part.validator` file.  If a
+    `.part` file is left over from an earlier, interrupted download, the
+    rest is requested with a Range header, qualified by an If-Range
+    header with that validator; if the connection drops partway through,
+    the download is likewise resumed from where it stopped.  If the
+    server ignores the Range header, the bytes already had are skipped,
+    but if the distfile has changed (or there is no validator to tell)
+    the `.part` file is discarded and the download started over, or, if
+    some of it has already been read, the download fails.  `finish`
+    checks the SHA-256 of what was downloaded, if one was given, and
+    then puts it into the distfile cache; a truncated distfile is never
+    cached.
+
+    """
+    RETRIES = 3
+
+    def __init__(self, downloader, url, filename, sha256=None):
+        self.downloader = downloader
+        self.shelf = downloader.shelf
+        self.url = url
+        self.filename = filename
+        self.sha256 = sha256
+        self.part_filename = filename + '.part'
+        self.validator_filename = self.part_filename + '.validator'
+        self.validator = None
+        self.hash = hashlib.sha256()
+        self.offset = 0
+        self.resumed = None
+        self.response = None
+        self.connection = None
+        self.interrupted = False
+        if os.path.exists(self.part_filename):
+            if os.path.exists(self.validator_filename):
+                with open(self.validator_filename) as f:
+                    self.validator = f.read().strip() or None
+            with open(self.part_filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), ''):
+                    self.hash.update(chunk)
+                    self.offset += len(chunk)
+            self.shelf.note("Resuming download of %s at %d bytes..." %
+                            (url, self.offset))
+            self.resumed = open(self.part_filename, 'rb')
+        else:
+            self.shelf.note("Downloading %s..." % url)
+        self.part = open(self.part_filename, 'ab')
+
+    def response_validator(self):
+        """Return the strong ETag or Last-Modified date of the response,
+        or None if it has neither.
+
+        """
+        getheader = getattr(self.response, 'getheader', None)
+        if getheader is None:
+            return None
+        etag = getheader('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return getheader('Last-Modified')
+
+    def restart(self):
+        """Discard what has been downloaded so far, because the distfile
+        on the server is not the one it was part of.
+
+        """
+        if self.resumed is None or self.resumed.tell() != 0:
+            raise IOError("%s may have changed on the server while it was "
+                          "being downloaded" % self.url)
+        self.shelf.note("%s may have changed since its download was "
+                        "interrupted; starting over" % self.url)
+        self.resumed.close()
+        self.resumed = None
+        self.part.close()
+        self.part = open(self.part_filename, 'wb')
+        self.hash = hashlib.sha256()
+        self.offset = 0
+        self.validator = None
+
+    def open(self):
+        import httplib
+
+        # without a validator, there is no telling whether the bytes
+        # already had are part of what the server has now
+        offset = self.offset if self.validator else 0
+        (self.response, self.connection) = self.downloader.request(
+            self.url, offset, self.validator
+        )
+        status = getattr(self.response, 'status', 200)
+        if status == 416:
+            content_range = self.response.getheader('Content-Range', '')
+            self.response.read()
+            self.downloader.release(self.connection, self.response)
+            if content_range.endswith('/%d' % self.offset):
+                # the .part file was already complete
+                (self.response, self.connection) = (StringIO(''), None)
+                return
+            # the .part file is longer than the distfile, so it isn't
+            # part of it, whatever the validator says
+            self.validator = None
+            (self.response, self.connection) = self.downloader.request(
+                self.url
+            )
+            status = 200
+        if status == 200:
+            validator = self.response_validator()
+            if self.offset and (validator is None or
+                                validator != self.validator):
+                self.restart()
+            skip = self.offset
+            while skip > 0:
+                chunk = self.response.read(min(skip, 65536))
+                if not chunk:
+                    raise httplib.IncompleteRead('')
+                skip -= len(chunk)
+            if self.validator is None and validator is not None:
+                self.validator = validator
+                with open(self.validator_filename, 'w') as f:
+                    f.write(validator + '\n')
+
+    def read(self, size=-1):
+        import httplib
+        import socket
+
+        failures = 0
+        while True:
+            try:
+                if self.response is None:
+                    # before any of a leftover .part file is read, so that
+                    # it can still be discarded if the distfile has changed
+                    self.open()
+                if self.resumed is not None:
+                    data = self.resumed.read(size)
+                    if data:
+                        return data
+                    self.resumed.close()
+                    self.resumed = None
+                if size < 0:
+                    data = self.response.read()
+                else:
+                    data = self.response.read(size)
+                if not data and getattr(self.response, 'length', None):
+                    raise httplib.IncompleteRead(data)
+                break
+            except (socket.error, httplib.HTTPException) as e:
+                self.close_response()
+                failures += 1
+                if failures > self.RETRIES:
+                    self.interrupted = True
+                    raise
+                self.shelf.warn("Download of %s interrupted (%r); "
+                                "resuming at %d bytes" %
+                                (self.url, e, self.offset))
+        self.hash.update(data)
+        self.part.write(data)
+        self.offset += len(data)
+        return data
+
+    def finish(self):
+        """Read whatever the extractor didn't need (such as the padding
+        at the end of a tar file), check the result, and put it into the
+        distfile cache.
+
+        """
+        while self.read(65536):
+            pass
+        self.close()
+        digest = self.hash.hexdigest()
+        if self.sha256 and digest != self.sha256.lower():
+            self.discard()
+            raise ChecksumError("%s has SHA-256 %s, but its sha256 hint "
+                                "is %s" % (self.url, digest, self.sha256))
+        self.downloader.store(self.part_filename, digest, self.filename)
+        self.discard()
+
+    def abort(self):
+        """Give up on the download.  The `.part` file is kept, so that
+        the download can be resumed, only if the network was the problem.
+
+        """
+        self.close()
+        if not self.interrupted:
+            self.discard()
+
+    def discard(self):
+        for filename in (self.part_filename, self.validator_filename):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def close_response(self):
+        if self.response is None:
+            return
+        if self.connection is not None:
+            self.downloader.release(self.connection, self.response)
+        else:
+            self.response.close()
+        (self.response, self.connection) = (None, None)
+
+    def close(self):
+        if self.resumed is not None:
+            self.resumed.close()
+            self.resumed = None
+        self.close_response()
+        self.part.close()
+
+
+class LZMAStream(object):
+    """A file-like object which decompresses the xz data read from another
+    file-like object.
+
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = lzma.LZMADecompressor()
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.fileobj.read(65536)
+            if not chunk:
+                break
+            self.buffer += self.decompressor.decompress(chunk)
+        if size < 0:
+            (data, self.buffer) = (self.buffer, '')
+        else:
+            (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+    def close(self):
+        pass
+
+
+class XzPipe(object):
+    """A file-like object which decompresses the xz data read from another
+    file-like object by piping it through `xz`, for when there is no
+    `lzma` module.
+
+    """
+    def __init__(self, fileobj):
+        # Other threads may be running their own XzPipes; if this `xz`
+        # inherited the write ends of their pipes, theirs would never see
+        # end-of-file while this one is still running.
+        self.process = subprocess.Popen(
+            ['xz', '-d', '-c'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            close_fds=True
+        )
+        self.feeder = threading.Thread(target=self.feed, args=(fileobj,))
+        self.feeder.daemon = True
+        self.feeder.start()
+
+    def feed(self, fileobj):
+        try:
+            while True:
+                chunk = fileobj.read(65536)
+                if not chunk:
+                    break
+                self.process.stdin.write(chunk)
+        except (IOError, OSError):
+            pass
+        finally:
+            self.process.stdin.close()
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        self.process.stdout.close()
+        self.feeder.join()
+        if self.process.wait() != 0:
+            raise IOError("xz exited with status %d" % self.process.returncode)
+
+
+class DistfileExtractor(object):
+    """Extracts a distfile straight into a source's directory, reading the
+    archive as a stream.
+
+    An archive is 'well-structured' if all of its files are in a single
+    top-level directory, which is left out when extracting it; otherwise
+    it is a 'tarbomb', and is extracted as it is.  A tar file can only be
+    read in order, so which it is is decided from its first member, and if
+    a later member shows that to be wrong, the files extracted so far are
+    moved (by renaming the directory they were extracted into) to where
+    they belong.  A zip file has its table of contents at the end, so it
+    must be read from a file, but the decision can then be made exactly.
+
+    """
+    TAR_MODES = {
+        'tgz': 'r|gz',
+        'tar.gz': 'r|gz',
+        'tar.bz2': 'r|bz2',
+        'tar.xz': 'r|',
+    }
+
+    def __init__(self, shelf, dest_dir):
+        self.shelf = shelf
+        self.dest_dir = dest_dir
+        self.prefix = None
+        self.directories = []
+        self.count = 0
+
+    def extract(self, fileobj, type):
+        makedirs(self.dest_dir)
+        if type == 'zip':
+            self.extract_zip(fileobj)
+        elif type == 'tar.xz':
+            if lzma is not None:
+                stream = LZMAStream(fileobj)
             else:
-                self.shelf.note("Archive is a 'tarbomb' "
-                                "(all files in the root of the archive)")
-                extracted_dir = extract_dir
-            self.shelf.run('mv', extracted_dir, self.dir)
-            self.shelf.run('rm', '-rf', extract_dir)
+                stream = XzPipe(fileobj)
+            try:
+                self.extract_tar(stream, self.TAR_MODES[type])
+            finally:
+                stream.close()
+        elif type in self.TAR_MODES:
+            self.extract_tar(fileobj, self.TAR_MODES[type])
+        else:
+            raise NotImplementedError(type)
+        if self.prefix:
+            self.shelf.note("Archive is well-structured "
+                            "(all files in one directory)")
+        else:
+            self.shelf.note("Archive is a 'tarbomb' "
+                            "(all files in the root of the archive)")
+        self.shelf.note("Extracted %d files into %s" %
+                        (self.count, self.dest_dir))
+
+    def split(self, name):
+        parts = [part for part in name.split('/') if part not in ('', '.')]
+        if name.startswith('/') or '..' in parts:
+            self.shelf.warn("Skipping unsafe archive member '%s'" % name)
+            return None
+        return parts
+
+    def target(self, name, is_dir):
+        """Return the path, relative to the destination directory, at
+        which the archive member with the given name should be extracted,
+        or None if it should not be extracted.
+
+        """
+        parts = self.split(name)
+        if not parts:
+            return None
+        if self.prefix is None:
+            if len(parts) > 1 or is_dir:
+                self.prefix = parts[0]
+            else:
+                self.prefix = ''
+        if self.prefix:
+            if parts[0] == self.prefix:
+                parts = parts[1:]
+            else:
+                self.relocate()
+        return os.path.join('', *parts)
+
+    def is_safe(self, relname, symlink=None, hardlink=None):
+        """Return whether the archive member to be extracted at `relname`
+        stays inside the destination directory (see
+        `check_archive_member`); warn about it if not.
+
+        """
+        try:
+            check_archive_member(self.dest_dir, relname, symlink=symlink,
+                                 hardlink=hardlink, absolute_links=False)
+        except UnsafeArchiveError as e:
+            self.shelf.warn("Skipping unsafe archive member: %s" % e)
+            return False
+        return True
+
+    def strip(self, name):
+        """Return the path, relative to the destination directory, of an
+        archive member which has already been extracted.
+
+        """
+        parts = self.split(name) or []
+        if self.prefix and parts[:1] == [self.prefix]:
+            parts = parts[1:]
+        return os.path.join('', *parts)
+
+    def relocate(self):
+        """The archive turned out to be a tarbomb after all; move what
+        has been extracted so far into the directory it came from.
+
+        """
+        self.shelf.note("Archive has files outside '%s'; "
+                        "it's a tarbomb after all" % self.prefix)
+        temp_dir = self.dest_dir + '.extracting'
+        os.rename(self.dest_dir, temp_dir)
+        os.mkdir(self.dest_dir)
+        os.rename(temp_dir, os.path.join(self.dest_dir, self.prefix))
+        self.directories = [
+            (os.path.join(self.prefix, relname), member)
+            for (relname, member) in self.directories
+        ]
+        self.prefix = ''
+
+    def extract_tar(self, fileobj, mode):
+        import tarfile
+
+        with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+            for member in tar:
+                relname = self.target(member.name, member.isdir())
+                if relname is None:
+                    continue
+                if not (member.isfile() or member.isdir() or
+                        member.issym() or member.islnk()):
+                    self.shelf.warn("Skipping archive member %s: not a "
+                                    "file, directory or link" % member.name)
+                    continue
+                hardlink = None
+                if member.islnk():
+                    if not self.split(member.linkname):
+                        continue
+                    hardlink = self.strip(member.linkname)
+                if not self.is_safe(
+                    relname, hardlink=hardlink,
+                    symlink=member.linkname if member.issym() else None
+                ):
+                    continue
+                if member.isdir():
+                    makedirs(os.path.join(self.dest_dir, relname))
+                    self.directories.append((relname, member))
+                    continue
+                if hardlink is not None:
+                    member.linkname = os.path.join(self.dest_dir, hardlink)
+                member.name = relname
+                tar.extract(member, self.dest_dir)
+                self.count += 1
+            # like extractall, set the directories' permissions last, so
+            # that read-only directories could still be extracted into
+            for (relname, member) in reversed(self.directories):
+                dirname = os.path.join(self.dest_dir, relname)
+                tar.chown(member, dirname)
+                tar.utime(member, dirname)
+                tar.chmod(member, dirname)
+
+    def extract_zip(self, fileobj):
+        import zipfile
+
+        with zipfile.ZipFile(fileobj) as archive:
+            members = archive.infolist()
+            tops = set()
+            for member in members:
+                parts = self.split(member.filename)
+                if parts:
+                    if len(parts) == 1 and not member.filename.endswith('/'):
+                        tops.add(None)
+                    tops.add(parts[0])
+            self.prefix = tops.pop() if len(tops) == 1 else ''
+            for member in members:
+                relname = self.target(member.filename,
+                                      member.filename.endswith('/'))
+                if relname is None:
+                    continue
+                filename = os.path.join(self.dest_dir, relname)
+                mode = member.external_attr >> 16
+                symlink = None
+                if stat.S_ISLNK(mode):
+                    symlink = archive.read(member)
+                if not self.is_safe(relname, symlink=symlink):
+                    continue
+                if member.filename.endswith('/'):
+                    makedirs(filename)
+                    continue
+                makedirs(os.path.dirname(filename))
+                if symlink is not None:
+                    os.symlink(symlink, filename)
+                else:
+                    with archive.open(member) as src:
+                        with open(filename, 'wb') as dest:
+                            shutil.copyfileobj(src, dest)
+                    if mode & 07777:
+                        os.chmod(filename, mode & 07777)
+                self.count += 1
+
+
+class LinkPlanner(object):
+    """Works out what the link farms should contain for a set of sources
+    before touching the filesystem, and then makes only those changes
+    needed to get the link farms into that state.
+
+    If more than one source in the plan provides a file with the same
+    name for the same link farm, the source whose name sorts last wins
+    (which is the same source which would have won when relinking all
+    sources one at a time, in order.)  Links to files in sources which
+    are not in the plan are trampled, as usual.
+
+    If searching a source for linkable files fails, the error is collected
+    against that source in the usual way, and the source is dropped from
+    the plan (so its existing links are left as they are), rather than
+    abandoning the plan for every source.
+
+    """
+    def __init__(self, shelf):
+        self.shelf = shelf
+        self.sources = {}
+
+    def add(self, source):
+        """Add the given source to the plan.  It is not searched for
+        linkable files until the plan is made, so it may still change
+        (by being built, say) in the meantime.
+
+        """
+        self.sources[source.dir] = (source, None)
+
+    def find_links(self):
+        for (dirname, (source, links)) in self.sources.items():
+            if links is None:
+                try:
+                    self.sources[dirname] = (source, source.find_links())
+                except Exception:
+                    del self.sources[dirname]
+                    self.shelf.collect_error(source.name, sys.exc_info())
+
+    def owner(self, filename):
+        """Return the directory of the source in the plan which contains
+        the given file, or None if there is no such source.
+
+        """
+        dirname = filename
+        while True:
+            if dirname in self.sources:
+                return dirname
+            parent = os.path.dirname(dirname)
+            if parent == dirname:
+                return None
+            dirname = parent
+
+    def plan(self):
+        """Return a dict mapping each link farm name to a dict mapping
+        link names to the files they should link to.
+
+        """
+        self.find_links()
+        plan = dict((farm_name, {}) for farm_name in LINK_FARM_NAMES)
+        for dirname in sorted(self.sources,
+                              key=lambda d: self.sources[d][0].name):
+            (source, links) = self.sources[dirname]
+            for (farm_name, filenames) in links.iteritems():
+                farm_plan = plan[farm_name]
+                for filename in filenames:
+                    basename = os.path.basename(filename)
+                    previous = farm_plan.get(basename)
+                    if previous is not None and previous != filename:
+                        self.shelf.debug("[%s] %s from %s overrides %s" %
+                            (farm_name, basename, source.name, previous)
+                        )
+                    farm_plan[basename] = filename
+        return plan
+
+    def apply(self):
+        """Bring the link farms into the planned state, publishing a new
+        generation of each link farm which needs to change.  Returns a
+        tuple of the number of links changed, and the number of filesystem
+        operations which would have been made by relinking each source
+        in turn.
+
+        """
+        plan = self.plan()
+        changes = 0
+        naive_operations = 0
+        for farm_name in LINK_FARM_NAMES:
+            farm = self.shelf.link_farms[farm_name]
+            farm_plan = plan[farm_name]
+            current = dict((os.path.basename(linkname), target)
+                           for (linkname, target) in farm.links())
+
+            # relinking each source in turn would remove each of its
+            # existing links, then create (trampling if necessary) each
+            # of the links it provides
+            names = set(current)
+            for (source, links) in self.sources.itervalues():
+                for filename in links.get(farm_name, ()):
+                    naive_operations += 1
+                    if os.path.basename(filename) in names:
+                        naive_operations += 1
+                    names.add(os.path.basename(filename))
+            for target in current.itervalues():
+                if self.owner(target) is not None:
+                    naive_operations += 1
+
+            new_links = dict(current)
+            for (name, target) in sorted(current.iteritems()):
+                wanted = farm_plan.get(name)
+                if wanted == target:
+                    continue
+                if self.owner(target) is None:
+                    if wanted is None:
+                        continue
+                    self.shelf.warn("Trampling existing [%s] link %s" %
+                        (os.path.basename(farm.dirname), name)
+                    )
+                    self.shelf.warn("  was: %s" % target)
+                    self.shelf.warn("  now: %s" % wanted)
+                self.shelf.note("Removing [%s] link %s -> %s" %
+                                (farm_name, name, target))
+                del new_links[name]
+                changes += 1
+            for (name, filename) in sorted(farm_plan.iteritems()):
+                if current.get(name) != filename:
+                    self.shelf.note("Adding [%s] link %s -> %s" %
+                                    (farm_name, name, filename))
+                    new_links[name] = filename
+                    changes += 1
+            if new_links != current or farm.current_generation() is None:
+                farm.publish(new_links)
+        self.shelf.note(
+            "Relinked %d sources, changing %d links "
+            "(relinking them one at a time would take %d operations)" %
+            (len(self.sources), changes, naive_operations)
+        )
+        return (changes, naive_operations)
+
+
+class Jobserver(object):
+    """A GNU make jobserver: a pipe holding one token for each job which
+    may be run in addition to the one job every participant may always run.
+    Tokens are taken by reading a byte from the pipe, and given back by
+    writing it back.
+
+    `make`s started with the environment returned by `environ` take part,
+    so that the builds they run in parallel count against the same budget
+    as the builds being scheduled.
+
+    """
+    def __init__(self, jobs):
+        (self.read_fd, self.write_fd) = os.pipe()
+        # a token seen to be available may be taken by a `make` before we
+        # read it, so reads must not block (`make` itself reads this way)
+        flags = fcntl.fcntl(self.read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        os.write(self.write_fd, '+' * (jobs - 1))
+
+    def acquire(self):
+        """Take a token, if one is available.  Returns the token, or None
+        if there was none to take.
+
+        """
+        try:
+            return os.read(self.read_fd, 1) or None
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise
+
+    def release(self, token):
+        os.write(self.write_fd, token)
+
+    def environ(self):
+        env = dict(os.environ)
+        fds = '%d,%d' % (self.read_fd, self.write_fd)
+        env['MAKEFLAGS'] = '%s -j --jobserver-auth=%s --jobserver-fds=%s' % (
+            env.get('MAKEFLAGS', ''), fds, fds
+        )
+        return env
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class BuildTicket(object):
+    """The outcome of building a single source with a BuildScheduler."""
+    def __init__(self, source):
+        self.source = source
+        self.exc_info = None
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.event.is_set()
+
+    def add_callback(self, callback):
+        """Arrange for `callback` to be called with this ticket once the
+        build has finished (at once, if it already has.)
+
+        """
+        with self.lock:
+            if self.callbacks is not None:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def finish(self, exc_info=None):
+        self.exc_info = exc_info
+        with self.lock:
+            (callbacks, self.callbacks) = (self.callbacks, None)
+        for callback in callbacks:
+            callback(self)
+        self.event.set()
+
+    def wait(self):
+        """Wait for the build to finish, and re-raise the error it failed
+        with, if any.
+
+        """
+        while not self.event.wait(0.1):
+            pass
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+class BuildScheduler(object):
+    """Builds a set of sources in an order which respects their
+    `build_requires` hints, running up to `--jobs` independent builds at
+    once.
+
+    Each executable a source requires is mapped to the source being built
+    which provides it: the one whose executable is linked into the `bin`
+    link farm, or which has the same name as the executable, failing that.
+    A source is only built after all of the sources it requires have been
+    built and relinked.  If a source fails to build, the sources which
+    require it are not built.
+
+    Sources may be added all at once before calling `run`, or, after
+    calling `start`, one at a time while earlier ones are being built (as
+    happens in a pipeline.)  In the latter case, all of the sources which
+    may be added should first be announced with `expect`, so that a source
+    can require one which has not been added yet; a source which was
+    expected but will not be added after all should be `withdraw`n.
+    (Without `expect`, a source can only require sources which were added
+    before it.)  `finish` waits for all the builds.
+
+    """
+    def __init__(self, shelf):
+        self.shelf = shelf
+        self.tickets = collections.OrderedDict()
+        self.expected = {}
+        self.events = Queue()
+        self.thread = None
+
+    def expect(self, sources):
+        """Announce all of the sources which may later be added."""
+        tickets = []
+        for source in sources:
+            if source.dir not in self.expected:
+                self.expected[source.dir] = BuildTicket(source)
+                tickets.append(self.expected[source.dir])
+        self.events.put(('expect', tickets))
+
+    def add(self, source):
+        """Schedule the given source to be built, and return a BuildTicket
+        for it.
+
+        """
+        ticket = self.expected.get(source.dir) or BuildTicket(source)
+        self.events.put(('add', ticket))
+        return ticket
+
+    def withdraw(self, source):
+        """Note that the given expected source will not be added, as it is
+        not to be built this time.  Sources which require it are built
+        without waiting for it.
+
+        """
+        ticket = self.expected.get(source.dir)
+        if ticket is not None:
+            self.events.put(('withdraw', ticket))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.dispatch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def finish(self):
+        if self.thread is None:
+            self.start()
+        self.events.put(('finish', None))
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+
+    def run(self):
+        """Build all of the sources added so far.  Errors are collected
+        in the usual way.
+
+        """
+        self.finish()
+        for ticket in self.tickets.itervalues():
+            if ticket.exc_info is not None:
+                self.shelf.collect_error(ticket.source.name, ticket.exc_info)
+
+    def dispatch(self):
+        try:
+            self._dispatch()
+        except Exception:
+            exc_info = sys.exc_info()
+            for ticket in self.tickets.itervalues():
+                if not ticket.finished:
+                    ticket.finish(exc_info)
+
+    def _dispatch(self):
+        from multiprocessing.pool import ThreadPool
+
+        jobs = max(self.shelf.options.jobs, 1)
+        jobserver = None
+        env = None
+        (output, installed) = (None, False)
+        if jobs > 1:
+            jobserver = Jobserver(jobs)
+            env = jobserver.environ()
+        if jobs > 1 or isinstance(sys.stdout, SourceOutput):
+            # only buffer the output of builds which may run side by side
+            # (with each other, or with the other stages of a pipeline)
+            (output, installed) = SourceOutput.install()
+        pool = ThreadPool(jobs)
+
+        farm_links = list(self.shelf.link_farms['bin'].links())
+        link_providers = {}
+        name_providers = {}
+        requires = {}
+        provided = {}
+        dependents = {}
+        waiting = {}
+        arrived = []
+        present = set()
+        ready = collections.deque()
+        running = 0
+        relinked = set()
+        # the one job we may always run without taking a token
+        free_slot = True
+        holds_free_slot = set()
+        finishing = False
+
+        def build(ticket, token):
+            dirname = ticket.source.dir
+            fun = lambda s: s.build(provided=provided[dirname], env=env)
+            try:
+                if output is None:
+                    try:
+                        fun(ticket.source)
+                    except Exception:
+                        return (ticket, '', sys.exc_info())
+                    return (ticket, '', None)
+                return (ticket,) + output.capture(fun, ticket.source)[1:]
+            finally:
+                if token is not None:
+                    jobserver.release(token)
+
+        def fail(dirname, exc_info):
+            ticket = self.tickets[dirname]
+            if ticket.finished:
+                return
+            ticket.finish(exc_info)
+            for dependent in dependents[dirname]:
+                skip(dependent, ticket.source)
+
+        def skip(dirname, required_source):
+            reason = "%s was not built" % required_source.name
+            self.shelf.warn("Not building %s: %s" %
+                            (self.tickets[dirname].source.name, reason))
+            try:
+                raise DependencyError("not built: %s" % reason)
+            except DependencyError:
+                fail(dirname, sys.exc_info())
+
+        def register(ticket):
+            source = ticket.source
+            name_providers.setdefault(source.project, source)
+            record = self.shelf.link_manifest.get(source)
+            if record is not None:
+                for filename in record['links'].get('bin', ()):
+                    link_providers[os.path.basename(filename)] = source
+            prefix = source.dir + os.sep
+            for (linkname, target) in farm_links:
+                if target.startswith(prefix):
+                    link_providers[os.path.basename(linkname)] = source
+
+        def resolve(ticket):
+            source = ticket.source
+            dirname = source.dir
+            requires[dirname] = set()
+            provided[dirname] = set()
+            waiting[dirname] = 0
+            build_requires = source.hints.get('build_requires', '')
+            for executable in build_requires.strip().split():
+                provider = (link_providers.get(executable) or
+                            name_providers.get(executable))
+                if provider is None or provider is source:
+                    continue
+                requires[dirname].add(provider.dir)
+                provided[dirname].add(executable)
+            for required in requires[dirname]:
+                dependents[required].add(dirname)
+            for required in requires[dirname]:
+                required_ticket = self.tickets[required]
+                if not required_ticket.finished:
+                    waiting[dirname] += 1
+                elif required_ticket.exc_info is not None:
+                    skip(dirname, required_ticket.source)
+                    return
+            make_ready(dirname)
+
+        def make_ready(dirname):
+            if (waiting[dirname] == 0 and dirname in present and
+                not self.tickets[dirname].finished):
+                ready.append(dirname)
+
+        def release_dependents(dirname):
+            for dependent in dependents[dirname]:
+                waiting[dependent] -= 1
+                make_ready(dependent)
+
+        def withdraw(ticket):
+            if ticket.finished or ticket.source.dir in present:
+                return
+            ticket.finish()
+            release_dependents(ticket.source.dir)
+
+        try:
+            while True:
+                while ready:
+                    dirname = ready[0]
+                    if self.tickets[dirname].finished:
+                        ready.popleft()
+                        continue
+                    token = None
+                    if not free_slot:
+                        if jobserver is not None:
+                            token = jobserver.acquire()
+                        if token is None:
+                            # tried again when the next event arrives, or
+                            # after a moment
+                            break
+                    ready.popleft()
+                    if token is None:
+                        free_slot = False
+                        holds_free_slot.add(dirname)
+                    unlinked = [self.tickets[d].source
+                                for d in requires[dirname]
+                                if d not in relinked]
+                    if unlinked:
+                        self.shelf.relink_sources(unlinked)
+                        relinked.update(s.dir for s in unlinked)
+                    running += 1
+                    pool.apply_async(build, (self.tickets[dirname], token),
+                                     callback=lambda r: self.events.put(
+                                         ('built', r)
+                                     ))
+                if finishing and not running and not ready:
+                    # anything still expected is not going to be added now
+                    for ticket in self.expected.values():
+                        withdraw(ticket)
+                    if not ready:
+                        break
+                    continue
+
+                timeout = None
+                if ready:
+                    timeout = 0.05
+                try:
+                    (event, value) = self.events.get(timeout=timeout)
+                except Empty:
+                    continue
+                if event == 'expect':
+                    for ticket in value:
+                        self.tickets[ticket.source.dir] = ticket
+                        register(ticket)
+                        dependents[ticket.source.dir] = set()
+                    for ticket in value:
+                        resolve(ticket)
+                elif event == 'add':
+                    dirname = value.source.dir
+                    present.add(dirname)
+                    if dirname in waiting:
+                        make_ready(dirname)
+                    else:
+                        self.tickets[dirname] = value
+                        arrived.append(value)
+                elif event == 'withdraw':
+                    withdraw(value)
+                elif event == 'finish':
+                    finishing = True
+                elif event == 'built':
+                    (ticket, text, exc_info) = value
+                    dirname = ticket.source.dir
+                    running -= 1
+                    if dirname in holds_free_slot:
+                        holds_free_slot.remove(dirname)
+                        free_slot = True
+                    if text:
+                        output.emit(text)
+                    if exc_info is not None:
+                        fail(dirname, exc_info)
+                        continue
+                    ticket.finish()
+                    release_dependents(dirname)
+
+                # resolve newly-added sources once all of those which
+                # were added together have arrived
+                if arrived and self.events.empty():
+                    for ticket in arrived:
+                        register(ticket)
+                        dependents[ticket.source.dir] = set()
+                    for ticket in arrived:
+                        resolve(ticket)
+                    arrived = []
+        finally:
+            pool.terminate()
+            pool.join()
+            if installed:
+                output.restore()
+            if jobserver is not None:
+                jobserver.close()
+
+        cycle = [ticket for ticket in self.tickets.itervalues()
+                 if not ticket.finished]
+        if cycle:
+            names = ', '.join(ticket.source.name for ticket in cycle)
+            try:
+                raise DependencyError(
+                    "Circular build_requires among: %s" % names
+                )
+            except DependencyError:
+                exc_info = sys.exc_info()
+            for ticket in cycle:
+                ticket.finish(exc_info)
+
+
+class SourceClassifier(object):
+    """Decides which of the files found in a source are of interest to
+    which link farms.
+
+    Built once per source, from that source's hints, so that nothing
+    needs to be recomputed for each file; and works from the directory
+    entries returned by `scan_tree`, so that files are only stat'ed when
+    their names alone don't settle the matter, and then only once.
+
+    """
+    def __init__(self, source):
+        hints = source.hints
+        self.interesting_executables = frozenset(
+            hints.get('interesting_executables', '').split(' ')
+        )
+        exclude_paths = list(UNINTERESTING_PATHS)
+        exclude_paths_hint = hints.get('exclude_paths', None)
+        if exclude_paths_hint:
+            exclude_paths.extend(exclude_paths_hint.split(' '))
+        self.excluded_prefixes = tuple(
+            os.path.join(source.dir, path) for path in exclude_paths
+        )
+        self.euid = os.geteuid()
+        self.groups = frozenset([os.getegid()] + os.getgroups())
+
+    def is_interesting(self, basename):
+        return (basename in self.interesting_executables or
+                UNINTERESTING_RE.match(basename) is None)
+
+    def may_use_path(self, dirname):
+        return not dirname.startswith(self.excluded_prefixes)
+
+    def is_executable(self, st):
+        """Like `os.access(filename, os.X_OK)`, but using the result of
+        an earlier stat of the file.
+
+        """
+        mode = st.st_mode
+        if self.euid == 0:
+            return bool(mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH))
+        if st.st_uid == self.euid:
+            return bool(mode & stat.S_IXUSR)
+        if st.st_gid in self.groups:
+            return bool(mode & stat.S_IXGRP)
+        return bool(mode & stat.S_IXOTH)
+
+    def classify(self, entry, lua=True):
+        """Return a list of the names of the link farms which the file
+        with the given directory entry should be linked into.  (Not
+        including `python` or `include`, which are not decided per-file.)
+
+        """
+        name = entry.name
+        farm_names = []
+        interesting = self.is_interesting(name)
+        st = None
+        if interesting:
+            try:
+                st = entry.stat()
+            except OSError:
+                pass
+        is_file = st is not None and stat.S_ISREG(st.st_mode)
+        if is_file and self.is_executable(st):
+            farm_names.append('bin')
+        if SHARED_OBJECT_RE.match(name) or STATIC_LIB_RE.match(name):
+            if entry.is_symlink() or entry.is_file():
+                farm_names.append('lib')
+        if (PKGCONFIG_DATA_RE.match(name) and
+            not UNINSTALLED_PKGCONFIG_DATA_RE.match(name)):
+            farm_names.append('pkgconfig')
+        if lua and is_file and name.endswith('.lua'):
+            farm_names.append('lua')
+        return farm_names
+
+
+class Source(object):
+    """A source tree, docked or not.
+
+    Instances are kept small, since expanding `all` on a large shelf
+    creates one for every docked source: attributes are stored in slots,
+    the paths derived from the host, user and project are computed once,
+    on first use, and the cookie hints are not looked up until they are
+    first needed.
+
+    """
+    __slots__ = ('shelf', 'url', 'host', 'user', 'project', 'type',
+                 'local', 'tag', '_hints', '_name', '_user_dir', '_dir',
+                 '_classifier')
+
+    def __init__(self, shelf, url=None, host=None, user=None, project=None,
+                 type=None, local=False, tag=None):
+        self.shelf = shelf
+        self.url = url
+        if not host:
+            raise ValueError('no host supplied')
+        self.host = host
+        self.user = user or 'distfile'
+        self.project = project
+        self.type = type
+        self.local = local
+        self.tag = tag
+        self._hints = None
+        self._name = None
+        self._user_dir = None
+        self._dir = None
+        self._classifier = None
+
+    def __repr__(self):
+        return ("Source(url=%r, host=%r, user=%r, "
+                "project=%r, type=%r, local=%r, tag=%r, hints=%r)" %
+                (self.url, self.host, self.user,
+                 self.project, self.type, self.local, self.tag, self.hints))
+
+    @property
+    def hints(self):
+        if self._hints is None:
+            self._hints = dict(self.shelf.cookies.hints_for(self.name))
+        return self._hints
+
+    @property
+    def classifier(self):
+        if self._classifier is None:
+            self._classifier = SourceClassifier(self)
+        return self._classifier
+
+    @property
+    def distfile(self):
+        if self.local:
+            return self.url
+        if self.type in DISTFILE_TYPES:
+            return os.path.join(self.shelf.dir, '.distfiles',
+                                '%s.%s' % (self.project, self.type))
+        else:
+            return None
+
+    @property
+    def name(self):
+        if self._name is None:
+            self._name = os.path.join(self.host, self.user, self.project)
+        return self._name
+
+    @property
+    def user_dir(self):
+        if self._user_dir is None:
+            self._user_dir = os.path.join(self.shelf.dir, self.host, self.user)
+        return self._user_dir
+
+    @property
+    def dir(self):
+        if self._dir is None:
+            self._dir = os.path.join(self.user_dir, self.project)
+        return self._dir
+
+    @property
+    def docked(self):
+        return os.path.isdir(self.dir)
+
+    def checkout(self):
+        self.shelf.note("Checking out %s..." % self.name)
+
+        makedirs(self.user_dir)
+
+        if self.type in ('git', 'hg', 'hg-or-git'):
+            with self.shelf.host_slot(self.host):
+                self.clone()
+        elif self.distfile is not None:
+            makedirs(os.path.join(self.shelf.dir, '.distfiles'))
+            try:
+                self.extract_distfile()
+            except:
+                shutil.rmtree(self.dir, ignore_errors=True)
+                raise
         else:
             raise NotImplementedError(self.type)
         self.update_to_tag(self.tag)
 
+    def extract_distfile(self):
+        """Extract this source's distfile into its directory.  If the
+        distfile has not already been downloaded, it is extracted as it
+        downloads (except for zip files, which cannot be read until they
+        have been downloaded completely), and is kept in the distfile
+        cache once the download is complete.  If the source has a
+        `sha256` hint, the distfile must match it.
+
+        """
+        downloader = self.shelf.downloader
+        sha256 = self.hints.get('sha256')
+        extractor = DistfileExtractor(self.shelf, self.dir)
+        if (sha256 and os.path.exists(self.distfile) and
+            not downloader.verify(self.distfile, sha256)):
+            if self.local:
+                raise ChecksumError("distfile '%s' doesn't match its "
+                                    "sha256 hint" % self.distfile)
+            self.shelf.warn("Cached distfile '%s' doesn't match its sha256 "
+                            "hint; downloading it again" % self.distfile)
+            os.unlink(self.distfile)
+        if self.local and not os.path.exists(self.distfile):
+            raise IOError("local distfile '%s' doesn't exist?!" % self.distfile)
+        if not os.path.exists(self.distfile) and not (
+               sha256 and downloader.fetch_stored(sha256, self.distfile)):
+            with self.shelf.host_slot(self.host):
+                download = downloader.open(self.url, self.distfile,
+                                           sha256=sha256)
+                try:
+                    if self.type == 'zip':
+                        download.finish()
+                    else:
+                        extractor.extract(download, self.type)
+                        download.finish()
+                except:
+                    download.abort()
+                    raise
+            if self.type != 'zip':
+                return
+        with open(self.distfile, 'rb') as f:
+            extractor.extract(f, self.type)
+
+    def clone(self):
+        if self.type == 'git':
+            self.git_clone()
+        elif self.type == 'hg':
+            self.hg_clone()
+        elif self.type == 'hg-or-git':
+            try:
+                # better would be to check hg's error output for
+                # 'Http Error 406'
+                self.hg_clone()
+            except subprocess.CalledProcessError:
+                self.shelf.note("`hg clone` failed, so trying git")
+                self.git_clone()
+        else:
+            raise NotImplementedError(self.type)
+
+    def git_clone(self):
+        """Clone this source's git repository, shallowly (only the last
+        `clone_depth` commits) and/or partially (only the objects passing
+        `clone_filter`) if so configured, by hint or by command-line
+        option.  A shallow clone of a source with a tag only fetches the
+        history leading up to that tag; but a tag which looks like a
+        commit id can't be cloned that way, so such a source is cloned in
+        full.  Otherwise, with --share-objects, the clone borrows its
+        objects from the shared object pool.
+
+        """
+        (depth, filter) = self.clone_limits()
+        if depth and self.tag is not None and COMMIT_ID_RE.match(self.tag):
+            self.shelf.debug("%s is at a commit; not cloning shallowly" %
+                             self.name)
+            depth = 0
+        command = ['git', 'clone']
+        if depth:
+            command.append('--depth=%d' % depth)
+            if self.tag is not None:
+                command.append('--branch=%s' % self.tag)
+        if filter:
+            command.append('--filter=%s' % filter)
+        if self.shelf.options.share_objects and not (depth or filter):
+            command.append('--reference=%s' % self.fill_object_pool('git'))
+        command.append(self.url)
+        self.shelf.run(*command, cwd=self.user_dir)
+
+    def hg_clone(self):
+        """Clone this source's Mercurial repository.  With
+        --share-objects, the clone is a share of the shared object pool
+        (so that it, and anything later pulled into it, is stored there.)
+
+        """
+        if not self.shelf.options.share_objects:
+            self.shelf.run('hg', 'clone', self.url, cwd=self.user_dir)
+            return
+        pool = self.fill_object_pool('hg')
+        self.shelf.run('hg', '--config', 'extensions.share=', 'share',
+                       pool, self.project, cwd=self.user_dir)
+        with open(os.path.join(self.dir, '.hg', 'hgrc'), 'a') as f:
+            f.write('\n[paths]\ndefault = %s\n' % self.url)
+
+    def object_pool(self, kind):
+        """Return the directory of the pool of objects shared by all the
+        sources of this project (forks, mirrors) of the given kind (`git`
+        or `hg`) which were cloned with --share-objects.
+
+        """
+        return os.path.join(self.shelf.dir, '.objects',
+                            '%s.%s' % (self.project, kind))
+
+    @property
+    def object_pool_refs(self):
+        # ':' is not allowed in a git ref name, but may be in a host
+        return 'refs/forks/%s/%s' % (self.host.replace(':', '_'), self.user)
+
+    def fill_object_pool(self, kind):
+        """Fetch everything in this source's upstream repository into the
+        shared object pool (creating it if need be), and return the pool's
+        directory.  In a git pool, this source's branches and tags are
+        kept under `object_pool_refs`, so that the objects they need are
+        never pruned from it.
+
+        """
+        pool = self.object_pool(kind)
+        with self.shelf.object_pool_lock(pool):
+            exists = os.path.isdir(pool)
+            makedirs(os.path.dirname(pool))
+            if kind == 'git':
+                if not exists:
+                    self.shelf.run('git', 'init', '--quiet', '--bare', pool)
+                self.shelf.run(
+                    'git', '--git-dir=' + pool, 'fetch', '--quiet',
+                    '--no-tags', self.url,
+                    '+refs/heads/*:%s/heads/*' % self.object_pool_refs,
+                    '+refs/tags/*:%s/tags/*' % self.object_pool_refs
+                )
+            elif exists:
+                self.shelf.run('hg', 'pull', '--quiet', '-R', pool, self.url)
+            else:
+                self.shelf.run('hg', 'clone', '--quiet', '--noupdate',
+                               self.url, pool)
+        return pool
+
+    def shared_object_pool(self):
+        return shared_object_pool(self.dir)
+
+    def dissociate(self):
+        """Give this source its own copy of the objects it has been
+        borrowing from the shared object pool, stop using the pool, and
+        release it (see `release_object_pool`.)  Returns False if the
+        source wasn't using a pool.
+
+        """
+        pool = self.shared_object_pool()
+        if pool is None:
+            return False
+        self.shelf.note("Dissociating %s from %s..." % (self.name, pool))
+        if os.path.isdir(os.path.join(self.dir, '.git')):
+            self.shelf.run('git', 'repack', '-a', '-d', '-q', cwd=self.dir)
+            os.unlink(os.path.join(
+                self.dir, '.git', 'objects', 'info', 'alternates'
+            ))
+        else:
+            self.shelf.run('hg', '--config', 'extensions.share=', 'unshare',
+                           cwd=self.dir)
+        self.release_object_pool(pool)
+        return True
+
+    def release_object_pool(self, pool):
+        """Note that this source no longer uses the given shared object
+        pool (because it has been removed or dissociated.)  The pool is
+        removed once no docked source of this project uses it.
+
+        Objects are never pruned from a pool while it is in use, even
+        those only the released source needed, as other sources may since
+        have come to depend on them.
+
+        """
+        with self.shelf.object_pool_lock(pool):
+            if not os.path.isdir(pool):
+                return
+            for dirname in dir_entries(self.shelf.dir):
+                if not dirname.is_dir() or dirname.name.startswith('.'):
+                    continue
+                for user_dir in dir_entries(dirname.path):
+                    other_dir = os.path.join(user_dir.path, self.project)
+                    if (other_dir != self.dir and
+                        shared_object_pool(other_dir) == pool):
+                        if pool.endswith('.git'):
+                            self.release_object_pool_refs(pool)
+                        return
+            self.shelf.note("Removing unused object pool %s" % pool)
+            shutil.rmtree(pool)
+
+    def release_object_pool_refs(self, pool):
+        (status, output) = self.shelf.probe(
+            'git', '--git-dir=' + pool, 'for-each-ref',
+            '--format=%(refname)', self.object_pool_refs + '/'
+        )
+        deletions = ''.join('delete %s\n' % refname
+                            for refname in output.split())
+        if not deletions:
+            return
+        command = ('git', '--git-dir=' + pool, 'update-ref', '--stdin')
+        self.shelf.note("Running `%s`..." % ' '.join(command))
+        process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        process.communicate(deletions)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+    def clone_limits(self):
+        depth = self.hints.get('clone_depth')
+        if depth is None:
+            depth = self.shelf.options.clone_depth
+        filter = self.hints.get('clone_filter', self.shelf.options.clone_filter)
+        return (int(depth or 0), filter)
+
+    @property
+    def shallow(self):
+        return os.path.isfile(os.path.join(self.dir, '.git', 'shallow'))
+
+    def ensure_history(self, ref=None):
+        """If this source is a shallow git clone, fetch the rest of its
+        history (and all of its upstream branches and tags), so that
+        commands which look at history see all of it.  If `ref` is given,
+        only do so if `ref` can't be found in the history already fetched.
+
+        """
+        if not self.shallow:
+            return
+        if ref is not None:
+            (status, output) = self.shelf.probe(
+                'git', 'rev-parse', '--verify', '--quiet', ref + '^{commit}',
+                cwd=self.dir
+            )
+            if status == 0:
+                return
+        self.shelf.note("Fetching the full history of %s..." % self.name)
+        with self.shelf.host_slot(self.host):
+            self.shelf.run(
+                'git', 'fetch', '--unshallow', '--tags', 'origin',
+                '+refs/heads/*:refs/remotes/origin/*', cwd=self.dir
+            )
+
     def update_to_tag(self, tag):
         """'tag' may also be the name of a branch."""
         if tag is None:
             return
         self.shelf.note("Updating %s to %s..." % (self.dir, tag))
-        self.shelf.chdir(self.dir)
-        if os.path.isdir('.hg'):
-            self.shelf.run('hg', 'up', tag)
-        elif os.path.isdir('.git'):
-            self.shelf.run('git', 'checkout', tag)
+        if os.path.isdir(os.path.join(self.dir, '.hg')):
+            self.shelf.run('hg', 'up', tag, cwd=self.dir)
+        elif os.path.isdir(os.path.join(self.dir, '.git')):
+            self.ensure_history(tag)
+            self.shelf.run('git', 'checkout', tag, cwd=self.dir)
         else:
             self.shelf.warn("Can't update to %s -- not version-controlled" % tag)
 
-    def build(self):
+    def build(self, provided=(), env=None):
+        """Build this source.  Executables named in `provided` are taken
+        to be available even if they cannot (yet) be found on the search
+        path; `env`, if given, is the environment to build in.
+
+        The source is not built if it was built before and its build
+        fingerprint has not changed since (unless --force was given.)
+        Returns True if the source was built.
+
+        """
+        fingerprints = self.shelf.build_fingerprints
+        fingerprint = self.build_fingerprint()
+        if not self.shelf.options.force:
+            if fingerprints.matches(self, fingerprint):
+                self.shelf.note("%s is already built" % self.name)
+                fingerprints.skip(self, fingerprint)
+                return False
+
         self.shelf.note("Building %s..." % self.dir)
 
         build_requires = self.hints.get('build_requires', '')
         if build_requires:
             search_path = Path()
             for executable in build_requires.strip().split(' '):
+                if executable in provided:
+                    continue
                 if not search_path.which(executable):
                     self.shelf.warn("Requires %s to build, not found on search path" % executable)
-                    return
+                    return False
+
+        fingerprints.forget(self)
+        store = self.shelf.artifact_store
+        key = None
+        if store is not None:
+            key = self.artifact_key(fingerprint)
+        if key is not None and store.restore(self, key):
+            self.shelf.note("Restored %s from artifact store" % self.name)
+        else:
+            before = None
+            if key is not None:
+                before = store.snapshot(self)
+            self.run_build_command(env=env)
+            if key is not None:
+                store.publish(self, key, before)
+        fingerprints.record(self, self.build_fingerprint())
+        return True
+
+    def effective_build_command(self):
+        build_command = self.hints.get('build_command@' + self.shelf.uname, None)
+        if not build_command:
+            build_command = self.hints.get('build_command', None)
+        return build_command
+
+    def build_fingerprint(self):
+        """Return a summary of everything which, if it changed, would
+        mean this source needs to be built again.
+
+        A source which is not version-controlled (e.g. one extracted from
+        a distfile) has no head or diff to go by, so its distfile (if it
+        is kept in `$TOOLSHELF/.distfiles`) and the files in its tree are
+        fingerprinted instead.
+
+        """
+        head = None
+        changes = None
+        distfile = None
+        tree = None
+        if os.path.isdir(os.path.join(self.dir, '.git')):
+            head = self.head_ref().strip()
+            diff = self.shelf.probe('git', 'diff', '--no-ext-diff', 'HEAD',
+                                    cwd=self.dir)[1]
+        elif os.path.isdir(os.path.join(self.dir, '.hg')):
+            head = self.head_ref().strip()
+            diff = self.shelf.probe('hg', 'diff', cwd=self.dir)[1]
+        else:
+            diff = ''
+            # found by name, as a docked source doesn't know its URL
+            for type in DISTFILE_TYPES:
+                filename = os.path.join(self.shelf.dir, '.distfiles',
+                                        '%s.%s' % (self.project, type))
+                if os.path.exists(filename):
+                    distfile = (type,) + file_signature(filename)
+                    break
+            tree = self.tree_signature()
+        if diff:
+            changes = hashlib.sha1(diff).hexdigest()
+        return (
+            ('uname', self.shelf.uname),
+            ('head', head),
+            ('changes', changes),
+            ('distfile', distfile),
+            ('tree', tree),
+            ('build_command', self.effective_build_command()),
+            ('hints', tuple(sorted(self.hints.iteritems()))),
+        )
 
-        self.shelf.chdir(self.dir)
-        build_command = self.hints.get('build_command@' + self.shelf.uname, None)
-        if not build_command:
-            build_command = self.hints.get('build_command', None)
+    def tree_signature(self):
+        """Return a digest of the names, sizes and mtimes of all of the
+        files in this source's tree.
+
+        """
+        hash = hashlib.sha1()
+        for (dirname, dirs, files) in scan_tree(self.dir):
+            dirs.sort()
+            for entry in sorted(files, key=lambda entry: entry.name):
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                hash.update('%s\0%d\0%r\0' %
+                            (entry.path, st.st_size, st.st_mtime))
+        return hash.hexdigest()
+
+    def artifact_key(self, fingerprint):
+        """Return the key under which the outputs of building this source,
+        in the state described by the given build fingerprint, are kept in
+        the artifact store; or None if they shouldn't be kept, because the
+        source is not version-controlled, or has local changes.
+
+        """
+        fingerprint = dict(fingerprint)
+        if fingerprint['head'] is None or fingerprint['changes'] is not None:
+            return None
+        # builds (e.g. `./configure --prefix=.../install`) bake the source's
+        # absolute path into their outputs, so they can only be shared by
+        # toolshelves which keep the source at the same path
+        return hashlib.sha1(repr((
+            self.name, self.dir, fingerprint['head'], fingerprint['uname'],
+            fingerprint['build_command'], fingerprint['hints'],
+        ))).hexdigest()
+
+    def run_build_command(self, env=None):
+        def isfile(filename):
+            return os.path.isfile(os.path.join(self.dir, filename))
+
+        def run(*args, **kwargs):
+            kwargs.setdefault('env', env)
+            self.shelf.run(*args, **kwargs)
+
+        build_command = self.effective_build_command()
         if build_command:
-            self.shelf.run(build_command, shell=True)
-        elif os.path.isfile('build.sh'):
-            self.shelf.run('./build.sh')
-        elif os.path.isfile('make.sh'):
-            self.shelf.run('./make.sh')
-        elif os.path.isfile('build.xml'):
-            self.shelf.run('ant')
+            run(build_command, shell=True, cwd=self.dir)
+        elif isfile('build.sh'):
+            run('./build.sh', cwd=self.dir)
+        elif isfile('make.sh'):
+            run('./make.sh', cwd=self.dir)
+        elif isfile('build.xml'):
+            run('ant', cwd=self.dir)
         else:
-            if (os.path.isfile('autogen.sh') and
-                not os.path.isfile('configure')):
-                self.shelf.run('./autogen.sh')
-            if (os.path.isfile('configure.in') and
-                not os.path.isfile('configure')):
-                self.shelf.run('autoconf')
-            if os.path.isfile('configure'):
-                self.shelf.run('./configure', "--prefix=%s" %
-                               os.path.join(self.dir, 'install'))
-                self.shelf.run('make')
-                self.shelf.run('make', 'install')
-            elif os.path.isfile('Makefile') or os.path.isfile('makefile'):
-                self.shelf.run('make')
-            elif os.path.isfile('src/Makefile'):
-                self.shelf.chdir('src')
-                self.shelf.run('make')
+            if isfile('autogen.sh') and not isfile('configure'):
+                run('./autogen.sh', cwd=self.dir)
+            if isfile('configure.in') and not isfile('configure'):
+                run('autoconf', cwd=self.dir)
+            if isfile('configure'):
+                run('./configure', "--prefix=%s" %
+                    os.path.join(self.dir, 'install'), cwd=self.dir)
+                run('make', cwd=self.dir)
+                run('make', 'install', cwd=self.dir)
+            elif isfile('Makefile') or isfile('makefile'):
+                run('make', cwd=self.dir)
+            elif isfile('src/Makefile'):
+                run('make', cwd=os.path.join(self.dir, 'src'))
 
     def update(self):
         """Returns True if there were changes, False if there were none.
 
         """
-        self.shelf.chdir(self.dir)
         old_head_ref = self.head_ref()
-        if os.path.isdir('.git'):
-            self.shelf.run('git', 'pull')
-        elif os.path.isdir('.hg'):
-            self.shelf.run('hg', 'pull', '-u')
+        if os.path.isdir(os.path.join(self.dir, '.git')):
+            command = ('git', 'pull')
+        elif os.path.isdir(os.path.join(self.dir, '.hg')):
+            command = ('hg', 'pull', '-u')
         else:
             raise NotImplementedError(
                 "Can't update a non-version-controlled Source"
             )
+        with self.shelf.host_slot(self.host):
+            self.shelf.run(*command, cwd=self.dir)
         new_head_ref = self.head_ref()
         return old_head_ref != new_head_ref
 
+    def is_behind_upstream(self):
+        """Return True if the upstream repository has changes which this
+        source does not, False if it does not, or None if that can't be
+        found out without pulling.  Only asks the upstream repository for
+        its head, which is much cheaper than pulling from it.
+
+        """
+        probe = self.shelf.probe
+        if os.path.isdir(os.path.join(self.dir, '.git')):
+            (status, upstream) = probe(
+                'git', 'rev-parse', '--abbrev-ref', '--symbolic-full-name',
+                '@{u}', cwd=self.dir
+            )
+            if status != 0 or '/' not in upstream:
+                return None
+            (remote, branch) = upstream.strip().split('/', 1)
+            with self.shelf.host_slot(self.host):
+                (status, output) = probe(
+                    'git', 'ls-remote', remote, 'refs/heads/' + branch,
+                    cwd=self.dir
+                )
+            if status != 0 or not output.strip():
+                return None
+            remote_head = output.split()[0]
+            (status, output) = probe(
+                'git', 'merge-base', '--is-ancestor', remote_head, 'HEAD',
+                cwd=self.dir
+            )
+            return status != 0
+        elif os.path.isdir(os.path.join(self.dir, '.hg')):
+            with self.shelf.host_slot(self.host):
+                (status, output) = probe(
+                    'hg', 'incoming', '--quiet', '--limit', '1', cwd=self.dir
+                )
+            return {0: True, 1: False}.get(status)
+        return None
+
     def relink(self):
         """Search this source for linkable files, and place them in
         the link farms.
 
-        Requires that the current directory is self.dir.
+        """
+        planner = LinkPlanner(self.shelf)
+        planner.add(self)
+        planner.apply()
+
+    def find_links(self):
+        """Return a dict mapping each link farm name to a list of the
+        (absolute) filenames which should be linked into it from this
+        source.
+
+        If this source has been searched before, and neither its tree nor
+        the settings which affect what gets linked have changed since, the
+        result of that search is reused (unless --force was given.)
 
         """
-        # TODO: refactor all this to make it more efficient.
-        self.shelf.link_farms['bin'].clean(prefix=self.dir)
+        manifest = self.shelf.link_manifest
+        settings = self.link_settings()
+        if (not self.shelf.options.force and
+            manifest.is_current(self, settings)):
+            self.shelf.debug("%s unchanged since last relink" % self.name)
+            return manifest.get(self)['links']
+        linkables = {}
+        searched_dirs = {}
+        candidate_modes = {}
         if self not in self.shelf.blacklist:
-            for filename in self.linkable_files(
-                              self.is_interesting_executable
-                            ):
-                self.shelf.link_farms['bin'].create_link(filename)
+            linkables = self.find_linkables(searched_dirs=searched_dirs,
+                                            candidate_modes=candidate_modes)
+        links = {}
+        for (farm_name, filenames) in linkables.iteritems():
+            if filenames:
+                links[farm_name] = [os.path.abspath(filename)
+                                    for filename in filenames]
+        manifest.record(self, settings, searched_dirs, candidate_modes,
+                        links)
+        return links
+
+    def link_settings(self):
+        """Return a summary of everything other than the contents of this
+        source's tree which affects what gets linked from it.
 
-        self.shelf.link_farms['lib'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            for filename in self.linkable_files(is_library):
-                self.shelf.link_farms['lib'].create_link(filename)
+        """
+        return (
+            tuple((name, self.hints.get(name)) for name in LINK_HINT_NAMES),
+            self in self.shelf.blacklist,
+        )
 
-        self.shelf.link_farms['python'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            python_modules = self.hints.get('python_modules')
-            if python_modules is not None:
-                for filename in python_modules.split(' '):
-                    self.shelf.link_farms['python'].create_link(filename)
-            else:
-                for filename in self.linkable_python_packages():
-                    self.shelf.link_farms['python'].create_link(filename)                
+    def find_linkables(self, searched_dirs=None, candidate_modes=None):
+        """Return a dict mapping the name of each link farm to a list of
+        the files (or, for `python`, directories) in this source which
+        should be linked into it.
 
-        self.shelf.link_farms['lua'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            lua_modules = self.hints.get('lua_modules')
-            if lua_modules is not None:
-                for filename in lua_modules.split(' '):
-                    self.shelf.link_farms['lua'].create_link(filename)
-            else:
-                for filename in self.linkable_files(is_lua_module):
-                    if not self.is_interesting(filename):
-                        continue
-                    self.shelf.link_farms['lua'].create_link(filename)
+        If `searched_dirs` is given, it should be a dict; the mtime of
+        each directory searched will be recorded in it.  Likewise, if
+        `candidate_modes` is given, the permission bits of each file
+        whose executability was considered will be recorded in it.
 
-        self.shelf.link_farms['pkgconfig'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            for filename in self.linkable_files(is_pkgconfig_data):
-                self.shelf.link_farms['pkgconfig'].create_link(filename)
+        The source tree is traversed only once, no matter how many link
+        farms it is being searched for.  Within each of the `only_paths`
+        (or the whole tree, if that hint is not given) only the last file
+        found with any given basename is linked.
 
-        self.shelf.link_farms['include'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            include_dirs = self.hints.get('include_dirs', None)
-            if include_dirs is None:
-                if os.path.exists(os.path.join(self.dir, 'install', 'include')):
-                    include_dirs = 'install/include'
-            if include_dirs is not None:
-                for dirname in include_dirs.split(' '):
-                    dirname = os.path.join(self.dir, dirname)
-                    if not os.path.isdir(dirname):
-                        self.shelf.warn('No such directory: %s' % dirname)
-                        continue
-                    for filename in os.listdir(dirname):
-                        i_filename = os.path.join(dirname, filename)
-                        self.shelf.link_farms['include'].create_link(i_filename)
+        """
+        python_modules = self.hints.get('python_modules')
+        lua_modules = self.hints.get('lua_modules')
+        classifier = self.classifier
+
+        farm_names = ['bin', 'lib', 'pkgconfig']
+        if lua_modules is None:
+            farm_names.append('lua')
+
+        only_paths = self.hints.get('only_paths', None)
+        roots = [self.dir]
+        if only_paths:
+            roots = [os.path.join(self.dir, path)
+                     for path in only_paths.split(' ')]
+        found = dict((farm_name, [{} for root in roots])
+                     for farm_name in farm_names)
+
+        def is_in(dirname, root):
+            return dirname == root or dirname.startswith(root + os.sep)
+
+        def search_files(dirname, files, root_indices):
+            for entry in files:
+                if (candidate_modes is not None and
+                    classifier.is_interesting(entry.name)):
+                    try:
+                        candidate_modes[entry.path] = stat.S_IMODE(
+                            entry.stat().st_mode
+                        )
+                    except OSError:
+                        pass
+                for farm_name in classifier.classify(entry,
+                                                     lua=lua_modules is None):
+                    self.shelf.debug("found linkable file: %s" % entry.path)
+                    for index in root_indices:
+                        found[farm_name][index][entry.name] = entry.path
+
+        # Python packages are searched for in the whole tree, regardless
+        # of `only_paths`, but not inside other Python packages.
+        packages = {}
+        not_in_packages = set()
+        find_packages = python_modules is None
+        visited_roots = set()
+
+        def record_dir(dirname):
+            if searched_dirs is not None:
+                try:
+                    searched_dirs[dirname] = os.stat(dirname).st_mtime
+                except OSError:
+                    pass
+
+        for (dirname, dirs, files) in scan_tree(self.dir):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            if '.hg' in dirs:
+                dirs.remove('.hg')
+            if not classifier.may_use_path(dirname):
+                self.shelf.debug("%s excluded from search path" % dirname)
+                dirs[:] = []
+                continue
+            record_dir(dirname)
+            if dirname in roots:
+                visited_roots.add(dirname)
+            root_indices = [index for (index, root) in enumerate(roots)
+                            if is_in(dirname, root)]
+            search_files(dirname, files, root_indices)
+            if find_packages:
+                if dirname in not_in_packages:
+                    not_in_packages.update(
+                        os.path.join(dirname, name) for name in dirs
+                    )
+                else:
+                    for name in dirs:
+                        subdirname = os.path.join(dirname, name)
+                        if is_python_package(subdirname):
+                            self.shelf.debug(
+                                "found linkable dir: %s" % subdirname
+                            )
+                            packages[name] = subdirname
+                            not_in_packages.add(subdirname)
+            else:
+                dirs[:] = [name for name in dirs
+                           if any(is_in(os.path.join(dirname, name), root) or
+                                  is_in(root, os.path.join(dirname, name))
+                                  for root in roots)]
+
+        # `only_paths` which could not be reached in the above traversal
+        # (e.g. because they are symbolic links) are searched separately.
+        for (index, root) in enumerate(roots):
+            if root in visited_roots or not os.path.isdir(root):
+                continue
+            for (dirname, dirs, files) in scan_tree(root):
+                if '.git' in dirs:
+                    dirs.remove('.git')
+                if '.hg' in dirs:
+                    dirs.remove('.hg')
+                if not classifier.may_use_path(dirname):
+                    self.shelf.debug("%s excluded from search path" % dirname)
+                    dirs[:] = []
+                    continue
+                record_dir(dirname)
+                search_files(dirname, files, [index])
+
+        linkables = {}
+        for (farm_name, found_sets) in found.iteritems():
+            linkables[farm_name] = [filename for found_set in found_sets
+                                    for filename in found_set.values()]
+        if python_modules is not None:
+            linkables['python'] = [os.path.join(self.dir, filename)
+                                   for filename in python_modules.split(' ')]
+        else:
+            linkables['python'] = packages.values()
+        if lua_modules is not None:
+            linkables['lua'] = [os.path.join(self.dir, filename)
+                                for filename in lua_modules.split(' ')]
+        linkables['include'] = self.find_include_files(record_dir)
+        return linkables
+
+    def find_include_files(self, record_dir=lambda dirname: None):
+        include_dirs = self.hints.get('include_dirs', None)
+        if include_dirs is None:
+            if os.path.exists(os.path.join(self.dir, 'install', 'include')):
+                include_dirs = 'install/include'
+        if include_dirs is None:
+            return []
+        filenames = []
+        for dirname in include_dirs.split(' '):
+            dirname = os.path.join(self.dir, dirname)
+            if not os.path.isdir(dirname):
+                self.shelf.warn('No such directory: %s' % dirname)
+                continue
+            record_dir(dirname)
+            for filename in os.listdir(dirname):
+                filenames.append(os.path.join(dirname, filename))
+        return filenames
 
     def status(self):
-        self.shelf.chdir(self.dir)
         output = None
-        if os.path.isdir('.git'):
-            output = self.shelf.get_it('git status')
+        if os.path.isdir(os.path.join(self.dir, '.git')):
+            output = self.shelf.get_it('git status', cwd=self.dir)
             if 'working directory clean' in output:
                 output = ''
-        elif os.path.isdir('.hg'):
-            output = self.shelf.get_it('hg status')
+        elif os.path.isdir(os.path.join(self.dir, '.hg')):
+            output = self.shelf.get_it('hg status', cwd=self.dir)
         if output:
             print self.dir
             print output
 
     ### utility methods ###
 
-    def is_interesting(self, filename):
-        basename = os.path.basename(filename)
-        interesting_executables = self.hints.get('interesting_executables', '').split(' ')
-        if basename in interesting_executables:
-            return True
-        for pattern in UNINTERESTING_EXECUTABLES:
-            if re.match('^' + pattern + '$', basename):
-                return False
-        return True
-
-    def is_interesting_executable(self, filename):
-        return self.is_interesting(filename) and is_executable(filename)
-
     def head_ref(self):
-        self.shelf.chdir(self.dir)
-        if os.path.isdir('.git'):
-            return self.shelf.get_it('git rev-parse HEAD')
-        elif os.path.isdir('.hg'):
-            return self.shelf.get_it('hg id')
+        if os.path.isdir(os.path.join(self.dir, '.git')):
+            return self.shelf.get_it('git rev-parse HEAD', cwd=self.dir)
+        elif os.path.isdir(os.path.join(self.dir, '.hg')):
+            return self.shelf.get_it('hg id', cwd=self.dir)
         else:
             raise NotImplementedError(
                 "Can't get head ref of a non-version-controlled Source"
             )
 
     def may_use_path(self, dirname):
-        exclude_paths = [p for p in UNINTERESTING_PATHS]
-        exclude_paths_hint = self.hints.get('exclude_paths', None)
-        if exclude_paths_hint:
-            exclude_paths.extend(exclude_paths_hint.split(' '))
-        for path in exclude_paths:
-            verboten = os.path.join(self.dir, path)
-            if dirname.startswith(verboten):
-                return False
-        return True
-
-    def linkable_files(self, predicate):
-        only_paths = self.hints.get('only_paths', None)
-        paths_to_try = [self.dir]
-        if only_paths:
-            paths_to_try = [
-                os.path.join(os.path.join(self.dir, path))
-                for path in only_paths.split(' ')
-            ]
-        for path in paths_to_try:
-            for filename in self.find_linkable_file_set(predicate, path):
-                yield filename
-
-    def find_linkable_file_set(self, predicate, subdir):
-        found_files = {}
-        for root, dirs, files in os.walk(os.path.join(self.dir, subdir)):
-            if '.git' in dirs:
-                dirs.remove('.git')
-            if '.hg' in dirs:
-                dirs.remove('.hg')
-            if not self.may_use_path(root):
-                self.shelf.debug("%s excluded from search path" % root)
-                dirs[:] = []
-                continue
-            for name in files:
-                filename = os.path.join(self.dir, root, name)
-                if predicate(filename):
-                    self.shelf.debug("found linkable file: %s" % filename)
-                    found_files[os.path.basename(filename)] = filename
-        return found_files.values()
-
-    def linkable_python_packages(self):
-        for filename in self.find_linkable_dir_set(is_python_package,
-                                                   self.dir):
-            yield filename
-
-    def find_linkable_dir_set(self, predicate, subdir):
-        found_dirs = {}
-        for root, dirs, files in os.walk(os.path.join(self.dir, subdir)):
-            if '.git' in dirs:
-                dirs.remove('.git')
-            if '.hg' in dirs:
-                dirs.remove('.hg')
-            if not self.may_use_path(root):
-                self.shelf.debug("%s excluded from search path" % root)
-                dirs[:] = []
-            remove_these = []
-            for name in dirs:
-                dirname = os.path.join(self.dir, root, name)
-                if predicate(dirname):
-                    self.shelf.debug("found linkable dir: %s" % dirname)
-                    found_dirs[os.path.basename(dirname)] = dirname
-                    remove_these.append(name)
-            # now, don't recurse
-            for name in remove_these:
-                dirs.remove(name)
-        return found_dirs.values()
+        return self.classifier.may_use_path(dirname)
 
     def rectify_executable_permissions(self):
-        for root, dirs, files in os.walk(self.dir):
+        engine = self.shelf.options.rectify_engine
+        if engine == 'file':
+            self.rectify_executable_permissions_with_file()
+        elif engine == 'magic':
+            self.rectify_executable_permissions_with_magic()
+        else:
+            raise ValueError(
+                "rectify engine should be one of: %s" %
+                ', '.join(RECTIFY_ENGINES)
+            )
+        # executable bits have changed, so what gets linked may have, too
+        self.shelf.link_manifest.forget(self)
+
+    def find_rectifiable_files(self):
+        for root, dirs, files in scan_tree(self.dir):
             if '.git' in dirs:
                 dirs.remove('.git')
             if '.hg' in dirs:
                 dirs.remove('.hg')
-            for name in files:
-                filename = os.path.join(self.dir, root, name)
+            for entry in files:
                 # if it's not 'interesting', just skip it, so we don't
-                # have to call 'file' so many times.  it won't be put on
-                # the path anyway, whether it's executable or not.
-                if not self.is_interesting(filename):
+                # have to examine it.  it won't be put on the path
+                # anyway, whether it's executable or not.
+                if self.classifier.is_interesting(entry.name):
+                    yield entry.path
+
+    def rectify_executable_permissions_with_magic(self):
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+
+        def rectify(filename):
+            try:
+                mode = os.stat(filename).st_mode
+            except OSError:
+                return None
+            if not stat.S_ISREG(mode):
+                return None
+            if looks_executable(filename):
+                new_mode = mode | stat.S_IXUSR
+            else:
+                new_mode = mode & ~stat.S_IXUSR
+            if new_mode == mode:
+                return None
+            os.chmod(filename, stat.S_IMODE(new_mode))
+            return (filename, bool(new_mode & stat.S_IXUSR))
+
+        pool = ThreadPool(cpu_count())
+        try:
+            changes = pool.imap_unordered(
+                rectify, self.find_rectifiable_files(), chunksize=64
+            )
+            for change in changes:
+                if change is None:
                     continue
-                make_it_executable = False
-                pipe = subprocess.Popen(["file", filename],
-                                        stdout=subprocess.PIPE)
-                output = pipe.communicate()[0]
-                self.shelf.debug(output)
-                if 'executable' in output:
-                    make_it_executable = True
-                if make_it_executable:
+                (filename, executable) = change
+                if executable:
                     self.shelf.debug("Making %s executable" % filename)
-                    subprocess.check_call(["chmod", "u+x", filename])
                 else:
                     self.shelf.debug("Making %s NON-executable" % filename)
-                    subprocess.check_call(["chmod", "u-x", filename])
+        finally:
+            pool.close()
+            pool.join()
+
+    def rectify_executable_permissions_with_file(self):
+        for filename in self.find_rectifiable_files():
+            make_it_executable = False
+            pipe = subprocess.Popen(["file", filename],
+                                    stdout=subprocess.PIPE)
+            output = pipe.communicate()[0]
+            self.shelf.debug(output)
+            if 'executable' in output:
+                make_it_executable = True
+            if make_it_executable:
+                self.shelf.debug("Making %s executable" % filename)
+                subprocess.check_call(["chmod", "u+x", filename])
+            else:
+                self.shelf.debug("Making %s NON-executable" % filename)
+                subprocess.check_call(["chmod", "u-x", filename])
 
     def rectify_permissions_if_needed(self):
         rectify_permissions = 'no'
@@ -786,10 +3994,8 @@ class Source(object):
         (hg only for now.)
 
         """
-        self.shelf.chdir(self.dir)
-
         latest_tag = None
-        for line in self.shelf.get_it("hg tags").split('\n'):
+        for line in self.shelf.get_it("hg tags", cwd=self.dir).split('\n'):
             match = re.match(r'^\s*(\S+)\s+(\d+):(.*?)\s*$', line)
             if match:
                 tag = match.group(1)
@@ -809,14 +4015,16 @@ class Source(object):
             r'^.*?\.txt$',
             r'^.*?\.lhs$',
         )
-        for root, dirnames, filenames in os.walk('.'):
+        for root, dirnames, filenames in os.walk(self.dir):
             if root.endswith((".hg", "bin", "fixture", "distrepos")):
                 del dirnames[:]
                 continue
             for filename in filenames:
                 for pattern in DOC_PATTERNS:
                     if re.match(pattern, filename):
-                        yield os.path.join(root, filename)[2:]
+                        yield os.path.relpath(
+                            os.path.join(root, filename), self.dir
+                        )
                         break
 
 
@@ -835,16 +4043,39 @@ class BaseCommand(object):
         sources = shelf.make_sources_from_specs(specs)
         return sources
 
+    def name(self):
+        return self.__module__.split('.')[-1]
+
     def setup(self, shelf):
         """Called before any Sources have been processed."""
         pass
 
+    def prepare(self, shelf, sources):
+        """Called after `setup`, with all of the Sources which are about
+        to be processed, before any of them are.
+
+        """
+        pass
+
+    def stream(self, shelf):
+        """Called after `setup` when this command is a stage in a
+        pipeline, and so Sources will be passed to `perform` as soon as
+        the previous stage has finished with them.  Commands which would
+        otherwise save up their work until `teardown` can start it here.
+
+        """
+        pass
+
     def perform(self, shelf, source):
         """Performs the command on the given Source.
 
         Typically this will be called for all the sources to which the
         given specs resolved.
 
+        May return False to indicate that the Source did not change (or
+        True to indicate that it did); in a sequence of commands, later
+        commands may then skip the Source (see `skips_unchanged`.)
+
         This should be implemented by all concrete subclasses.
 
         """
@@ -857,12 +4088,56 @@ class BaseCommand(object):
     def show_progress(self):
         return True
 
+    def skips_unchanged(self):
+        """Return True if, in a sequence of commands, this command need
+        not be performed on Sources which an earlier command reported as
+        unchanged (unless the --force option was given.)
+
+        """
+        return False
+
+    def withdraw(self, shelf, source):
+        """Called, when this command is a stage in a pipeline, for each of
+        the Sources given to `prepare` which it will not be performed on
+        after all: because an earlier stage failed on it, or it was
+        unchanged and this command `skips_unchanged`.
+
+        """
+        pass
+
+    def waits_for_other_sources(self):
+        """Return True if performing this command on a Source may have to
+        wait until it has been performed on other Sources (as `build` waits
+        for the sources a source requires.)  In a pipeline, Sources are
+        then given to `submit` instead of `perform`, so that no worker is
+        left waiting for a Source which is still queued behind it.
+
+        """
+        return False
+
+    def submit(self, shelf, source):
+        """Start performing the command on the given Source, and return a
+        BuildTicket which is finished once it has been.  Only called for
+        commands which `waits_for_other_sources`.
+
+        """
+        raise NotImplementedError
+
     def trigger_relink(self, shelf):
         return []
 
     def specs_are_external(self):
         return False
 
+    def fetches(self):
+        """Return True if this command spends most of its time fetching
+        from remote hosts.  The Sources for such commands are processed
+        by `--fetch-jobs` workers at once, in an order which spreads them
+        across hosts.
+
+        """
+        return False
+
     def execute(self, shelf, args):
         """This is just provisional.  We'll actually run more than one
         Command at once...
@@ -870,47 +4145,298 @@ class BaseCommand(object):
         """
         sources = self.process_args(shelf, args)
         self.setup(shelf)
+        self.prepare(shelf, sources)
         progress = lambda x: x
         if self.show_progress():
-            progress = tqdm
+            progress = progress_bar
+        jobs = None
+        if self.fetches():
+            sources = interleave_by_host(sources)
+            jobs = max(shelf.options.jobs, shelf.options.fetch_jobs)
         shelf.foreach_source(
-            sources, lambda s: self.perform(shelf, s), progress=progress
+            sources, lambda s: self.perform(shelf, s), progress=progress,
+            jobs=jobs
         )
         self.teardown(shelf)
         relink_specs = self.trigger_relink(shelf)
         if relink_specs:
             specs = shelf.expand_docked_specs(relink_specs)
-            sources = shelf.make_sources_from_specs(specs)
-            # FIXME this should be handled better
-            for source in sources:
-                shelf.debug("Relinking %s" % source)
-                shelf.chdir(source.dir)  # needed for create_link, but probably shouldn't be
-                source.relink()
+            shelf.relink_sources(shelf.make_sources_from_specs(specs))
+
+
+class SourceOutput(object):
+    """Stands in for `sys.stdout` while Sources are being processed in
+    parallel.  Output written by a thread between calls to `begin` and
+    `end` is buffered, and returned by `end`; other output is passed
+    through to the real standard output.
+
+    One thread at a time is "live", though: the first to `begin` while
+    no other thread is live has its output passed straight through, so
+    that whatever is being done when nothing else is (e.g. everything,
+    with a single job) is not held back.  Buffered output which is
+    `emit`ted while a thread is live is written out when it `end`s.
+
+    """
+    def __init__(self, stream):
+        self.__dict__['stream'] = stream
+        self.__dict__['local'] = threading.local()
+        self.__dict__['lock'] = threading.Lock()
+        self.__dict__['live'] = None
+        self.__dict__['pending'] = []
+
+    @classmethod
+    def install(cls):
+        """Make sure `sys.stdout` is a SourceOutput.  Returns the
+        SourceOutput, and whether it had to be installed (in which case
+        the caller should `restore` the real standard output afterwards.)
+
+        """
+        if isinstance(sys.stdout, cls):
+            return (sys.stdout, False)
+        output = cls(sys.stdout)
+        sys.stdout = output
+        return (output, True)
+
+    def restore(self):
+        sys.stdout = self.stream
+
+    def emit(self, text):
+        """Write the given (buffered) output to the real standard output
+        in one piece, once no thread is live.
+
+        """
+        if not text:
+            return
+        with self.lock:
+            if self.live is not None:
+                self.pending.append(text)
+                return
+            self.stream.write(text)
+            self.stream.flush()
+
+    def begin(self):
+        with self.lock:
+            if self.live is None:
+                self.__dict__['live'] = threading.current_thread()
+                self.local.buffer = None
+                return
+        self.local.buffer = StringIO()
+
+    def capturing(self):
+        """Return True if the current thread's output is being buffered."""
+        return getattr(self.local, 'buffer', None) is not None
+
+    def end(self):
+        if self.live is threading.current_thread():
+            with self.lock:
+                self.__dict__['live'] = None
+                for text in self.pending:
+                    self.stream.write(text)
+                del self.pending[:]
+                self.stream.flush()
+            return ''
+        output = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return output
+
+    def capture(self, fun, source):
+        """Call `fun` on the given Source, buffering its output (unless
+        this thread gets to be live.)  Returns a tuple of the Source, the
+        output, and the `sys.exc_info()` of the error `fun` raised, or
+        None if it raised none.
+
+        """
+        self.begin()
+        try:
+            fun(source)
+        except Exception:
+            return (source, self.end(), sys.exc_info())
+        return (source, self.end(), None)
+
+    def target(self):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream
+        return buffer
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.target(), name, value)
 
 
 class CommandSequence(list):
+    """A sequence of commands, such as `tether+build+relink`, to be
+    performed on each Source in turn.
+
+    The commands are run as a pipeline: each command is a stage, with its
+    own worker threads, and hands each Source on to the next stage (through
+    a bounded queue) once it has finished with it.  So each Source still
+    goes through the commands in order, but one Source can be built while
+    the next is being fetched.
+
+    Along with each Source, the pipeline carries whether it has changed,
+    as last reported by a command's `perform`, so that later commands can
+    skip Sources which haven't (for example, building and relinking a
+    Source which pulling found no new changes for.)
+
+    """
     def execute(self, shelf, args):
         # XXX this is hacky.  different command process args in different
         # ways; you ought to only be able to combine ones that do it the same
         sources = self[0].process_args(shelf, args)
         for command in self:
             command.setup(shelf)
-        def execute(s):
-            for command in self:
-                command.perform(shelf, s)
-        shelf.foreach_source(sources, execute)
+        if self[0].fetches():
+            sources = interleave_by_host(sources)
+        for command in self:
+            command.prepare(shelf, sources)
+        for command in self:
+            command.stream(shelf)
+        self.pipeline(shelf, sources)
         relink_specs = set()
         for command in self:
             command.teardown(shelf)
             relink_specs.update(set(command.trigger_relink(shelf)))
         if relink_specs:
             specs = shelf.expand_docked_specs(list(relink_specs))
-            sources = shelf.make_sources_from_specs(specs)
-            # FIXME this should be handled better
+            shelf.relink_sources(shelf.make_sources_from_specs(specs))
+
+    def stage_jobs(self, shelf, command, sources):
+        if command.fetches():
+            return max(shelf.options.jobs, shelf.options.fetch_jobs)
+        return max(shelf.options.jobs, 1)
+
+    def pipeline(self, shelf, sources):
+        """Pass the given Sources through each of the commands in turn.
+        Errors are collected in the usual way; a Source on which a command
+        fails is not passed on to the next command.
+
+        """
+        done = object()
+        stages = []
+        for command in self:
+            jobs = self.stage_jobs(shelf, command, sources)
+            stages.append((command, jobs, Queue(maxsize=jobs * 2)))
+        intervals = dict((command, []) for command in self)
+        submitted = [[] for command in self]
+        failure = []
+        (output, installed) = SourceOutput.install()
+
+        skip_unchanged = not shelf.options.force
+
+        def withdraw(source, first):
+            for (command, jobs, queue) in stages[first:]:
+                command.withdraw(shelf, source)
+
+        def work(index):
+            (command, jobs, queue) = stages[index]
+            while True:
+                item = queue.get()
+                if item is done:
+                    queue.put(done)
+                    return
+                (source, changed) = item
+                if failure:
+                    withdraw(source, index)
+                    continue
+                if (not changed and skip_unchanged and
+                    command.skips_unchanged()):
+                    shelf.note("%s: %s unchanged, skipping" %
+                               (command.name(), source.name))
+                    command.withdraw(shelf, source)
+                    if index + 1 < len(stages):
+                        stages[index + 1][2].put(item)
+                    continue
+                start = time.time()
+                if command.waits_for_other_sources():
+                    # passed on by `performed` once the ticket is finished
+                    ticket = command.submit(shelf, source)
+                    ticket.add_callback(
+                        lambda ticket, item=item, start=start: performed(
+                            index, item, start, ticket.exc_info
+                        )
+                    )
+                    submitted[index].append(ticket)
+                    continue
+                result = []
+                (source, text, exc_info) = output.capture(
+                    lambda s: result.append(command.perform(shelf, s)),
+                    source
+                )
+                if result and result[0] is not None:
+                    item = (source, result[0])
+                output.emit(text)
+                performed(index, item, start, exc_info)
+
+        def performed(index, item, start, exc_info):
+            (command, jobs, queue) = stages[index]
+            (source, changed) = item
+            intervals[command].append((start, time.time()))
+            if exc_info is not None:
+                if shelf.options.break_on_error:
+                    failure.append(exc_info)
+                else:
+                    shelf.errors.setdefault(source.name, []).append(
+                        str(exc_info[1])
+                    )
+                withdraw(source, index + 1)
+            elif index + 1 < len(stages):
+                stages[index + 1][2].put(item)
+
+        workers = []
+        for (index, (command, jobs, queue)) in enumerate(stages):
+            threads = []
+            for n in xrange(jobs):
+                thread = threading.Thread(target=work, args=(index,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            workers.append(threads)
+
+        started = time.time()
+        try:
             for source in sources:
-                shelf.debug("Relinking %s" % source)
-                shelf.chdir(source.dir)  # needed for create_link, but probably shouldn't be
-                source.relink()
+                stages[0][2].put((source, True))
+            for (index, threads) in enumerate(workers):
+                stages[index][2].put(done)
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(0.1)
+                for ticket in submitted[index]:
+                    while not ticket.event.wait(0.1):
+                        pass
+        finally:
+            if installed:
+                output.restore()
+        elapsed = time.time() - started
+
+        if failure:
+            exc_info = failure[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if len(sources) > 1:
+            self.report_timing(shelf, intervals, elapsed)
+
+    def report_timing(self, shelf, intervals, elapsed):
+        """Report how long each stage of the pipeline was busy for, and
+        how much of that time overlapped with other stages.
+
+        """
+        busy = {}
+        for (command, spans) in intervals.iteritems():
+            busy[command] = span_length(spans)
+        overlapped = sum(busy.itervalues()) - span_length(
+            [span for spans in intervals.itervalues() for span in spans]
+        )
+        if shelf.options.quiet:
+            return
+        print "Pipeline timing:"
+        for command in self:
+            print "  %-10s busy for %.1fs" % (command.name(), busy[command])
+        print ("  %.1fs elapsed; stages overlapped for %.1fs, "
+               "of %.1fs total stage time" %
+               (elapsed, overlapped, sum(busy.itervalues())))
 
 
 ### Toolshelf object (Environment for Toolshelf operations)
@@ -919,6 +4445,7 @@ class CommandSequence(list):
 class Toolshelf(object):
     def __init__(self, directory=None, uname=None, cwd=None, options=None,
                        cookies=None, blacklist=None, link_farms=None,
+                       link_manifest=None, build_fingerprints=None,
                        errors=None):
         if directory is None:
             directory = os.environ.get('TOOLSHELF')
@@ -931,13 +4458,25 @@ class Toolshelf(object):
         if options is None:
             class DefaultOptions(object):
                 break_on_error = True
+                clone_depth = None
+                clone_filter = None
+                debug = False
+                fetch_jobs = 1
+                force = False
+                jobs = 1
+                per_host_jobs = 4
+                precheck = False
+                quiet = False
+                rectify_engine = 'magic'
+                share_objects = False
+                unique = False
                 verbose = False
                 build = True
             options = DefaultOptions()
         self.options = options
 
         if uname is None:
-            uname = self.get_it('uname').strip()
+            uname = os.uname()[0]
         self.uname = uname
         if self.uname.upper().startswith('CYGWIN'):
             self.uname = 'Cygwin'
@@ -951,7 +4490,9 @@ class Toolshelf(object):
         self.link_farms = link_farms
 
         if cookies is None:
-            cookies = Cookies(self)
+            cookies = Cookies(self, cache_filename=os.path.join(
+                self.dir, '.cache', 'cookies.cache'
+            ))
             cookies.add_file(os.path.join(
                 self.dir, '.toolshelf', 'local-cookies.catalog'
             ))
@@ -964,27 +4505,89 @@ class Toolshelf(object):
             blacklist = Blacklist(self, os.path.join(
                 self.dir, '.toolshelf', 'blacklist.txt'
             ))
-            blacklist.load()
         self.blacklist = blacklist
 
+        if link_manifest is None:
+            link_manifest = LinkManifest(self, os.path.join(
+                self.dir, '.cache', 'links.manifest'
+            ))
+        self.link_manifest = link_manifest
+
+        self.downloader = Downloader(self)
+
+        self.docked_index = DockedIndex(self, os.path.join(
+            self.dir, '.cache', 'docked.index'
+        ))
+
+        self.catalogs = Catalogs(self, cache_filename=os.path.join(
+            self.dir, '.cache', 'catalogs.cache'
+        ))
+
+        self.artifact_store = None
+        if getattr(options, 'artifact_store', None):
+            self.artifact_store = ArtifactStore(
+                self, options.artifact_store,
+                options.artifact_store_size * 1024 * 1024
+            )
+
+        if build_fingerprints is None:
+            build_fingerprints = BuildFingerprints(self, os.path.join(
+                self.dir, '.cache', 'builds.fingerprints'
+            ))
+        self.build_fingerprints = build_fingerprints
+
         if errors is None:
             errors = {}
         self.errors = errors
 
+        self.host_slots = {}
+        self.host_slots_lock = threading.Lock()
+        self.object_pool_locks = {}
+
     ### utility methods ###
 
     def run(self, *args, **kwargs):
+        """Run the given command, in the directory given by the `cwd`
+        keyword argument if one is given.
+
+        When sources are being processed in parallel, the output of the
+        command is collected and written to `sys.stdout` (and thus the
+        output buffer for the source being processed), instead of being
+        sent straight to the terminal.
+
+        """
         self.note("Running `%s`..." % ' '.join(args))
-        if 'ignore_exit_code' in kwargs:
-            del kwargs['ignore_exit_code']
-            subprocess.call(args, **kwargs)
+        ignore_exit_code = kwargs.pop('ignore_exit_code', False)
+        if isinstance(sys.stdout, SourceOutput) and sys.stdout.capturing():
+            process = subprocess.Popen(
+                args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                **kwargs
+            )
+            sys.stdout.write(process.communicate()[0])
+            returncode = process.returncode
         else:
-            subprocess.check_call(args, **kwargs)
+            returncode = subprocess.call(args, **kwargs)
+        if returncode != 0 and not ignore_exit_code:
+            raise subprocess.CalledProcessError(returncode, args)
+
+    def probe(self, *args, **kwargs):
+        """Run the given command, and return a tuple of its exit code and
+        its standard output.  Its standard error is discarded, and a
+        non-zero exit code is not considered an error.
+
+        """
+        self.note("Running `%s`..." % ' '.join(args))
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(
+                args, stdout=subprocess.PIPE, stderr=devnull, **kwargs
+            )
+            output = process.communicate()[0]
+        return (process.returncode, output)
 
-    def get_it(self, command):
+    def get_it(self, command, cwd=None):
         self.note("Running `%s`..." % command)
         output = subprocess.Popen(
-            command, shell=True, stdout=subprocess.PIPE
+            command, shell=True, stdout=subprocess.PIPE, cwd=cwd
         ).communicate()[0]
         if self.options.verbose:
             print output
@@ -1005,6 +4608,27 @@ class Toolshelf(object):
         if not self.options.quiet:
             print msg
 
+    def host_slot(self, host):
+        """Return a semaphore which must be held while talking to the
+        given host over the network, limiting how many fetches from that
+        host may be happening at once.
+
+        """
+        with self.host_slots_lock:
+            slot = self.host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.options.per_host_jobs)
+                self.host_slots[host] = slot
+            return slot
+
+    def object_pool_lock(self, pool):
+        """Return a lock which must be held while changing the given
+        shared object pool.
+
+        """
+        with self.host_slots_lock:
+            return self.object_pool_locks.setdefault(pool, threading.Lock())
+
     def chdir(self, dirname):
         self.note("Changing dir to `%s`..." % dirname)
         os.chdir(dirname)
@@ -1018,6 +4642,12 @@ class Toolshelf(object):
     def save(self):
         self.blacklist.save()
 
+    def save_caches(self):
+        """Persist state which remains valid even if errors occurred."""
+        self.link_manifest.save()
+        self.build_fingerprints.save()
+        self.catalogs.save()
+
     ### making Sources from specs ###
 
     def expand_docked_spec(self, name):
@@ -1036,22 +4666,13 @@ class Toolshelf(object):
         8. .                          the docked project (if any) in the cwd
 
         """
+        index = self.docked_index
+        if index.sources is None:
+            index.refresh()
         new_specs = []
         match = re.match(r'^([^/]*)/([^/]*)$', name)
         if name == 'all':  # case 7
-            for host in sorted(os.listdir(self.dir)):
-                if host.startswith('.'):
-                    continue
-                host_dirname = os.path.join(self.dir, host)
-                for user in sorted(os.listdir(host_dirname)):
-                    user_dirname = os.path.join(host_dirname, user)
-                    for project in sorted(os.listdir(user_dirname)):
-                        project_dirname = os.path.join(user_dirname,
-                                                       project)
-                        if not os.path.isdir(project_dirname):
-                            continue
-                        new_specs.append('%s/%s/%s' % (host, user, project))
-            return new_specs
+            return ['%s/%s/%s' % source for source in index.all()]
         elif name == '.' or name.startswith('.@'):  # case 8
             tag = None
             if '@' in name:
@@ -1074,59 +4695,27 @@ class Toolshelf(object):
         elif match:  # case 3 or 4
             user = match.group(1)
             project = match.group(2)
-            for host in sorted(os.listdir(self.dir)):
-                if host.startswith('.'):
-                    continue
-                user_dirname = os.path.join(self.dir, host, user)
-                if project == 'all':  # case 4
-                    if os.path.isdir(user_dirname):
-                        for found_project in sorted(os.listdir(user_dirname)):
-                            project_dirname = os.path.join(user_dirname,
-                                                           found_project)
-                            if not os.path.isdir(project_dirname):
-                                continue
-                            new_specs.append('%s/%s/%s' %
-                                (host, user, found_project)
-                            )
-                else:  # case 3
-                    project_dirname = os.path.join(
-                        self.dir, host, user, project
-                    )
-                    if not os.path.isdir(project_dirname):
-                        continue
-                    new_specs.append('%s/%s/%s' % (host, user, project))
+            if project == 'all':  # case 4
+                sources = index.find(user=user)
+            else:  # case 3
+                sources = index.find(user=user, project=project)
+            new_specs.extend('%s/%s/%s' % source for source in sources)
         elif '/' not in name:  # cases 5 and 6
-            try:
-                for host in os.listdir(self.dir):
-                    if host.startswith('.'):
-                        # skip hidden dirs
-                        continue
-                    host_dirname = os.path.join(self.dir, host)
-                    for user in os.listdir(host_dirname):
-                        user_dirname = os.path.join(host_dirname, user)
-                        for project in os.listdir(user_dirname):
-                            if project == name:
-                                new_specs.append('%s/%s/%s' %
-                                                 (host, user, project))
-                            if (name.endswith('+') and
-                                project.startswith(name[:-1])):
-                                new_specs.append('%s/%s/%s' %
-                                                 (host, user, project))
-                                raise StopIteration
-            except StopIteration:
-                pass
+            if name.endswith('+'):
+                source = index.find_prefix(name[:-1])
+                if source is not None:
+                    new_specs.append('%s/%s/%s' % source)
+            else:
+                new_specs.extend('%s/%s/%s' % source
+                                 for source in index.find(project=name))
         else:  # case 1 or 2
             components = name.split('/')
             host = components[0]
             user = ','.join(components[1:-1])
             project = components[-1]
             if project == 'all':  # case 2
-                user_dirname = os.path.join(self.dir, host, user)
-                for found_project in sorted(os.listdir(user_dirname)):
-                    project_dirname = os.path.join(user_dirname, found_project)
-                    if not os.path.isdir(project_dirname):
-                        continue
-                    new_specs.append('%s/%s/%s' % (host, user, found_project))
+                new_specs.extend('%s/%s/%s' % source
+                                 for source in index.find(host=host, user=user))
             else:  # case 1
                 new_specs.append(name)
 
@@ -1145,6 +4734,7 @@ class Toolshelf(object):
         """
         if not specs:
             self.warn('No source specifiers given')
+        self.docked_index.refresh()
         new_specs = []
         for name in specs:
             additional_specs = self.expand_docked_spec(name)
@@ -1173,6 +4763,8 @@ class Toolshelf(object):
           git://host.dom/.../user/repo.git       git
           http[s]://host.dom/.../user/repo.git   git
           http[s]://host.dom/.../user/repo       Mercurial
+          file:///path/to/.../user/repo.git      git (docked under localhost)
+          file:///path/to/.../user/repo          Mercurial (or git)
           http[s]://host.dom/.../distfile.tgz    \
           http[s]://host.dom/.../distfile.tar.gz | remotely hosted archive
           http[s]://host.dom/.../distfile.tar.xz | ("distfile" or "tarball")
@@ -1191,86 +4783,63 @@ class Toolshelf(object):
 
         """
         tag = None
-        match = re.match(r'^(.*?)\@(.*?)$', name)
+        match = SPEC_TAG_RE.match(name)
         if match:
             name = match.group(1)
             tag = match.group(2)
 
         # resolve name shorthands
-        match = re.match(r'^gh:(.*?)\/(.*?)$', name)
-        if match:
-            user = match.group(1)
-            project = match.group(2)
-            name = self.options.gh_prefix_template % (user, project)
-        match = re.match(r'^bb:(.*?)\/(.*?)$', name)
+        match = SPEC_SHORTHAND_RE.match(name)
         if match:
-            user = match.group(1)
-            project = match.group(2)
-            name = self.options.bb_prefix_template % (user, project)
+            if match.group(1) == 'gh':
+                template = self.options.gh_prefix_template
+            else:
+                template = self.options.bb_prefix_template
+            name = template % (match.group(2), match.group(3))
 
-        match = re.match(r'^git:\/\/(.*?)/(.*?)/(.*?)\.git$', name)
-        if match:
-            host = match.group(1)
-            user = match.group(2)
-            project = match.group(3)
-            return Source(self, url=name, host=host, user=user, project=project,
-                          type='git', tag=tag)
+        scheme = name.split('://', 1)[0] if '://' in name else None
+        patterns = SPEC_PATTERNS.get(scheme, ()) + SPEC_PATTERNS[None]
+        for (pattern, kind) in patterns:
+            match = pattern.match(name)
+            if match:
+                break
+        else:
+            raise SourceSpecError("Couldn't parse source spec '%s'" % name)
 
-        match = re.match(r'^https?:\/\/(.*?)/(.*?)/(.*?)\.git$', name)
-        if match:
-            host = match.group(1)
-            user = match.group(2)
-            project = match.group(3)
+        if kind in ('git', 'hg-or-git'):
+            (host, user, project) = match.groups()
             return Source(self, url=name, host=host, user=user, project=project,
-                          type='git', tag=tag)
-
-        match = re.match(r'^(https?|ftp):\/\/(.*?)/.*?\/?([^/]*?)'
-                         r'\.(zip|tgz|tar\.gz|tar\.xz|tar\.bz2)$', name)
-        if match:
-            host = match.group(2)
-            project = match.group(3)
-            ext = match.group(4)
+                          type=kind, tag=tag)
+        elif kind == 'file':
+            (user, project, git) = match.groups()
+            type = 'git' if git else 'hg-or-git'
+            return Source(self, url=name, host='localhost', user=user,
+                          project=project, type=type, tag=tag)
+        elif kind == 'distfile':
+            (scheme, host, project, ext) = match.groups()
             return Source(self, url=name, host=host, user='distfile',
                           project=project, type=ext, tag=tag)
-
-        match = re.match(r'^https?:\/\/(.*?)/(.*?)/(.*?)\/?$', name)
-        if match:
-            host = match.group(1)
-            user = match.group(2)
-            project = match.group(3)
-            return Source(self, url=name, host=host, user=user, project=project,
-                          type='hg-or-git', tag=tag)
-
-        # local distfile
-        match = re.match(r'^(.*?\/)([^/]*?)\.(zip|tgz|tar\.gz|tar\.xz|tar\.bz2)$', name)
-        if match:
+        elif kind == 'local-distfile':
             host = 'localhost'
             user = 'distfile'
             project = match.group(2)
             ext = match.group(3)
             # has "magic" filename?
-            match = re.match(r'^([^,]*?),([^,]*?),([^,]*?)(\-[^\-]*?)?$', project)
+            match = MAGIC_DISTFILE_NAME_RE.match(project)
             if match:
                 host = match.group(1)
                 user = match.group(2)
                 project = match.group(3)
             return Source(self, url=name, host=host, user=user,
                           project=project, type=ext, local=True, tag=tag)
-
-        # already docked
-        match = re.match(r'^(.*?)\/(.*?)\/(.*?)$', name)
-        if match:
-            host = match.group(1)
-            user = match.group(2)
-            project = match.group(3)
+        else:  # already docked
+            (host, user, project) = match.groups()
             if os.path.isdir(os.path.join(self.dir, host, user, project)):
                 # TODO divine type
                 return Source(self, url='', host=host, user=user,
                               project=project, type='unknown', tag=tag)
             raise SourceSpecError("Source '%s' not docked" % name)
 
-        raise SourceSpecError("Couldn't parse source spec '%s'" % name)
-
     def make_sources_from_specs(self, names):
         sources = []
         for name in names:
@@ -1293,54 +4862,90 @@ class Toolshelf(object):
           @@foo                      read list in .toolshelf/catalog/foo
 
         """
-        if name.startswith('@@'):
-            filename = os.path.join(
-                self.dir, '.toolshelf', 'catalog', name[2:] + '.catalog'
-            )
-            return self.make_sources_from_catalog(filename)
         if name.startswith('@'):
-            return self.make_sources_from_catalog(
-                os.path.join(self.cwd, name[1:])
-            )
+            return self.make_sources_from_catalog(self.catalogs.resolve(name))
 
         return [self.make_source_from_spec(name)]
 
     def make_sources_from_catalog(self, filename):
-        self.debug('Reading catalog %s' % filename)
+        """Return the sources listed in the given catalog file (and the
+        catalogs it includes), leaving out any listed more than once.
+
+        """
         sources = []
-        with open(filename, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if line == '' or line.startswith('#'):
-                    continue
-                sources += self.make_sources_from_spec(line)
+        seen = set()
+        for spec in self.catalogs.expand(filename):
+            source = self.make_source_from_spec(spec)
+            key = (source.name, source.tag)
+            if key not in seen:
+                seen.add(key)
+                sources.append(source)
         return sources
 
     ### processing sources ###
 
-    def foreach_source(self, sources, fun, progress=tqdm):
+    def foreach_source(self, sources, fun, progress=progress_bar, jobs=None):
         """Call `fun` for each Source in the given iterable sources.
 
-        The working directory is changed to that Source's directory
-        before `fun` is called.  (It is not changed back afterwards.)
-        In addition, if `fun` raises an error, it will be caught and
-        collected (unless the --break-on-error option was given.)
+        If `fun` raises an error, it will be caught and collected
+        (unless the --break-on-error option was given.)
+
+        If the --jobs option (or `jobs`, which overrides it) is greater
+        than one, up to that many Sources are processed at once.  In this
+        case, anything a Source writes to standard output is buffered,
+        and written out in one piece once that Source has been processed
+        (except for the output of one Source at a time; see SourceOutput.)
 
         Note that a single spec among the specs can result in
         multiple Sources.
 
         """
-        for source in progress(sources):
-            if os.path.isdir(source.dir):
-                self.chdir(source.dir)
-            else:
-                self.chdir(self.dir)
-            try:
-                fun(source)
-            except Exception as e:
-                if self.options.break_on_error:
-                    raise
-                self.errors.setdefault(source.name, []).append(str(e))
+        if jobs is None:
+            jobs = self.options.jobs
+        if jobs <= 1:
+            for source in progress(sources):
+                try:
+                    fun(source)
+                except Exception as e:
+                    if self.options.break_on_error:
+                        raise
+                    self.errors.setdefault(source.name, []).append(str(e))
+            return
+
+        from multiprocessing.pool import ThreadPool
+
+        (output, installed) = SourceOutput.install()
+        pool = ThreadPool(jobs)
+        try:
+            for (source, text, exc_info) in progress(
+                pool.imap(lambda s: output.capture(fun, s), sources)
+            ):
+                output.emit(text)
+                if exc_info is not None:
+                    self.collect_error(source.name, exc_info)
+        finally:
+            pool.terminate()
+            pool.join()
+            if installed:
+                output.restore()
+
+    def collect_error(self, name, exc_info):
+        """Record the error described by the given `sys.exc_info()`
+        against the given name, or re-raise it if --break-on-error was
+        given.
+
+        """
+        if self.options.break_on_error:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.errors.setdefault(name, []).append(str(exc_info[1]))
+
+    def relink_sources(self, sources):
+        """Relink all of the given sources at once."""
+        planner = LinkPlanner(self)
+        for source in sources:
+            self.debug("Relinking %s" % source)
+            planner.add(source)
+        planner.apply()
 
     def coalesce_catalog_args(self, args):
         # resolve @'s and @@'s which are given individually in the arglist
@@ -1378,14 +4983,12 @@ class Toolshelf(object):
 
 
 def available_commands():
-    fromlist = ["toolshelf.commands"]
-    command_modules = dict([
-        (name, __import__("toolshelf.commands.%s" % name, fromlist=fromlist))
-        for name in COMMANDS
-    ])
-
     def short_desc(command):
-        doc = command_modules[command].__doc__
+        if command in COMMAND_SUMMARIES:
+            return COMMAND_SUMMARIES[command]
+        module = __import__("toolshelf.commands.%s" % command,
+                            fromlist=["toolshelf.commands"])
+        doc = module.__doc__
         if not doc:
             return "(no description available)"
         return doc.strip().split('\n')[0]
@@ -1401,10 +5004,33 @@ def available_commands():
 def main(args):
     parser = optparse.OptionParser(__doc__)
 
+    parser.add_option("--artifact-store", dest="artifact_store",
+                      default=os.environ.get('TOOLSHELF_ARTIFACT_STORE'),
+                      metavar='DIR',
+                      help="restore built sources from, and add newly "
+                           "built sources to, the artifact store in DIR "
+                           "(default: $TOOLSHELF_ARTIFACT_STORE, if set)")
+    parser.add_option("--artifact-store-size", dest="artifact_store_size",
+                      default=4096, type='int', metavar='MB',
+                      help="remove least recently used artifacts from the "
+                           "artifact store when it grows beyond this size "
+                           "(default: %default)")
     parser.add_option("--bb-prefix-template",
                       default='https://bitbucket.org/%s/%s',
                       help="template to expand 'bb:' prefix to "
                            "(default: %default)")
+    parser.add_option("--clone-depth", dest="clone_depth",
+                      default=None, type='int', metavar='N',
+                      help="make shallow clones of git repositories, with "
+                           "only the last N commits of history (the "
+                           "clone_depth hint overrides this; 0 means a "
+                           "full clone)")
+    parser.add_option("--clone-filter", dest="clone_filter",
+                      default=None, metavar='SPEC',
+                      help="make partial clones of git repositories, "
+                           "passing --filter=SPEC (e.g. blob:none) to "
+                           "`git clone` (the clone_filter hint overrides "
+                           "this)")
     parser.add_option("--gh-prefix-template",
                       default='https://github.com/%s/%s',
                       help="template to expand 'gh:' prefix to "
@@ -1419,18 +5045,53 @@ def main(args):
                       help="for certain commands (release and export), "
                            "write the results into this directory "
                            "(default: %default)")
+    parser.add_option("--fetch-jobs", dest="fetch_jobs",
+                      default=8, type='int', metavar='N',
+                      help="for commands which mostly fetch from remote "
+                           "hosts (tether, pull), process up to N sources "
+                           "at once (default: %default)")
+    parser.add_option("--per-host-jobs", dest="per_host_jobs",
+                      default=4, type='int', metavar='N',
+                      help="fetch from no more than N sources on the same "
+                           "host at once (default: %default)")
     parser.add_option("-K", "--break-on-error", dest="break_on_error",
                       default=False, action="store_true",
                       help="abort if error occurs with a single "
                            "source when processing multiple sources")
+    parser.add_option("-f", "--force", dest="force",
+                      default=False, action="store_true",
+                      help="process sources even if they appear to be "
+                           "unchanged since they were last processed")
+    parser.add_option("-j", "--jobs", dest="jobs",
+                      default=1, type='int', metavar='N',
+                      help="process up to N sources at once "
+                           "(default: %default)")
     parser.add_option("--login", dest="login",
                       default=None, metavar='USERNAME',
                       help="username to login with when using the "
                            "Github or Bitbucket APIs")
+    parser.add_option("--rectify-engine", dest="rectify_engine",
+                      default='magic', type='choice',
+                      choices=list(RECTIFY_ENGINES),
+                      help="how to decide which files should be made "
+                           "executable when rectifying permissions: "
+                           "'magic' (inspect their contents in-process) "
+                           "or 'file' (run file(1) on each one) "
+                           "(default: %default)")
     parser.add_option("--unique", dest="unique",
                       default=False, action="store_true",
                       help="abort if given specs do not resolve to "
                            "exactly one source")
+    parser.add_option("--precheck", dest="precheck",
+                      default=False, action="store_true",
+                      help="before pulling, ask each upstream repository "
+                           "for its head, and only pull sources which are "
+                           "behind it")
+    parser.add_option("--share-objects", dest="share_objects",
+                      default=False, action="store_true",
+                      help="clone repositories against a pool of objects "
+                           "shared by all docked sources of the same "
+                           "project (e.g. forks), in $TOOLSHELF/.objects")
     parser.add_option("-q", "--quiet", dest="quiet",
                       default=False, action="store_true",
                       help="suppress output of warning messages")
@@ -1460,6 +5121,7 @@ def main(args):
         t.run_commands(subcommand, args)
     else:
         t.run_command(subcommand, args)
+    t.save_caches()
     if t.errors:
         sys.stderr.write('\nERRORS:\n\n')
         for name in sorted(t.errors.keys()):
@@ -0,0 +1,137 @@
+"""Tests for the store of build outputs (`ArtifactStore`).
+
+Run from the toolshelf directory with:
+
+    python -m unittest discover -s tests
+
+"""
+
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from toolshelf.toolshelf import ArtifactStore, Toolshelf, UnsafeArchiveError
+
+
+def make_member(name, type=tarfile.REGTYPE, linkname=''):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.linkname = linkname
+    return info
+
+
+class FakeSource(object):
+    """Just enough of a `Source` for the artifact store."""
+    def __init__(self, name, dir):
+        self.name = name
+        self.dir = dir
+
+
+class ArtifactStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.shelf = Toolshelf(directory=os.path.join(self.tmp, 'shelf'),
+                               cwd=self.tmp)
+        self.shelf.options.quiet = True
+        self.store = ArtifactStore(self.shelf,
+                                   os.path.join(self.tmp, 'artifacts'),
+                                   1024 * 1024)
+        self.dest_dir = os.path.join(self.tmp, 'shelf', 'example.com',
+                                     'alice', 'foo')
+        os.makedirs(self.dest_dir)
+        self.outside = os.path.join(self.tmp, 'outside')
+        os.mkdir(self.outside)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def assertRejected(self, member):
+        self.assertRaises(UnsafeArchiveError,
+                          self.store.check_member, self.dest_dir, member)
+
+    def test_accepts_members_inside(self):
+        for member in (make_member('install/bin/foo'),
+                       make_member('install', tarfile.DIRTYPE),
+                       make_member('install/lib/libfoo.so',
+                                   tarfile.SYMTYPE, 'libfoo.so.1'),
+                       make_member('install/bin/bar',
+                                   tarfile.SYMTYPE, '../lib/bar'),
+                       make_member('install/bin/baz',
+                                   tarfile.LNKTYPE, 'install/bin/foo')):
+            self.store.check_member(self.dest_dir, member)
+
+    def test_rejects_unsafe_names(self):
+        self.assertRejected(make_member('/etc/passwd'))
+        self.assertRejected(make_member('../foo'))
+        self.assertRejected(make_member('install/../../foo'))
+
+    def test_rejects_symlinks_out(self):
+        self.assertRejected(make_member('esc', tarfile.SYMTYPE, self.outside))
+        self.assertRejected(make_member('esc', tarfile.SYMTYPE, '/etc'))
+        self.assertRejected(make_member('install/esc', tarfile.SYMTYPE,
+                                        '../../outside'))
+
+    def test_rejects_members_through_symlinks_out(self):
+        os.symlink(self.outside, os.path.join(self.dest_dir, 'esc'))
+        self.assertRejected(make_member('esc/owned.txt'))
+        self.assertRejected(make_member('esc/sub', tarfile.DIRTYPE))
+
+    def test_rejects_hardlinks_out(self):
+        self.assertRejected(make_member('install/passwd', tarfile.LNKTYPE,
+                                        '/etc/passwd'))
+        self.assertRejected(make_member('install/passwd', tarfile.LNKTYPE,
+                                        '../../outside/passwd'))
+
+    def test_rejects_devices_and_fifos(self):
+        self.assertRejected(make_member('install/null', tarfile.CHRTYPE))
+        self.assertRejected(make_member('install/disk', tarfile.BLKTYPE))
+        self.assertRejected(make_member('install/fifo', tarfile.FIFOTYPE))
+
+    def test_publish_and_restore(self):
+        source = FakeSource('example.com/alice/foo', self.dest_dir)
+        with open(os.path.join(self.dest_dir, 'foo.c'), 'w') as f:
+            f.write('int main() { return 0; }\n')
+        before = self.store.snapshot(source)
+        os.makedirs(os.path.join(self.dest_dir, 'install', 'bin'))
+        with open(os.path.join(self.dest_dir, 'install', 'bin', 'foo'),
+                  'w') as f:
+            f.write('built\n')
+        with open(os.path.join(self.dest_dir, 'foo.o'), 'w') as f:
+            f.write('object\n')
+        self.store.publish(source, 'ab' * 20, before)
+
+        shutil.rmtree(os.path.join(self.dest_dir, 'install'))
+        os.unlink(os.path.join(self.dest_dir, 'foo.o'))
+        self.assertTrue(self.store.restore(source, 'ab' * 20))
+        with open(os.path.join(self.dest_dir, 'install', 'bin', 'foo')) as f:
+            self.assertEqual(f.read(), 'built\n')
+        self.assertTrue(os.path.isfile(os.path.join(self.dest_dir, 'foo.o')))
+        self.assertFalse(self.store.restore(source, 'cd' * 20))
+
+    def test_restore_refuses_unsafe_artifact(self):
+        source = FakeSource('example.com/alice/foo', self.dest_dir)
+        key = 'ef' * 20
+        filename = self.store.filename(key)
+        os.makedirs(os.path.dirname(filename))
+        with tarfile.open(filename, 'w') as tar:
+            tar.addfile(make_member('install', tarfile.DIRTYPE))
+            tar.addfile(make_member('install/esc', tarfile.SYMTYPE,
+                                    self.outside))
+            info = make_member('install/esc/owned.txt')
+            info.size = len('owned\n')
+            tar.addfile(info, StringIO('owned\n'))
+        self.assertFalse(self.store.restore(source, key))
+        self.assertEqual(os.listdir(self.outside), [])
+        self.assertFalse(os.path.lexists(os.path.join(self.dest_dir,
+                                                      'install')))
+
+
+if __name__ == '__main__':
+    unittest.main()
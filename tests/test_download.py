@@ -0,0 +1,146 @@
+"""Tests for resuming interrupted distfile downloads (`Download`).
+
+Run from the toolshelf directory with:
+
+    python -m unittest discover -s tests
+
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from toolshelf.toolshelf import Downloader, Toolshelf
+
+
+class DistfileHandler(BaseHTTPRequestHandler):
+    """Serves `server.files`, a dict mapping paths to (contents, ETag),
+    honouring Range requests unless an If-Range header doesn't match the
+    ETag, and recording the headers of each request in `server.requests`.
+
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        (contents, etag) = self.server.files[self.path]
+        self.server.requests.append(dict(self.headers.items()))
+        start = 0
+        range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if range and (if_range is None or if_range == etag):
+            start = int(range[len('bytes='):].rstrip('-'))
+        if start >= len(contents) and start > 0:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % len(contents))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, len(contents) - 1, len(contents)))
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(contents) - start))
+        self.end_headers()
+        self.wfile.write(contents[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadTestCase(unittest.TestCase):
+    CONTENTS = ''.join(chr(i % 251) for i in xrange(200000))
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.shelf = Toolshelf(directory=os.path.join(self.tmp, 'shelf'),
+                               cwd=self.tmp)
+        self.shelf.options.quiet = True
+        self.notes = []
+        self.shelf.note = self.notes.append
+        self.server = HTTPServer(('127.0.0.1', 0), DistfileHandler)
+        self.server.files = {'/foo-1.0.tar.gz': (self.CONTENTS, '"v2"')}
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/foo-1.0.tar.gz' % (
+            self.server.server_address[1]
+        )
+        os.makedirs(os.path.join(self.tmp, 'shelf', '.distfiles'))
+        self.filename = os.path.join(self.tmp, 'shelf', '.distfiles',
+                                     'foo.tar.gz')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def leave_part(self, contents, validator=None):
+        with open(self.filename + '.part', 'wb') as f:
+            f.write(contents)
+        if validator is not None:
+            with open(self.filename + '.part.validator', 'w') as f:
+                f.write(validator + '\n')
+
+    def download(self):
+        sha256 = hashlib.sha256(self.CONTENTS).hexdigest()
+        download = Downloader(self.shelf).open(self.url, self.filename,
+                                               sha256=sha256)
+        data = []
+        for chunk in iter(lambda: download.read(8192), ''):
+            data.append(chunk)
+        download.finish()
+        return ''.join(data)
+
+    def assertDownloaded(self, data):
+        self.assertEqual(data, self.CONTENTS)
+        with open(self.filename, 'rb') as f:
+            self.assertEqual(f.read(), self.CONTENTS)
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+        self.assertFalse(os.path.exists(self.filename + '.part.validator'))
+
+    def test_fresh_download(self):
+        self.assertDownloaded(self.download())
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertNotIn('range', self.server.requests[0])
+
+    def test_resume_with_matching_validator(self):
+        self.leave_part(self.CONTENTS[:70000], '"v2"')
+        self.assertDownloaded(self.download())
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]['range'], 'bytes=70000-')
+        self.assertEqual(self.server.requests[0]['if-range'], '"v2"')
+
+    def test_resume_with_stale_validator_restarts(self):
+        # the distfile changed on the server since the download of the
+        # old one was interrupted, so the If-Range gets a 200
+        self.leave_part('old contents ' * 1000, '"v1"')
+        self.assertDownloaded(self.download())
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]['if-range'], '"v1"')
+        self.assertTrue([note for note in self.notes
+                         if 'starting over' in note])
+
+    def test_resume_without_validator_restarts(self):
+        self.leave_part('old contents ' * 1000)
+        self.assertDownloaded(self.download())
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertNotIn('range', self.server.requests[0])
+
+    def test_complete_part(self):
+        self.leave_part(self.CONTENTS, '"v2"')
+        self.assertDownloaded(self.download())
+        self.assertEqual(self.server.requests[0]['range'], 'bytes=200000-')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""Tests for extracting distfiles into sources (`DistfileExtractor`).
+
+Run from the toolshelf directory with:
+
+    python -m unittest discover -s tests
+
+"""
+
+import os
+import shutil
+import stat
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from toolshelf.toolshelf import DistfileExtractor, Toolshelf
+
+
+def make_tar(members):
+    """Return a file-like object holding a .tar.gz of the given members,
+    each a tuple of (name, type, linkname or contents).
+
+    """
+    fileobj = StringIO()
+    with tarfile.open(fileobj=fileobj, mode='w:gz') as tar:
+        for (name, type, value) in members:
+            info = tarfile.TarInfo(name)
+            info.type = type
+            data = None
+            if type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = value
+            elif type == tarfile.DIRTYPE:
+                info.mode = 0755
+            else:
+                info.size = len(value)
+                data = StringIO(value)
+            tar.addfile(info, data)
+    fileobj.seek(0)
+    return fileobj
+
+
+def make_zip(members):
+    """Return a file-like object holding a .zip of the given members,
+    each a tuple of (name, contents, mode).
+
+    """
+    fileobj = StringIO()
+    with zipfile.ZipFile(fileobj, 'w') as archive:
+        for (name, contents, mode) in members:
+            info = zipfile.ZipInfo(name)
+            info.external_attr = mode << 16
+            archive.writestr(info, contents)
+    fileobj.seek(0)
+    return fileobj
+
+
+class DistfileExtractorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.shelf = Toolshelf(directory=os.path.join(self.tmp, 'shelf'),
+                               cwd=self.tmp)
+        self.shelf.options.quiet = True
+        self.dest_dir = os.path.join(self.tmp, 'shelf', 'example.com',
+                                     'distfile', 'evil-1.0')
+        self.outside = os.path.join(self.tmp, 'evil-target')
+        os.mkdir(self.outside)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def extract(self, fileobj, type):
+        DistfileExtractor(self.shelf, self.dest_dir).extract(fileobj, type)
+
+    def assertNothingOutside(self):
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_well_structured_tar(self):
+        self.extract(make_tar([
+            ('foo-1.0/', tarfile.DIRTYPE, None),
+            ('foo-1.0/bin/', tarfile.DIRTYPE, None),
+            ('foo-1.0/bin/foo', tarfile.REGTYPE, 'foo\n'),
+            ('foo-1.0/bin/bar', tarfile.SYMTYPE, 'foo'),
+            ('foo-1.0/bin/baz', tarfile.LNKTYPE, 'foo-1.0/bin/foo'),
+        ]), 'tar.gz')
+        bin_dir = os.path.join(self.dest_dir, 'bin')
+        self.assertEqual(sorted(os.listdir(bin_dir)), ['bar', 'baz', 'foo'])
+        self.assertEqual(os.readlink(os.path.join(bin_dir, 'bar')), 'foo')
+        self.assertTrue(os.path.samefile(os.path.join(bin_dir, 'baz'),
+                                         os.path.join(bin_dir, 'foo')))
+
+    def test_tar_symlink_escape(self):
+        # a symlink out of the source, and then a file "in" it
+        self.extract(make_tar([
+            ('evil-1.0/', tarfile.DIRTYPE, None),
+            ('evil-1.0/esc', tarfile.SYMTYPE, self.outside),
+            ('evil-1.0/esc/owned.txt', tarfile.REGTYPE, 'owned\n'),
+        ]), 'tar.gz')
+        self.assertNothingOutside()
+        self.assertFalse(os.path.islink(os.path.join(self.dest_dir, 'esc')))
+
+    def test_tar_relative_symlink_escape(self):
+        self.extract(make_tar([
+            ('evil-1.0/', tarfile.DIRTYPE, None),
+            ('evil-1.0/esc', tarfile.SYMTYPE, '../../../../evil-target'),
+            ('evil-1.0/esc/owned.txt', tarfile.REGTYPE, 'owned\n'),
+        ]), 'tar.gz')
+        self.assertNothingOutside()
+        self.assertFalse(os.path.islink(os.path.join(self.dest_dir, 'esc')))
+
+    def test_tar_unsafe_names_and_hard_links(self):
+        self.extract(make_tar([
+            ('evil-1.0/', tarfile.DIRTYPE, None),
+            ('evil-1.0/../../../../evil-target/owned.txt',
+             tarfile.REGTYPE, 'owned\n'),
+            ('evil-1.0/passwd', tarfile.LNKTYPE, '../../../../etc/passwd'),
+            ('evil-1.0/ok', tarfile.REGTYPE, 'ok\n'),
+        ]), 'tar.gz')
+        self.assertNothingOutside()
+        self.assertEqual(os.listdir(self.dest_dir), ['ok'])
+
+    def test_zip_symlink_escape(self):
+        link_mode = stat.S_IFLNK | 0777
+        file_mode = stat.S_IFREG | 0644
+        self.extract(make_zip([
+            ('evil-1.0/esc', self.outside, link_mode),
+            ('evil-1.0/rel', '../../../../evil-target', link_mode),
+            ('evil-1.0/esc/owned.txt', 'owned\n', file_mode),
+            ('evil-1.0/ok', 'ok\n', file_mode),
+            ('evil-1.0/good', 'ok', link_mode),
+        ]), 'zip')
+        self.assertNothingOutside()
+        self.assertEqual(
+            os.readlink(os.path.join(self.dest_dir, 'good')), 'ok'
+        )
+        for name in ('esc', 'rel'):
+            self.assertFalse(
+                os.path.islink(os.path.join(self.dest_dir, name))
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Tests for fetching sources in parallel (`interleave_by_host`,
+`Toolshelf.host_slot`).
+
+Run from the toolshelf directory with:
+
+    python -m unittest discover -s tests
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from toolshelf.toolshelf import Source, Toolshelf, interleave_by_host
+
+
+class FetchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.shelf = Toolshelf(directory=os.path.join(self.tmp, 'shelf'),
+                               cwd=self.tmp)
+        self.shelf.options.quiet = True
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_sources(self, *names):
+        sources = []
+        for name in names:
+            (host, user, project) = name.split('/')
+            sources.append(Source(self.shelf, host=host, user=user,
+                                  project=project, type='git'))
+        return sources
+
+    def test_interleave_by_host(self):
+        sources = self.make_sources(
+            'github.com/a/1', 'github.com/a/2', 'github.com/b/3',
+            'bitbucket.org/c/4', 'bitbucket.org/c/5', 'example.com/d/6',
+        )
+        self.assertEqual(
+            [source.name for source in interleave_by_host(sources)],
+            ['github.com/a/1', 'bitbucket.org/c/4', 'example.com/d/6',
+             'github.com/a/2', 'bitbucket.org/c/5', 'github.com/b/3']
+        )
+        self.assertEqual(interleave_by_host([]), [])
+
+    def test_host_slot_is_per_host(self):
+        self.assertIs(self.shelf.host_slot('github.com'),
+                      self.shelf.host_slot('github.com'))
+        self.assertIsNot(self.shelf.host_slot('github.com'),
+                         self.shelf.host_slot('bitbucket.org'))
+
+    def test_fetches_are_limited_per_host(self):
+        self.shelf.options.per_host_jobs = 2
+        sources = interleave_by_host(self.make_sources(*(
+            '%s/user/project%d' % (host, n)
+            for host in ('github.com', 'bitbucket.org')
+            for n in xrange(6)
+        )))
+        lock = threading.Lock()
+        active = {}
+        most = {}
+
+        def fetch(source):
+            with self.shelf.host_slot(source.host):
+                with lock:
+                    active[source.host] = active.get(source.host, 0) + 1
+                    most[source.host] = max(most.get(source.host, 0),
+                                            active[source.host])
+                    most['all'] = max(most.get('all', 0),
+                                      sum(active.values()))
+                time.sleep(0.05)
+                with lock:
+                    active[source.host] -= 1
+
+        self.shelf.foreach_source(sources, fetch, progress=lambda x: x,
+                                  jobs=8)
+        self.assertEqual(self.shelf.errors, {})
+        self.assertEqual(most['github.com'], 2)
+        self.assertEqual(most['bitbucket.org'], 2)
+        # fetches from one host don't hold up fetches from another
+        self.assertEqual(most['all'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
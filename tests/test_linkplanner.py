@@ -0,0 +1,142 @@
+"""Tests for planning and applying changes to link farms (`LinkPlanner`).
+
+Run from the toolshelf directory with:
+
+    python -m unittest discover -s tests
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from toolshelf.toolshelf import LinkPlanner, Source, Toolshelf
+
+
+class LinkPlannerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.shelf = Toolshelf(directory=os.path.join(self.tmp, 'shelf'),
+                               cwd=self.tmp)
+        self.shelf.options.quiet = True
+        # sources are changed within the same second as they are searched
+        self.shelf.options.force = True
+        self.notes = []
+        self.shelf.note = self.notes.append
+        self.warnings = []
+        self.shelf.warn = self.warnings.append
+        self.farm = self.shelf.link_farms['bin']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_source(self, user, *executables):
+        source = Source(self.shelf, host='example.com', user=user,
+                        project='foo', type='git')
+        for filename in executables:
+            self.add_executable(source, filename)
+        return source
+
+    def add_executable(self, source, filename):
+        filename = os.path.join(source.dir, filename)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(filename, 0755)
+        return filename
+
+    def apply(self, *sources):
+        planner = LinkPlanner(self.shelf)
+        for source in sources:
+            planner.add(source)
+        del self.notes[:]
+        return planner.apply()
+
+    def farm_contents(self):
+        return dict((os.path.basename(linkname), target)
+                    for (linkname, target) in self.farm.links())
+
+    def diff_notes(self):
+        return sorted(note for note in self.notes
+                      if note.startswith(('Adding', 'Removing')))
+
+    def test_plan_last_source_wins(self):
+        alice = self.make_source('alice', 'bin/foo', 'bin/alice')
+        bob = self.make_source('bob', 'bin/foo')
+        planner = LinkPlanner(self.shelf)
+        planner.add(bob)
+        planner.add(alice)
+        self.assertEqual(planner.plan()['bin'], {
+            'foo': os.path.join(bob.dir, 'bin', 'foo'),
+            'alice': os.path.join(alice.dir, 'bin', 'alice'),
+        })
+
+    def test_apply_to_empty_farm(self):
+        alice = self.make_source('alice', 'bin/foo', 'bin/bar')
+        (changes, naive_operations) = self.apply(alice)
+        foo = os.path.join(alice.dir, 'bin', 'foo')
+        bar = os.path.join(alice.dir, 'bin', 'bar')
+        self.assertEqual(changes, 2)
+        self.assertEqual(naive_operations, 2)
+        self.assertEqual(self.farm_contents(), {'foo': foo, 'bar': bar})
+        self.assertEqual(self.diff_notes(), [
+            'Adding [bin] link bar -> %s' % bar,
+            'Adding [bin] link foo -> %s' % foo,
+        ])
+
+    def test_apply_makes_only_the_difference(self):
+        alice = self.make_source('alice', 'bin/foo', 'bin/bar')
+        self.apply(alice)
+        generation = self.farm.current_generation()
+
+        os.unlink(os.path.join(alice.dir, 'bin', 'bar'))
+        baz = self.add_executable(alice, 'bin/baz')
+        (changes, naive_operations) = self.apply(alice)
+        self.assertEqual(changes, 2)
+        # removing both old links, then adding (and trampling foo)
+        self.assertEqual(naive_operations, 5)
+        self.assertEqual(self.farm_contents(), {
+            'foo': os.path.join(alice.dir, 'bin', 'foo'), 'baz': baz,
+        })
+        self.assertEqual(self.diff_notes(), [
+            'Adding [bin] link baz -> %s' % baz,
+            'Removing [bin] link bar -> %s' %
+                os.path.join(alice.dir, 'bin', 'bar'),
+        ])
+        self.assertEqual(self.farm.current_generation(), generation + 1)
+
+    def test_apply_without_changes_publishes_nothing(self):
+        alice = self.make_source('alice', 'bin/foo')
+        self.apply(alice)
+        generation = self.farm.current_generation()
+        (changes, naive_operations) = self.apply(alice)
+        self.assertEqual(changes, 0)
+        self.assertEqual(self.diff_notes(), [])
+        self.assertEqual(self.farm.current_generation(), generation)
+
+    def test_apply_keeps_and_tramples_links_to_other_sources(self):
+        elsewhere = os.path.join(self.tmp, 'elsewhere')
+        self.farm.publish({'foo': os.path.join(elsewhere, 'foo'),
+                           'other': os.path.join(elsewhere, 'other')})
+        alice = self.make_source('alice', 'bin/foo')
+        foo = os.path.join(alice.dir, 'bin', 'foo')
+        (changes, naive_operations) = self.apply(alice)
+        self.assertEqual(changes, 2)
+        self.assertEqual(self.farm_contents(), {
+            'foo': foo, 'other': os.path.join(elsewhere, 'other'),
+        })
+        self.assertEqual(self.warnings, [
+            'Trampling existing [.bin] link foo',
+            '  was: %s' % os.path.join(elsewhere, 'foo'),
+            '  now: %s' % foo,
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Compares the cost of applying cookie hints with toolshelf's CookieMatcher
+# against the straightforward loop (fnmatch.translate and re.match of every
+# spec key against every source name) which it replaced.
+
+# example:
+#   python util/benchmark-cookies.py --sources 10000 --keys 2000
+
+# The old loop is far too slow to run over all the sources at these sizes,
+# so it is only run over a sample of them, and its total time extrapolated.
+
+import fnmatch
+import optparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'src'))
+
+from toolshelf.toolshelf import CookieMatcher
+
+
+HOSTS = ('github.com', 'bitbucket.org', 'gitorious.org', 'example.com')
+
+
+def make_hint_map(count, rng):
+    hint_map = {}
+    for n in xrange(count):
+        kind = n % 5
+        if kind == 0:
+            key = '*/*/project%d' % n
+        elif kind == 1:
+            key = '*/user%d/*' % n
+        elif kind == 2:
+            key = '%s/user%d/project%d' % (rng.choice(HOSTS), n, n)
+        elif kind == 3:
+            key = '*/*/project%d-*' % n
+        else:
+            key = '*/user%d/project%d*' % (n, n)
+        hint_map[key] = {'build_command': 'make %d' % n}
+    # a few which can't be bucketed at all
+    hint_map['*/*/*-devel'] = {'exclude_paths': 'devel'}
+    hint_map['*'] = {'test_command': 'true'}
+    return hint_map
+
+
+def make_names(count, key_count, rng):
+    names = []
+    for n in xrange(count):
+        k = rng.randrange(key_count * 2)
+        names.append('%s/user%d/project%d%s' % (
+            rng.choice(HOSTS), k, rng.randrange(key_count * 2),
+            rng.choice(('', '-1.0', '-devel'))
+        ))
+    return names
+
+
+def legacy_hints(hint_maps, name):
+    hints = {}
+    for hint_map in hint_maps:
+        found_in_map = False
+        for (key, key_hints) in hint_map.iteritems():
+            pattern = fnmatch.translate(key)
+            if re.match(pattern, name):
+                hints.update(key_hints)
+                found_in_map = True
+        if found_in_map:
+            break
+    return hints
+
+
+def matcher_hints(matchers, name):
+    hints = {}
+    for matcher in matchers:
+        found = matcher.match(name)
+        if found:
+            for key_hints in found:
+                hints.update(key_hints)
+            break
+    return hints
+
+
+def main(args):
+    parser = optparse.OptionParser()
+    parser.add_option("--sources", type="int", default=10000)
+    parser.add_option("--keys", type="int", default=2000)
+    parser.add_option("--legacy-sample", type="int", default=50,
+                      help="number of sources to time the old loop over "
+                           "(default: %default)")
+    parser.add_option("--seed", type="int", default=1)
+    (options, args) = parser.parse_args(args)
+
+    rng = random.Random(options.seed)
+    hint_maps = [make_hint_map(options.keys, rng)]
+    names = make_names(options.sources, options.keys, rng)
+    sample = names[:options.legacy_sample]
+
+    start = time.time()
+    legacy_results = [legacy_hints(hint_maps, name) for name in sample]
+    legacy_time = (time.time() - start) * len(names) / max(len(sample), 1)
+
+    start = time.time()
+    matchers = [CookieMatcher(hint_map) for hint_map in hint_maps]
+    build_time = time.time() - start
+    start = time.time()
+    results = [matcher_hints(matchers, name) for name in names]
+    match_time = time.time() - start
+
+    if results[:len(sample)] != legacy_results:
+        print "MISMATCH between CookieMatcher and the old loop!"
+        sys.exit(1)
+
+    print "%d sources x %d spec keys" % (len(names), options.keys)
+    print "old loop:       %8.3fs (extrapolated from %d sources)" % (
+        legacy_time, len(sample)
+    )
+    print "CookieMatcher:  %8.3fs (%.3fs to build, %.3fs to match)" % (
+        build_time + match_time, build_time, match_time
+    )
+    print "speedup:        %8.1fx" % (
+        legacy_time / max(build_time + match_time, 1e-9)
+    )
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+# Measures how long `bin/toolshelf.py` takes to start up and do a trivial
+# amount of work -- by default, what the `toolshelf cd` shell function in
+# `init.sh` runs -- and optionally fails if that exceeds a threshold.
+
+# example:
+#   python util/benchmark-startup.py --runs 20 --max-warm-ms 30
+#   python util/benchmark-startup.py --shelf $TOOLSHELF -- --unique resolve foo
+
+# "Warm" runs use the toolshelf source tree as it is, so Python can use
+# the .pyc files written by earlier runs.  "Cold" runs each use a fresh copy
+# of the source tree with no .pyc files, so they also pay for compiling
+# every module which is imported.  (Neither drops the operating system's
+# file cache.)
+
+# Unless --shelf is given, a throwaway toolshelf directory containing a
+# single docked source is created to run against, so that the user's own
+# link farms and caches are not touched.
+
+# The time taken to start the bare Python interpreter is measured too, and
+# the limits given by --max-warm-ms and --max-cold-ms apply to how much
+# longer than that toolshelf takes, so that they mean much the same thing
+# on faster and slower machines.
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+TOOLSHELF_ROOT = os.path.realpath(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..'
+))
+
+
+def make_shelf(dirname):
+    os.makedirs(os.path.join(dirname, 'example.com', 'someone', 'project'))
+    os.symlink(TOOLSHELF_ROOT, os.path.join(dirname, '.toolshelf'))
+
+
+def copy_tree(dest):
+    """Copy just enough of the toolshelf tree to run it, without .pyc's."""
+    for subdir in ('bin', 'src'):
+        shutil.copytree(
+            os.path.join(TOOLSHELF_ROOT, subdir), os.path.join(dest, subdir),
+            ignore=shutil.ignore_patterns('*.pyc', '*.pyo')
+        )
+    return os.path.join(dest, 'bin', 'toolshelf.py')
+
+
+def time_run(argv, env):
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        process = subprocess.Popen(argv, env=env, stdout=devnull)
+        status = process.wait()
+        elapsed = time.time() - start
+    if status != 0:
+        sys.stderr.write("`%s` exited with status %d\n" %
+                         (' '.join(argv), status))
+        sys.exit(1)
+    return elapsed * 1000.0
+
+
+def median(times):
+    return sorted(times)[len(times) // 2]
+
+
+def summarize(label, times, baseline=None):
+    line = "%-8s min %7.1fms  median %7.1fms  max %7.1fms" % (
+        label, min(times), median(times), max(times)
+    )
+    if baseline is not None:
+        line += "  (+%.1fms over python)" % (median(times) - baseline)
+    print line
+
+
+def main(args):
+    parser = optparse.OptionParser(
+        "%prog [options] [-- <toolshelf arguments>]"
+    )
+    parser.add_option("--runs", type="int", default=20,
+                      help="number of times to run each kind of startup "
+                           "(default: %default)")
+    parser.add_option("--python", default=sys.executable,
+                      help="Python interpreter to run toolshelf with "
+                           "(default: %default)")
+    parser.add_option("--shelf", default=None, metavar='DIR',
+                      help="run against the toolshelf directory DIR instead "
+                           "of a throwaway one")
+    parser.add_option("--max-warm-ms", type="float", default=None,
+                      metavar='MS',
+                      help="exit with an error if the median warm startup "
+                           "takes more than MS milliseconds longer than "
+                           "starting Python")
+    parser.add_option("--max-cold-ms", type="float", default=None,
+                      metavar='MS',
+                      help="exit with an error if the median cold startup "
+                           "takes more than MS milliseconds longer than "
+                           "starting Python")
+    (options, args) = parser.parse_args(args)
+    if not args:
+        args = ['--unique', 'resolve', 'project']
+
+    scratch = tempfile.mkdtemp(prefix='toolshelf-startup-')
+    try:
+        shelf = options.shelf
+        if shelf is None:
+            shelf = os.path.join(scratch, 'shelf')
+            make_shelf(shelf)
+        env = dict(os.environ)
+        env['TOOLSHELF'] = os.path.realpath(shelf)
+        script = os.path.join(TOOLSHELF_ROOT, 'bin', 'toolshelf.py')
+
+        # once to write the .pyc files, and make sure the command works
+        time_run([options.python, script] + args, env)
+
+        # the kinds of run are interleaved, so that anything else going on
+        # on the machine affects them all alike
+        (baseline, warm, cold) = ([], [], [])
+        for n in xrange(options.runs):
+            baseline.append(time_run([options.python, '-c', 'pass'], env))
+            warm.append(time_run([options.python, script] + args, env))
+            tree = os.path.join(scratch, 'tree%d' % n)
+            cold.append(time_run([options.python, copy_tree(tree)] + args,
+                                 env))
+            shutil.rmtree(tree)
+    finally:
+        shutil.rmtree(scratch)
+
+    print "toolshelf %s (%d runs each)" % (' '.join(args), options.runs)
+    summarize("python", baseline)
+    summarize("warm", warm, median(baseline))
+    summarize("cold", cold, median(baseline))
+
+    failed = False
+    for (label, times, limit) in (('warm', warm, options.max_warm_ms),
+                                  ('cold', cold, options.max_cold_ms)):
+        overhead = median(times) - median(baseline)
+        if limit is not None and overhead > limit:
+            print "REGRESSION: %s startup takes %.1fms over python, " \
+                  "more than %.1fms" % (label, overhead, limit)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])